@@ -0,0 +1,166 @@
+#
+# Admission control for scapyHunt.py
+#
+# Token buckets in front of processPacket, so a flood from a player (ie, macof, or
+# nmap -T5) can't keep the packet loop from answering everything else. Each frame
+# is looked at from a few header bytes at fixed offsets:
+#  - frames nothing would answer (IPv4 to an address that isn't a simulated host,
+#    and anything but ARP/IPv4) are passed over: the switch learns their source MAC
+#    (see scapyHunt.shedFrame), so macof still overflows the CAM table, and they
+#    are never dissected
+#  - the others are classified (ADMIT_*), and take a token from their source's
+#    bucket for that class (keyed by source MAC, and source IP for IPv4), so one
+#    noisy source is held to its budget
+#  - a source without a bucket yet takes its token from the session's bucket for
+#    new sources of the class, holding AGGREGATE times a source's budget. A flood
+#    from random sources is all new sources, so it is held by that alone, while
+#    sources already known (ie, the player's own knocks) keep their budgets.
+# Buckets refill at their budget's rate, up to its burst. Frames over budget are shed
+# (learned by the switch, like those passed over) and counted per class.
+#
+# Like the CAM table (camTable.py) the source buckets are kept in last-seen order
+# and bounded: making room forgets the least recently seen source, which counts as
+# new again if it comes back. New sources that were shed aren't remembered, so a
+# flood doesn't push the known ones out.
+#
+
+import collections
+import struct
+import time
+
+# Frame classes, each with its own budget
+ADMIT_ARP = 0
+ADMIT_ICMP = 1
+ADMIT_SYN = 2     # TCP SYNs (port scans, macof aimed at a host)
+ADMIT_TCP = 3     # every other TCP segment (handshakes, service data and ACKs)
+ADMIT_NAMES = ("arp", "icmp", "syn", "tcp")
+
+# Per-source budgets, as (frames/sec, burst). An nmap -T4 sweep and scan of the
+#  network, and the ACKs of a RETR at full speed, stay within them.
+DEFAULT_BUDGETS = {
+  ADMIT_ARP:  (500.0, 1000.0),
+  ADMIT_ICMP: (500.0, 1000.0),
+  ADMIT_SYN:  (5000.0, 5000.0),
+  ADMIT_TCP:  (50000.0, 10000.0),
+}
+
+# A session's budget for new sources of a class, in source budgets
+AGGREGATE = 4
+
+# Source MAC (as two words), EtherType, IPv4 version/IHL, protocol, source and
+#  destination, from byte 6 of the frame
+sourceHeader = struct.Struct("!IHHB8xB2xII")
+
+# Parses a budget given as "class=rate:burst" (ie, "syn=2000:4000", or "syn=2000"
+#  for a burst of one second's worth), returning (class, (rate, burst))
+def parseBudget(text):
+  name, sep, value = text.partition("=")
+  if name not in ADMIT_NAMES or not sep:
+    raise ValueError("budget should be one of %s=RATE[:BURST], not %r" %
+                     ("/".join(ADMIT_NAMES), text))
+  rate, sep, burst = value.partition(":")
+  rate = float(rate)
+  burst = float(burst) if burst else max(rate, 1.0)
+  if rate < 0 or burst < 1:
+    raise ValueError("budget %r needs a rate >= 0 and a burst >= 1" % text)
+  return ADMIT_NAMES.index(name), (rate, burst)
+
+class AdmissionControl(object):
+
+  # targets  - the IPv4 addresses answered, packed (ie, the session's hosts)
+  # budgets  - class -> (frames/sec, burst), replacing the DEFAULT_BUDGETS of those classes
+  # capacity - the most sources with a bucket at once
+  def __init__(self, targets, budgets=None, capacity=4096, clock=time.monotonic):
+    merged = dict(DEFAULT_BUDGETS)
+    if budgets:
+      merged.update(budgets)
+    self.targets = targets
+    self.rates = [merged[c][0] for c in range(len(ADMIT_NAMES))]
+    self.bursts = [merged[c][1] for c in range(len(ADMIT_NAMES))]
+    self.capacity = capacity
+    self.clock = clock
+    now = clock()
+    # The session's bucket for new sources of each class, and when each was last
+    #  refilled
+    self.tokens = [burst * AGGREGATE for burst in self.bursts]
+    self.refilled = [now] * len(ADMIT_NAMES)
+    # Source key -> [tokens, last refilled], see admit
+    self.sources = collections.OrderedDict()
+
+    # Accounting
+    #  passed     - frames nothing would answer, only learned by the switch
+    #  (per class)
+    #  admitted   - frames let through to the packet loop
+    #  shedSource - frames over their source's budget
+    #  shedNew    - frames from new sources over the session's budget for them
+    self.passed = 0
+    self.admitted = [0] * len(ADMIT_NAMES)
+    self.shedSource = [0] * len(ADMIT_NAMES)
+    self.shedNew = [0] * len(ADMIT_NAMES)
+
+  # Frames shed, per class
+  @property
+  def shed(self):
+    return [a + b for a, b in zip(self.shedSource, self.shedNew)]
+
+  # Decides whether a frame goes to the packet loop, at time now (from the clock,
+  #  read once per batch). Returns False for a frame passed over or shed.
+  def admit(self, data, now):
+    size = len(data)
+    if size < 34:
+      self.passed += 1
+      return False
+    macHi, macLo, etherType, verIhl, proto, src, dst = sourceHeader.unpack_from(data, 6)
+    # The source's key: its MAC, IPv4 address (if any) and the class in one int
+    key = (macHi << 16 | macLo) << 40
+    if etherType == 0x0806:
+      cls = ADMIT_ARP
+    elif etherType != 0x0800 or dst not in self.targets:
+      self.passed += 1
+      return False
+    elif proto == 6:
+      flagsAt = 14 + (verIhl & 0x0f) * 4 + 13
+      if flagsAt < size and data[flagsAt] & 0x17 == 0x02:
+        cls = ADMIT_SYN
+      else:
+        cls = ADMIT_TCP
+      key |= src << 8
+    elif proto == 1:
+      cls = ADMIT_ICMP
+      key |= src << 8
+    else:
+      self.passed += 1
+      return False
+    key |= cls
+
+    sources = self.sources
+    bucket = sources.get(key)
+    if bucket is not None:
+      sources.move_to_end(key)
+      tokens = bucket[0] + (now - bucket[1]) * self.rates[cls]
+      if tokens > self.bursts[cls]:
+        tokens = self.bursts[cls]
+      bucket[1] = now
+      if tokens < 1:
+        bucket[0] = tokens
+        self.shedSource[cls] += 1
+        return False
+      bucket[0] = tokens - 1
+      self.admitted[cls] += 1
+      return True
+
+    tokens = self.tokens[cls] + (now - self.refilled[cls]) * self.rates[cls] * AGGREGATE
+    cap = self.bursts[cls] * AGGREGATE
+    if tokens > cap:
+      tokens = cap
+    self.refilled[cls] = now
+    if tokens < 1:
+      self.tokens[cls] = tokens
+      self.shedNew[cls] += 1
+      return False
+    self.tokens[cls] = tokens - 1
+    if len(sources) >= self.capacity:
+      sources.popitem(last=False)
+    sources[key] = [self.bursts[cls] - 1, now]
+    self.admitted[cls] += 1
+    return True
@@ -0,0 +1,400 @@
+#
+# Vectorized replies to probe bursts for scapyHunt.py
+#
+# When a wakeup drains a burst of probes (an nmap ping sweep or SYN scan), the
+# replies to all of them are worked out at once with NumPy rather than one
+# replyEngine call per frame:
+#  - frames of the same length are stacked into one array, read through a
+#    structured dtype of the header fields probes are told apart by (see fieldsFor)
+#  - the probes every session answers the same way, whatever state the game is in,
+#    are picked out: ARP who-has to a host (the is-at comes from its template), ICMP
+#    echo-requests to a host that answers them, and the bare SYNs the scan fast
+#    path answers (see scapyHunt.scanReply). Everything else is left to the
+#    per-packet path. The hosts of a HostStore's ranges (see hostTable.py) are
+#    looked up by range, and answered without making their Host entries.
+#  - each kind's replies are built as the rows of one contiguous array, with the
+#    swapped addresses and ports, seq/ack and checksums (carried over incrementally,
+#    as in replyEngine.checksumAdjust) computed for every row at once
+# The replies are byte for byte the ones the per-packet path builds (checked over
+# the replay streams by benchmark.py batch).
+#
+# Only an ARP is-at from the player changes how a probe is answered (the MAC a
+# host's is-at gives, after a spoof), so who-has frames after the first other ARP
+# frame of a batch are left to the per-packet path, which handles them after it.
+#
+# The batch path is only taken with --batch (see scapyHunt.batchPath): it pays off on
+# SYN scans and sweeps of host ranges, but stacking costs more than it saves on
+# other traffic. NumPy is optional: without it (see available) every frame takes the
+# per-packet path. It is only imported once the first BatchReplier answers a burst
+# (see loadNumpy), as importing it takes longer than starting the rest of the game.
+#
+
+import importlib.util
+
+from fastPath import FRAME_ARP, FRAME_ICMP
+from replyEngine import ARP_TEMPLATE_LEN
+from portIndex import PORT_OPEN, PORT_FILTERED, BITMAP_SIZE
+
+# Is the batch path available (NumPy is installed)?
+available = importlib.util.find_spec("numpy") is not None
+numpy = None
+
+# Imports NumPy, the first time the batch path needs it
+def loadNumpy():
+  global numpy
+  if numpy is None:
+    import numpy as module
+    numpy = module
+    hookRow(())
+
+# Header fields read from each frame, as (name, format, offset). Those that don't fit
+#  in a frame's length are left out of its dtype.
+probeFields = [
+  ("etherType", ">u2", 12),
+  # ARP
+  ("hwlen", "u1", 18), ("plen", "u1", 19), ("op", ">u2", 20), ("pdst", ">u4", 38),
+  # IPv4 (no options)
+  ("verIhl", "u1", 14), ("frag", ">u2", 20), ("proto", "u1", 23), ("dst", ">u4", 30),
+  # ICMP
+  ("icmpType", "u1", 34), ("typeWord", ">u2", 34), ("icmpChksum", ">u2", 36),
+  # TCP
+  ("dport", ">u2", 36), ("seq", ">u4", 38), ("ack", ">u4", 42),
+  ("offsetByte", "u1", 46), ("tcpFlags", "u1", 47), ("flagsWord", ">u2", 46),
+  ("tcpChksum", ">u2", 50),
+]
+
+# Shortest frame the batch path looks at (an ARP who-has), and the shortest bare SYN
+MIN_LENGTH = 42
+SYN_LENGTH = 54
+# Fewest frames of one length worth answering together; smaller groups go to the
+#  per-packet path
+GROUP_MIN = 8
+
+# Most batches in a row left to the per-packet path after ones the batch path
+#  answered too few probes of (see wanted)
+MAX_BACKOFF = 8
+
+# Frames handled by the batch path without a reply (SYNs to filtered ports)
+NO_REPLY = False
+
+# Frame length -> structured dtype over a whole frame of that length
+dtypes = dict()
+
+def fieldsFor(length):
+  dtype = dtypes.get(length)
+  if dtype is None:
+    fields = [f for f in probeFields if f[2] + numpy.dtype(f[1]).itemsize <= length]
+    dtype = dtypes[length] = numpy.dtype({"names": [f[0] for f in fields],
+                                          "formats": [f[1] for f in fields],
+                                          "offsets": [f[2] for f in fields],
+                                          "itemsize": length})
+  return dtype
+
+# replyEngine.checksumAdjust of every row at once (as int64 arrays). The one case
+#  checksumAdjust keeps at 0xffff needs a new sum of 0, which none of these replies
+#  have: a SYN-ACK or RST-ACK always has flags set, and an echo-reply's type word is
+#  only 0 when the old one was 0x0800.
+def checksumAdjust(chksum, oldSum, newSum):
+  return 0xfffe - (0xfffe - chksum - oldSum + newSum) % 0xffff
+
+# Frame length -> column order of a reply copied from a probe: the Ethernet and IPv4
+#  source/destination swapped, and the TCP ports too if tcp
+swaps = dict()
+
+# Copies the rows of frames, with the addresses (and TCP ports) swapped
+def swappedRows(frames, rows, tcp):
+  length = frames.shape[1]
+  order = swaps.get((length, tcp))
+  if order is None:
+    order = numpy.arange(length)
+    pairs = [(0, 6, 6), (26, 30, 4)]
+    if tcp:
+      pairs.append((34, 36, 2))
+    for a, b, size in pairs:
+      order[a:a + size], order[b:b + size] = numpy.arange(b, b + size), numpy.arange(a, a + size)
+    swaps[(length, tcp)] = order
+  return frames.take(rows, axis=0).take(order, axis=1)
+
+# Hands out the rows of a reply array (as views of its one buffer) to the frames
+#  they answer
+def spread(replies, indexes, out):
+  length = out.shape[1]
+  flat = memoryview(out.reshape(-1))
+  at = 0
+  for i in indexes.tolist():
+    replies[i] = flat[at:at + length]
+    at += length
+
+# Hosts' SYN hooks as rows of port -> hooked masks, shared by every session with
+#  the same hooks: frozenset of hooks -> (row, mask array)
+hookMasks = dict()
+
+class BatchReplier(object):
+
+  # hosts       - the session's hosts, packed address -> Host (see hostTable.py)
+  # answersEcho - function(host): does its handler answer ICMP echo-requests?
+  # arpTemplate - function(host) giving the is-at template for the host's current
+  #               MAC (see replyEngine.arpTemplate)
+  # The arrays are built with the first burst (see build), so a game that never
+  #  sees one never imports NumPy.
+  def __init__(self, hosts, answersEcho, arpTemplate):
+    self.table = hosts
+    self.answersEcho = answersEcho
+    self.arpTemplate = arpTemplate
+    self.addrs = None
+    # Batches still to leave to the per-packet path, and how many were left after
+    #  the last batch that answered too few probes
+    self.skip = 0
+    self.backoff = 0
+
+  def build(self):
+    loadNumpy()
+    hosts = self.table
+    answersEcho = self.answersEcho
+    arpTemplate = self.arpTemplate
+    self.hosts = [hosts[addr] for addr in sorted(hosts)]
+    self.addrs = numpy.array(sorted(hosts), dtype=numpy.int64)
+    # A HostStore's ranges (see hostTable.py) come after the hosts, one row each, as
+    #  every host of a range is answered alike
+    self.ranges = list(getattr(hosts, "ranges", ()))
+    self.reserved = list(getattr(hosts, "reserved", ()))
+    kinds = self.hosts + [hostRange.host(hostRange.net + 1) for hostRange in self.ranges]
+    self.echo = numpy.array([answersEcho(host) for host in kinds], dtype=bool)
+    self.scans = numpy.array([host.synHooks is not None for host in kinds], dtype=bool)
+    # Each range's is-at template, for its first host (see rangeArp)
+    if self.ranges:
+      self.rangeTemplates = numpy.frombuffer(b"".join([arpTemplate(host) for host in kinds[len(self.hosts):]]),
+                                             dtype=numpy.uint8).reshape(len(self.ranges), ARP_TEMPLATE_LEN)
+    # Each host's row in the hook masks, and in the port states (see portStates)
+    self.hookRows = numpy.array([hookRow(host.synHooks) for host in kinds], dtype=numpy.int64)
+    self.indexes = []
+    rows = []
+    for host in kinds:
+      if host.ports not in self.indexes:
+        self.indexes.append(host.ports)
+      rows.append(self.indexes.index(host.ports))
+    self.portRows = numpy.array(rows, dtype=numpy.int64)
+    # The port bitmaps of the hosts' PortIndexes stacked as rows, and the bitmaps
+    #  they were copied from - built with the first scan
+    self.stacked = None
+    self.copied = None
+
+  # Is the next batch worth answering here? Traffic that isn't probes to the hosts
+  #  (ie, macof's flood) costs more stacked than one frame at a time, so after a
+  #  batch answering fewer than GROUP_MIN frames the next one is left to the
+  #  per-packet path, then the next two, and so on up to MAX_BACKOFF
+  def wanted(self):
+    if self.skip:
+      self.skip -= 1
+      return False
+    return True
+
+  # The hosts' port bitmaps as rows of one array, copied again whenever a PortIndex
+  #  has changed since (ie, the knock opened .6:25)
+  def portStates(self):
+    if self.stacked is None:
+      self.stacked = numpy.zeros((len(self.indexes), BITMAP_SIZE), dtype=numpy.uint8)
+      self.copied = [None] * len(self.indexes)
+    copied = self.copied
+    for k, index in enumerate(self.indexes):
+      bits = index.bits
+      if copied[k] is not bits and copied[k] != bits:
+        self.stacked[k] = numpy.frombuffer(bits, dtype=numpy.uint8)
+        copied[k] = bytes(bits) if type(bits) is bytearray else bits
+    return self.stacked
+
+  # The index of the host each packed address is (or of its range, after the
+  #  hosts), and whether it is one at all
+  def lookup(self, dst):
+    addrs = self.addrs
+    hostIndex = numpy.searchsorted(addrs, dst)
+    numpy.minimum(hostIndex, len(addrs) - 1, out=hostIndex)
+    known = addrs[hostIndex] == dst
+    if self.ranges and numpy.count_nonzero(known) != len(known):
+      rest = ~known
+      for addr in self.reserved:
+        rest &= dst != addr
+      for i, hostRange in enumerate(self.ranges):
+        inside = rest & ((dst & hostRange.mask) == hostRange.net)
+        inside &= (dst != hostRange.net) & (dst != hostRange.broadcast)
+        hostIndex[inside] = len(self.hosts) + i
+        known |= inside
+        rest &= ~inside
+    return hostIndex, known
+
+  # Works out the replies to a batch of frames. Returns, for each frame, its reply
+  #  (a memoryview), NO_REPLY if it is answered with nothing, or None if it is left
+  #  to the per-packet path; and how many frames of each kind (FRAME_ARP, FRAME_ICMP,
+  #  or scans) were answered.
+  def replies(self, frames):
+    if self.addrs is None:
+      self.build()
+    replies = [None] * len(frames)
+    counts = {FRAME_ARP: 0, FRAME_ICMP: 0, "scan": 0}
+    lengths = list(map(len, frames))
+    if lengths.count(lengths[0]) == len(lengths):
+      groups = {lengths[0]: range(len(frames))}
+    else:
+      groups = dict()
+      for i, length in enumerate(lengths):
+        groups.setdefault(length, []).append(i)
+    arpCut = len(frames)
+    for length, indexes in groups.items():
+      if length < MIN_LENGTH or len(indexes) < GROUP_MIN:
+        continue
+      data = b"".join([frames[i] for i in indexes])
+      if type(indexes) is range:
+        indexes = numpy.arange(len(indexes))
+      else:
+        indexes = numpy.array(indexes)
+      arpCut = min(arpCut, self.group(replies, counts, indexes, length, data))
+
+    # Who-has frames after the first other ARP frame go to the per-packet path
+    for i in range(arpCut, len(frames)):
+      frame = frames[i]
+      if replies[i] is not None and frame[12] == 0x08 and frame[13] == 0x06:
+        replies[i] = None
+        counts[FRAME_ARP] -= 1
+
+    if counts[FRAME_ARP] + counts[FRAME_ICMP] + counts["scan"] < GROUP_MIN:
+      self.backoff = min(self.backoff * 2 or 1, MAX_BACKOFF)
+      self.skip = self.backoff
+    else:
+      self.backoff = 0
+    return replies, counts
+
+  # Answers the frames (at indexes of the batch) of one length, all in data. Returns
+  #  the index of the first ARP frame among them that isn't a who-has (or the end of
+  #  the batch).
+  def group(self, replies, counts, indexes, length, data):
+    rec = numpy.frombuffer(data, dtype=fieldsFor(length))
+    frames = numpy.frombuffer(data, dtype=numpy.uint8).reshape(len(indexes), length)
+    etherType = rec["etherType"]
+    arpCut = len(replies)
+    isArp = etherType == 0x0806
+    if numpy.count_nonzero(isArp):
+      arpCut = self.arpReplies(replies, counts, indexes, rec, frames, isArp)
+    ipv4 = (etherType == 0x0800) & (rec["verIhl"] == 0x45) & ((rec["frag"] & 0x1fff) == 0)
+    proto = rec["proto"]
+    echo = ipv4 & (proto == 1)
+    if numpy.count_nonzero(echo):
+      self.echoReplies(replies, counts, indexes, rec, frames, length, echo)
+    if length >= SYN_LENGTH:
+      syn = ipv4 & (proto == 6) & (rec["tcpFlags"] == 0x02) & ((rec["offsetByte"] & 0x01) == 0)
+      if numpy.count_nonzero(syn):
+        self.synReplies(replies, counts, indexes, rec, frames, length, syn)
+    return arpCut
+
+  # ARP who-has, answered from the host's is-at template
+  def arpReplies(self, replies, counts, indexes, rec, frames, isArp):
+    arp = isArp & (rec["hwlen"] == 6) & (rec["plen"] == 4)
+    whoHas = arp & (rec["op"] == 1)
+    otherArp = arp & ~whoHas
+    arpCut = int(indexes[numpy.argmax(otherArp)]) if numpy.count_nonzero(otherArp) else len(replies)
+    rows = numpy.nonzero(whoHas)[0]
+    hostIndex, known = self.lookup(rec["pdst"][rows].astype(numpy.int64))
+    rows, hostIndex = rows[known], hostIndex[known]
+    if not len(rows):
+      return arpCut
+    inRange = hostIndex >= len(self.hosts)
+    if numpy.count_nonzero(inRange):
+      out = self.rangeArp(hostIndex, rec["pdst"][rows], inRange)
+    else:
+      out = self.hostArp(hostIndex)
+    hwsrc = frames[rows, 22:28]
+    out[:, 0:6] = hwsrc
+    out[:, 32:38] = hwsrc
+    spread(replies, indexes[rows], out)
+    counts[FRAME_ARP] += len(rows)
+    return arpCut
+
+  # The is-at templates of the hosts at hostIndex, one row each
+  def hostArp(self, hostIndex):
+    used, which = numpy.unique(hostIndex, return_inverse=True)
+    templates = numpy.frombuffer(b"".join([self.arpTemplate(self.hosts[h]) for h in used.tolist()]),
+                                 dtype=numpy.uint8).reshape(len(used), ARP_TEMPLATE_LEN)
+    return templates[which]
+
+  # As hostArp, with some of the hosts in ranges (inRange): those are patched into
+  #  their range's template with their own address and MAC, without making a Host
+  def rangeArp(self, hostIndex, pdst, inRange):
+    out = numpy.empty((len(hostIndex), ARP_TEMPLATE_LEN), dtype=numpy.uint8)
+    declared = ~inRange
+    if numpy.count_nonzero(declared):
+      out[declared] = self.hostArp(hostIndex[declared])
+    ranged = self.rangeTemplates[hostIndex[inRange] - len(self.hosts)]
+    addr = pdst[inRange].astype(">u4").view(numpy.uint8).reshape(-1, 4)
+    ranged[:, 9:12] = addr[:, 1:]     # ethernet source
+    ranged[:, 25:28] = addr[:, 1:]    # ARP hwsrc
+    ranged[:, 28:32] = addr           # ARP psrc
+    out[inRange] = ranged
+    return out
+
+  # ICMP echo-requests to the hosts that answer them
+  def echoReplies(self, replies, counts, indexes, rec, frames, length, echo):
+    rows = numpy.nonzero(echo & (rec["icmpType"] == 8))[0]
+    hostIndex, known = self.lookup(rec["dst"][rows].astype(numpy.int64))
+    rows = rows[known & self.echo[hostIndex]]
+    if not len(rows):
+      return
+    out = swappedRows(frames, rows, False)
+    oldTypeWord = rec["typeWord"][rows].astype(numpy.int64)
+    typeWord = oldTypeWord & 0x00ff
+    outRec = numpy.frombuffer(out, dtype=fieldsFor(length))
+    outRec["typeWord"] = typeWord
+    outRec["icmpChksum"] = checksumAdjust(rec["icmpChksum"][rows].astype(numpy.int64),
+                                          oldTypeWord, typeWord)
+    spread(replies, indexes[rows], out)
+    counts[FRAME_ICMP] += len(rows)
+
+  # Bare SYNs to ports the hosts' handlers don't hook, answered from the port index
+  def synReplies(self, replies, counts, indexes, rec, frames, length, syn):
+    rows = numpy.nonzero(syn)[0]
+    hostIndex, known = self.lookup(rec["dst"][rows].astype(numpy.int64))
+    dport = rec["dport"][rows].astype(numpy.int64)
+    scanned = known & self.scans[hostIndex] & ~hookMaskArray[self.hookRows[hostIndex], dport]
+    rows, hostIndex, dport = rows[scanned], hostIndex[scanned], dport[scanned]
+    if not len(rows):
+      return
+    counts["scan"] += len(rows)
+    state = (self.portStates()[self.portRows[hostIndex], dport >> 2] >> ((dport & 3) * 2)) & 3
+    replying = state != PORT_FILTERED
+    if numpy.count_nonzero(replying) != len(rows):
+      for i in indexes[rows[~replying]].tolist():
+        replies[i] = NO_REPLY
+      rows, state = rows[replying], state[replying]
+      if not len(rows):
+        return
+
+    out = swappedRows(frames, rows, True)
+    oldSeq = rec["seq"][rows].astype(numpy.int64)
+    oldAck = rec["ack"][rows].astype(numpy.int64)
+    oldFlagsWord = rec["flagsWord"][rows].astype(numpy.int64)
+    # Open: SYN-ACK (tcpSA), closed: RST-ACK (tcpRA)
+    isOpen = (state == PORT_OPEN).astype(numpy.int64)
+    seq = isOpen * 0x1000
+    ack = (oldSeq + isOpen) & 0xffffffff
+    flagsWord = (oldFlagsWord & 0xfe00) | (0x014 - isOpen * 2)
+    outRec = numpy.frombuffer(out, dtype=fieldsFor(length))
+    outRec["seq"] = seq
+    outRec["ack"] = ack
+    outRec["flagsWord"] = flagsWord
+    outRec["tcpChksum"] = checksumAdjust(rec["tcpChksum"][rows].astype(numpy.int64),
+                                         oldSeq + oldAck + oldFlagsWord, seq + ack + flagsWord)
+    spread(replies, indexes[rows], out)
+
+# Row of the shared hook masks for a host's SYN hooks (row 0, hooking nothing, for
+#  hosts whose handlers see every SYN, as those are never scanned here)
+def hookRow(synHooks):
+  global hookMaskArray
+  key = frozenset(synHooks or ())
+  entry = hookMasks.get(key)
+  if entry is None:
+    mask = numpy.zeros(65536, dtype=bool)
+    mask[list(key)] = True
+    row = len(hookMasks)
+    hookMasks[key] = entry = (row, mask)
+    hookMaskArray = numpy.stack([m for r, m in sorted(hookMasks.values(), key=lambda e: e[0])])
+  return entry[0]
+
+hookMaskArray = None
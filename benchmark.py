@@ -0,0 +1,2085 @@
+#! usr/bin/python
+
+#
+#  Benchmarks for scapyHunt.py
+#
+#  Usage:
+#   python benchmark.py classify [capture.pcap]
+#     Frames/sec of full scapy dissection vs. the raw-bytes classifier in fastPath.py,
+#     over a recorded capture or a generated macof + nmap stream.
+#   python benchmark.py replies [count]
+#     Checks that replyEngine.py produces byte-for-byte the replies the scapy reply
+#     builders did for random probes, then compares replies/sec of both.
+#   python benchmark.py sessions [count]
+#     Memory per idle game session, for count sessions served by one AsyncioRuntime
+#     (each on a socketpair standing in for its tap device).
+#   python benchmark.py shards [maxWorkers] [playersPerWorker]
+#     Load test of --workers mode: aggregate frames/sec for 1..maxWorkers worker
+#     processes, with a closed-loop load generator process per player. Needs about
+#     twice as many cores as workers to show scaling.
+#   python benchmark.py cam [count]
+#     Random-source-MAC flood (macof) of a session's CAM table: learns/sec, memory as
+#     the flood goes on, and when the switch enters and leaves hub mode.
+#   python benchmark.py flows [count]
+#     SYN flood of the FTP server from count random source ports while one client
+#     logs in: handshakes/sec, flow table size and memory, and that the client's
+#     connection kept its login.
+#   python benchmark.py lines [clients]
+#     FTP logins from many concurrent clients with their commands split over tiny
+#     segments, interleaved: checks every client gets every reply, and reports
+#     segments/sec; then checks pipelined, retransmitted and unterminated commands.
+#   python benchmark.py retr [MB]
+#     RETR of a file of MB random bytes from a --scenario directory: MB/s through the
+#     engine with a client acking every batch of segments, without loss and losing 1%
+#     of them, then (as root, with /dev/net/tun) over tap0 to a kernel TCP client,
+#     with the game on an event loop and on threads, without loss and over a link
+#     losing 1% (so retransmit timers fire while acks arrive). Checks the file
+#     arrives intact each time.
+#   python benchmark.py shed [pps]
+#     --admission under floods, on a simulated clock: frames/sec through the engine
+#     and replies to a ping sweep during a macof flood of pps frames/sec, with and
+#     without admission (and that the CAM table still overflows); replies and sheds
+#     for the player's own SYN scans, slow and fast; and that the walkthrough at a
+#     player's pace loses nothing.
+#   python benchmark.py scan [ports]
+#     nmap -sS -p- of every host: checks the scan fast path answers every SYN exactly
+#     as the handlers do, then compares probes/sec of both.
+#   python benchmark.py batch [rounds]
+#     The batch path (batchReplies.py) against the per-packet path, over the replay
+#     streams and random probes fed in batches of 64 (as memoryviews into reused
+#     buffers, like TapReader's): checks the replies, frame counts and CAM table come
+#     out the same, then compares frames/sec of both (best of rounds).
+#   python benchmark.py replay [scenario|capture.pcap ...]
+#     Replays streams through the whole engine on a stand-in tap (a socketpair), no
+#     root or tun device needed. Scenarios: sweep, synscan, macof, knock, walkthrough
+#     (all of them by default). For each, reports:
+#       engine   - frames/sec through processBatch alone
+#       e2e      - frames/sec through the tap, reader, writer and an event loop
+#       p50/p99  - reply latency seen from the player's end of the tap
+#       alloc    - peak bytes allocated while handling a frame, and blocks still
+#                  allocated afterwards, per frame
+#   python benchmark.py topology [cidr]
+#     --hosts of a CIDR block (10.5.0.0/16 by default): checks ARP, ping and SYN scan
+#     replies from the range's hosts are the same on the batch and per-packet paths
+#     as from their handler, then sweeps the whole block with ARP who-has (as nmap
+#     -sn does) and ICMP echo-requests: frames/sec, and the memory it takes.
+#   python benchmark.py metrics [rounds]
+#     Cost of --stats: frames/sec of the replay streams with metrics off and on, each
+#     replay off followed by one on (medians over rounds of 50000 frames), and the
+#     time taken to write the stats file.
+#   python benchmark.py profile [rounds]
+#     Cost of the SIGUSR2 profiler (see scapyHunt.installProfiler): frames/sec of the
+#     replay streams (each replayed for 50000 frames) with it installed but off, and
+#     while it samples (best of rounds); checks the collapsed stacks written have
+#     samples inside the handlers, and reports the samples taken per CPU second.
+#     Then checks an idle game's profile is still written once its duration is up.
+#   python benchmark.py record
+#     Cost of --record: frames/sec of the replay streams with every frame in and out
+#     copied to a recorder, checks the pcap files written hold every frame, then
+#     fills a ring no flusher is emptying to show frames get dropped, not waited on.
+#   python benchmark.py traffic [pps] [generators]
+#     Checks frames from trafficGen.py's templates are byte-for-byte the ones scapy
+#     builds, compares frames/sec of both, then runs pps frames/sec of gateway noise
+#     split over the given number of generators on one scheduler (for 10 simulated
+#     seconds) and reports the CPU it takes. Then checks that noise from the timing
+#     wheel of a ThreadRuntime, in its own thread, and a macof flood through the tap
+#     can share a session (its CAM table) without errors.
+#   python benchmark.py links [frames]
+#     Frames through a timing wheel on a simulated clock, each delayed by up to 2s: CPU
+#     time per frame as more are waiting at once (against a heap), checking none is
+#     released early or more than a tick late. Then pings through a 10.1.8.0/24 link
+#     of 40ms, 10ms jitter and 5% loss: checks the delays and loss the player sees, and
+#     that hosts off the link still answer at once; then (as root, with /dev/net/tun)
+#     times a kernel client's connects through the link on tap0.
+#   python benchmark.py startup [rounds]
+#     Cold start of the game (needs root and /dev/net/tun): time to import scapyHunt.py
+#     in a fresh interpreter, and from starting scapyHunt.py to the first ARP reply
+#     on tap0 (the tap must not exist yet). Checks --players 2 and --workers 2 are
+#     refused without --netns, and that with it both players' taps answer.
+#   python benchmark.py queues [maxQueues] [seconds]
+#     --queues mode: checks the game state shared by the queues' partitions (the
+#     knock, an ARP spoof and hub mode, each seen on one queue, hold on every
+#     queue, and hub mode lasts while any partition is overflowed), and that the
+#     knock is solved when two queues' workers handle its knocks at once, out of
+#     round-robin order (a race needs two cores to show), then (as root,
+#     with /dev/net/tun) runs the game on tap0 with 1 to maxQueues queues, solves the
+#     knock over them and floods it with SYNs from many flows for the given seconds:
+#     replies/sec, and CPU seconds per worker. Needs as many cores as queues to show
+#     scaling.
+#   python benchmark.py pool [players] [size]
+#     Runs the game in --pool mode with size games ready (needs root, /dev/net/tun and
+#     ip netns): time for a player to be handed a game, and to its first ARP reply,
+#     for players joining one at a time and then all at once, and checks the games
+#     go away when the players disconnect.
+#
+
+# Surpress scapy warnings
+import logging
+logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
+
+from scapy.all import Ether, ARP, IP, ICMP, TCP, Raw, Padding, RandMAC, RandIP
+from random import randint, random
+import time
+import sys
+import socket
+import struct
+import tracemalloc
+import signal
+import select
+import collections
+import os
+
+from fastPath import *
+from hostTable import ipToInt
+import replyEngine
+from pcapFile import readPcap
+from tapReader import TapReader
+from tapWriter import TapWriter
+
+# Addresses answered by the game (see the bottom of scapyHunt.py)
+hostIPs = set(['10.5.0.4', '10.5.0.6', '10.5.0.35', '10.1.8.2', '10.1.8.6', '10.1.8.22'])
+hostAddrs = set(ipToInt(ip) for ip in hostIPs)
+playerMAC = '12:67:7e:b7:6d:c8'
+
+
+# Stream Generators
+# -----
+# macofFrames - random MAC/IP TCP frames, as sent by 'macof -I tap0'
+# sweepFrames - an ARP/ICMP ping sweep of 10.5.0.0/24 (nmap -sn)
+# synScanFrames - a SYN scan of the live hosts (nmap -sS)
+# nmapFrames - a ping sweep followed by a SYN scan
+# knockFrames - the port-knock sequence on .6
+# walkthroughFrames - every step of Solution.txt, from the sweep to retrieving the payload
+
+def macofFrames(count):
+  frames = []
+  for i in range(count):
+    frames.append((Ether(src=RandMAC(), dst=RandMAC())/
+                   IP(src=RandIP(), dst=RandIP())/
+                   TCP(sport=randint(1,65535), dport=randint(1,65535), flags=0x002)).build())
+  return frames
+
+def sweepFrames():
+  frames = []
+  for o4 in range(1, 255):
+    dst = '10.5.0.%d' % o4
+    frames.append((Ether(src=playerMAC, dst='ff:ff:ff:ff:ff:ff')/
+                   ARP(op=1, hwsrc=playerMAC, psrc='10.5.0.1', pdst=dst)).build())
+    frames.append((Ether(src=playerMAC)/IP(src='10.5.0.1', dst=dst)/ICMP()).build())
+  return frames
+
+def synScanFrames(ports, hosts=None):
+  frames = []
+  for dst in sorted(hosts or hostIPs):
+    for port in range(1, ports + 1):
+      frames.append((Ether(src=playerMAC)/IP(src='10.5.0.1', dst=dst)/
+                     TCP(sport=40000, dport=port, flags=0x002)).build())
+  return frames
+
+def nmapFrames(ports):
+  return sweepFrames() + synScanFrames(ports)
+
+def knockFrames():
+  return [(Ether(src=playerMAC)/IP(src='10.5.0.1', dst='10.5.0.6')/
+           TCP(sport=41000 + i, dport=port, flags=0x002)).build()
+          for i, port in enumerate([951,951,4826,443,100,21])]
+
+# A whole TCP connection from src: handshake, one PSH-ACK per line, then FIN-ACK
+def tcpConnection(src, mac, dst, sport, dport, lines):
+  ip = IP(src=src, dst=dst)
+  seq = 1000
+  frames = [(Ether(src=mac)/ip/TCP(sport=sport, dport=dport, flags='S', seq=seq)).build()]
+  seq += 1
+  frames.append((Ether(src=mac)/ip/TCP(sport=sport, dport=dport, flags='A', seq=seq, ack=0x1001)).build())
+  for line in lines:
+    frames.append((Ether(src=mac)/ip/TCP(sport=sport, dport=dport, flags='PA', seq=seq, ack=0x1001)/line).build())
+    seq += len(line)
+  frames.append((Ether(src=mac)/ip/TCP(sport=sport, dport=dport, flags='FA', seq=seq, ack=0x1001)).build())
+  return frames
+
+def walkthroughFrames():
+  frames = sweepFrames()                                    # 1) find the clients
+  frames += macofFrames(1100)                               # 2) overflow the CAM table
+  frames += knockFrames()                                   # 3-4) replay the knock
+  frames += synScanFrames(1024, ['10.5.0.6'])               # 5) find the new service
+  frames += tcpConnection('10.5.0.1', playerMAC, '10.5.0.6', 42000, 25,
+                          [b'EHLO\r\n'])                     # 6-7) ask the SMTP server
+  frames.append((Ether(src=playerMAC, dst='ff:ff:ff:ff:ff:ff')/
+                 ARP(op=2, hwsrc=playerMAC, psrc='10.5.0.6', pdst='10.5.0.1')).build())  # 8) ARP spoof .6
+  frames += tcpConnection('10.5.0.6', playerMAC, '10.1.8.6', 42001, 21,
+                          [b'USER admin\r\n', b'PASS admin\r\n', b'LIST\r\n',
+                           b'RETR topSecret.txt\r\n'])        # 9) retrieve the payload
+  return frames
+
+# Loads a recorded capture if given, else generates a macof + nmap stream
+def loadFrames(args):
+  if args:
+    return list(readPcap(args[0]))
+  return macofFrames(20000) + nmapFrames(1000)
+
+
+# Benchmarks
+# -----
+
+# Times fn over every frame, returns frames/sec
+def timeFrames(fn, frames):
+  start = time.time()
+  for frame in frames:
+    fn(frame)
+  return len(frames) / (time.time() - start)
+
+# The dispatch decision processPacket used to make from a full scapy dissection
+def scapyDispatch(data):
+  pkt = Ether(data)
+  if pkt.haslayer(ARP):
+    return ipToInt(pkt[ARP].pdst) in hostAddrs
+  elif pkt.haslayer(ICMP) and pkt[ICMP].type == 8:
+    return ipToInt(pkt[IP].dst) in hostAddrs
+  elif pkt.haslayer(TCP):
+    return ipToInt(pkt[IP].dst) in hostAddrs
+  return False
+
+# The same decision from the raw-bytes classifier (which the handlers work from
+#  as well, without dissecting the frame)
+def fastDispatch(data):
+  frame = parseFrame(data)
+  kind = frame.kind
+  if kind == FRAME_ARP:
+    dst = frame.arpPdst
+  elif kind == FRAME_ICMP and frame.icmpType == 8:
+    dst = frame.ipDst
+  elif kind == FRAME_TCP:
+    dst = frame.ipDst
+  else:
+    return False
+  return dst in hostAddrs
+
+def benchClassify(args):
+  frames = loadFrames(args)
+  for frame in frames:
+    if scapyDispatch(frame) != fastDispatch(frame):
+      print("Classifier mismatch on frame: %r" % Ether(frame).summary())
+      return 1
+  before = timeFrames(scapyDispatch, frames)
+  after = timeFrames(fastDispatch, frames)
+  print("%d frames" % len(frames))
+  print("scapy dissection: %10.0f frames/sec" % before)
+  print("fastPath:         %10.0f frames/sec (%.1fx)" % (after, after / before))
+  return 0
+
+
+# Scapy Reply Builders
+# -----
+# The reply builders scapyHunt.py used before replyEngine.py, kept as the reference
+#  the byte-level replies are checked against.
+
+def swapSrcAndDst(pkt,layer):
+  pkt[layer].src, pkt[layer].dst = pkt[layer].dst, pkt[layer].src
+
+def scapyArpIsAt(pkt, fake_src_mac):
+  ether = Ether(dst=pkt.hwsrc, src=fake_src_mac)
+  arp = ARP(op="is-at", psrc=pkt.pdst, pdst="10.5.0.1", hwsrc=fake_src_mac, hwdst=pkt.hwsrc)
+  return ether/arp
+
+def scapyIcmpEchoReply(pkt):
+  rpkt = pkt.copy()
+  swapSrcAndDst(rpkt, Ether)
+  swapSrcAndDst(rpkt, IP)
+  rpkt[ICMP].type = 'echo-reply'
+  rpkt[ICMP].chksum = None
+  rpkt[IP].chksum = None
+  return rpkt
+
+def scapyTcpReply(pkt, flags, seq, ack):
+  rpkt = pkt.copy()
+  swapSrcAndDst(rpkt,Ether)
+  swapSrcAndDst(rpkt,IP)
+  rpkt[TCP].flags = flags
+  rpkt[TCP].seq = seq
+  rpkt[TCP].ack = ack
+  rpkt[IP].chksum = None
+  rpkt[TCP].chksum = None
+  rpkt[TCP].sport, rpkt[TCP].dport = rpkt[TCP].dport, rpkt[TCP].sport
+  return rpkt
+
+def scapyTcpA(pkt):
+  if pkt.haslayer(Raw):
+    return scapyTcpReply(pkt, 'A', pkt[TCP].ack, pkt[TCP].seq + len(pkt[Raw].load))
+  return scapyTcpReply(pkt, 'A', pkt[TCP].ack, pkt[TCP].seq + 1)
+
+# (name, scapy builder, replyEngine builder) for each TCP reply in scapyHunt.py
+tcpReplies = [
+  ('tcpSA', lambda p: scapyTcpReply(p, 'SA', 0x1000, p[TCP].seq + 1),
+            lambda f: replyEngine.tcpReply(f, 0x012, 0x1000, f.seq + 1)),
+  ('tcpRA', lambda p: scapyTcpReply(p, 'RA', 0, p[TCP].seq),
+            lambda f: replyEngine.tcpReply(f, 0x014, 0, f.seq)),
+  ('tcpFA', lambda p: scapyTcpReply(p, 'FA', p[TCP].ack, p[TCP].seq + 1),
+            lambda f: replyEngine.tcpReply(f, 0x011, f.ack, f.seq + 1)),
+  ('tcpA',  scapyTcpA,
+            lambda f: replyEngine.tcpReply(f, 0x010, f.ack,
+                                           f.seq + (f.payloadLen or 1))),
+]
+
+# Random probes: TCP with/without options, payload and Ethernet padding,
+#  ICMP echo-requests with payloads, and ARP who-has
+def randomProbes(count):
+  probes = []
+  for i in range(count):
+    ether = Ether(src=RandMAC(), dst=RandMAC())
+    ip = IP(src=RandIP(), dst=RandIP(), ttl=randint(1,255), id=randint(0,65535),
+            flags=randint(0,2), tos=randint(0,255))
+    tcp = TCP(sport=randint(1,65535), dport=randint(1,65535), flags=randint(0,0x1ff),
+              seq=randint(0,0xfffffffe), ack=randint(0,0xfffffffe), window=randint(0,65535))
+    if randint(0,1):
+      tcp.options = [('MSS', 1460), ('SAckOK', b''), ('WScale', 7)]
+    pkt = ether/ip/tcp
+    if randint(0,1):
+      pkt = pkt/Raw(b'x' * randint(1,100))
+    if randint(0,1):
+      pkt = pkt/Padding(b'\x00' * randint(1,20))
+    probes.append(('tcp', pkt.build()))
+    probes.append(('icmp', (ether/ip/ICMP(id=randint(0,65535), seq=randint(0,65535))/
+                            Raw(b'p' * randint(0,64))).build()))
+    probes.append(('arp', (Ether(src=RandMAC(), dst='ff:ff:ff:ff:ff:ff')/
+                           ARP(op=1, hwsrc=RandMAC(), psrc=RandIP(), pdst=RandIP())).build()))
+  return probes
+
+def benchReplies(args):
+  count = int(args[0]) if args else 2000
+  probes = randomProbes(count)
+  fakeMAC = '12:67:7e:b7:6d:04'
+  mismatches = 0
+  for kind, data in probes:
+    frame = parseFrame(data)
+    pkt = Ether(data)
+    if kind == 'tcp':
+      pairs = [(name, scapyFn(pkt), engineFn(frame)) for name, scapyFn, engineFn in tcpReplies]
+    elif kind == 'icmp':
+      pairs = [('icmpEchoReply', scapyIcmpEchoReply(pkt), replyEngine.icmpEchoReply(frame))]
+    else:
+      template = replyEngine.arpTemplate(fakeMAC, frame.arpPdst)
+      pairs = [('arpIsAt', scapyArpIsAt(pkt, fakeMAC), replyEngine.arpReply(template, frame))]
+    for name, expected, actual in pairs:
+      if expected.build() != bytes(actual):
+        mismatches += 1
+        print("%s mismatch for %s" % (name, pkt.summary()))
+  print("%d probes checked, %d mismatches" % (len(probes), mismatches))
+  if mismatches:
+    return 1
+
+  tcpFrames = [data for kind, data in probes if kind == 'tcp']
+  before = timeFrames(lambda data: scapyTcpReply(Ether(data), 'RA', 0, 0).build(), tcpFrames)
+  after = timeFrames(lambda data: replyEngine.tcpReply(parseFrame(data), 0x014, 0, 0), tcpFrames)
+  print("tcpRA, scapy:       %10.0f replies/sec" % before)
+  print("tcpRA, replyEngine: %10.0f replies/sec (%.1fx)" % (after, after / before))
+  return 0
+
+
+# Sessions
+# -----
+
+def benchSessions(args):
+  import scapyHunt
+  count = int(args[0]) if args else 200
+  runtime = scapyHunt.AsyncioRuntime(scapyHunt.processBatch)
+  taps = []
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  for i in range(count):
+    tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    taps.append((tap, player))
+    runtime.addSession(scapyHunt.newSession("tap%d" % i, tap.fileno()))
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  print("%d sessions: %.1f KiB total, %.0f bytes per idle session" %
+        (count, (after - before) / 1024.0, (after - before) / float(count)))
+  print("shared read buffer pool: %.1f KiB" % (sum(b.nbytes for b in runtime.buffers) / 1024.0))
+  return 0
+
+
+# Sends windows of frames at a player's tap and waits for every reply, rounds times
+def loadGenerator(player, frames, rounds):
+  for r in range(rounds):
+    for frame in frames:
+      player.send(frame)
+    for frame in frames:
+      player.recv(2048)
+
+def benchShards(args):
+  import scapyHunt
+  from supervisor import Supervisor
+  maxWorkers = int(args[0]) if args else max(1, (os.cpu_count() or 2) // 2)
+  perWorker = int(args[1]) if len(args) > 1 else 1
+  rounds = 200
+  # SYNs to closed ports, each answered with a RST-ACK
+  frames = [(Ether(src=playerMAC, dst='12:67:7e:b7:6d:04')/IP(src='10.5.0.1', dst='10.5.0.4')/
+             TCP(sport=40000, dport=port, flags=0x002)).build() for port in range(1000, 1064)]
+
+  base = None
+  for workers in range(1, maxWorkers + 1):
+    supervisor = Supervisor(workers, scapyHunt.serveWorker)
+    supervisor.start()
+    taps = []
+    for i in range(workers * perWorker):
+      tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+      taps.append((tap, player))
+      supervisor.addPlayer("tap%d" % i, tap.fileno())
+
+    start = time.time()
+    pids = []
+    for tap, player in taps:
+      pid = os.fork()
+      if pid == 0:
+        try:
+          loadGenerator(player, frames, rounds)
+        finally:
+          os._exit(0)
+      pids.append(pid)
+    for pid in pids:
+      os.waitpid(pid, 0)
+    rate = len(taps) * rounds * len(frames) / (time.time() - start)
+
+    supervisor.stop()
+    for tap, player in taps:
+      tap.close()
+      player.close()
+    if base is None:
+      base = rate
+    print("%2d workers, %3d players: %10.0f frames/sec (%.2fx)" % (workers, len(taps), rate, rate / base))
+  return 0
+
+
+# CAM Table
+# -----
+
+def benchCam(args):
+  import scapyHunt
+  from camTable import CamTable
+  count = int(args[0]) if args else 200000
+  macs = [os.urandom(6) for i in range(count)]
+
+  # The table by itself, with a clock that never moves
+  cam = CamTable(1024, 300.0, clock=lambda: 0.0)
+  start = time.time()
+  for mac in macs:
+    cam.learn(mac)
+  elapsed = time.time() - start
+  print("CamTable.learn:  %10.0f MACs/sec (%d learned, %d refused)" %
+        (count / elapsed, len(cam), cam.overflows))
+
+  # A whole session under a macof flood; memory has to stop growing once the table is full
+  now = [0.0]
+  tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+  runtime = scapyHunt.AsyncioRuntime(scapyHunt.processBatch)
+  session = scapyHunt.newSession("tap0", tap.fileno())
+  runtime.addSession(session)
+  session.macTable.clock = lambda: now[0]
+  frame = bytearray(macofFrames(1)[0])
+  tracemalloc.start()
+  base = tracemalloc.get_traced_memory()[0]
+  start = time.time()
+  step = max(1, count // 8)
+  for i in range(count):
+    frame[6:12] = macs[i]
+    scapyHunt.processPacket(session, frame)
+    if (i + 1) % step == 0:
+      print("  %8d frames: %4d entries, hub mode %-5s %8.1f KiB" %
+            (i + 1, len(session.macTable), session.hubMode,
+             (tracemalloc.get_traced_memory()[0] - base) / 1024.0))
+  elapsed = time.time() - start
+  tracemalloc.stop()
+  print("processPacket:   %10.0f frames/sec" % (count / elapsed))
+
+  # Once the flood stops, the entries age out and the switch stops flooding
+  now[0] += session.macTable.aging + 1
+  session.macTable.expire()
+  print("after aging:     %d entries, overflowed %s" % (len(session.macTable), session.macTable.overflowed))
+  runtime.loop.close()
+  tap.close()
+  player.close()
+  return 0
+
+
+# Connection Table
+# -----
+
+def benchFlows(args):
+  import scapyHunt
+  count = int(args[0]) if args else 100000
+  tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+  session = scapyHunt.newSession("tap0", tap.fileno())
+  session.writer = TapWriter(tap.fileno())
+  session.writer.write = lambda frame: True
+  gwMAC = session.clients['10.5.0.6']
+  def ftp(sport, flags, seq, load=None):
+    pkt = Ether(src=gwMAC)/IP(src='10.5.0.6', dst='10.1.8.6')/TCP(sport=sport, dport=21, flags=flags, seq=seq, ack=0x1001)
+    if load is not None:
+      pkt = pkt/load
+    return pkt.build()
+
+  # One client logs in, then a flood of half-open connections pushes through the table
+  for frame in [ftp(40000, 'S', 0), ftp(40000, 'A', 1), ftp(40000, 'PA', 1, b'USER admin\r\n'),
+                ftp(40000, 'PA', 13, b'PASS admin\r\n')]:
+    scapyHunt.processPacket(session, frame)
+  client = session.flows.lookup(parseFrame(ftp(40000, 'A', 25)))
+
+  syn = bytearray(ftp(0, 'S', 0))
+  tracemalloc.start()
+  base = tracemalloc.get_traced_memory()[0]
+  start = time.time()
+  for i in range(count):
+    sport = 1024 + i % 30000
+    syn[34:36] = sport.to_bytes(2, 'big')
+    scapyHunt.processPacket(session, syn)
+    if i % 64 == 0:
+      session.flows.lookup(parseFrame(ftp(40000, 'A', 25)))  # the client stays active
+  elapsed = time.time() - start
+  grown = tracemalloc.get_traced_memory()[0] - base
+  tracemalloc.stop()
+  flows = session.flows
+  print("%d SYNs: %.0f handshakes/sec (traced)" % (count, count / elapsed))
+  print("flow table: %d of %d flows, %d evicted, %.1f KiB" %
+        (len(flows), flows.capacity, flows.evictions, grown / 1024.0))
+  print("client still logged in: %s" % (flows.flows.get(client.key) is client and client.passEntered))
+  tap.close()
+  player.close()
+  return 0
+
+
+# Service Streams
+# -----
+
+def benchLines(args):
+  import scapyHunt
+  import asyncio
+  clients = int(args[0]) if args else 200
+  session, handles = replaySession(scapyHunt)
+  session.flows.capacity = max(session.flows.capacity, clients)
+  # Replies stay queued for payloads() while the loop runs the daemons
+  session.writer.drain = lambda: None
+  queue = session.writer.queue
+  gwMAC = session.clients['10.5.0.6']
+  commands = b'USER admin\r\nPASS admin\r\nLIST\r\nRETR topSecret.txt\r\n'
+  replies = [b'220-', b'331-', b'230-', b'250-', b'150-', b'FTP Data']
+
+  def ftp(sport, flags, seq, load=b''):
+    return (Ether(src=gwMAC)/IP(src='10.5.0.6', dst='10.1.8.6')/
+            TCP(sport=sport, dport=21, flags=flags, seq=seq, ack=0x1001)/load).build()
+
+  # The replies' payloads to each client port (queued since the last call)
+  def payloads(got=None):
+    if got is None:
+      got = collections.defaultdict(list)
+    for reply in queue:
+      frame = parseFrame(reply)
+      if frame.payloadLen:
+        got[frame.dport].append(bytes(frame.payload))
+    queue.clear()
+    return got
+
+  # Every client connects, then sends its commands 1-3 bytes at a time, the
+  #  clients' segments interleaved
+  for i in range(clients):
+    scapyHunt.processPacket(session, ftp(20000 + i, 'S', 0))
+    scapyHunt.processPacket(session, ftp(20000 + i, 'A', 1))
+  segments = []
+  for i in range(clients):
+    offset = 0
+    own = []
+    while offset < len(commands):
+      size = randint(1, 3)
+      own.append(ftp(20000 + i, 'PA', 1 + offset, commands[offset:offset + size]))
+      offset += size
+    segments.append(own)
+  stream = [own[n] for n in range(max(len(own) for own in segments))
+            for own in segments if n < len(own)]
+  greetings = payloads()
+  got = collections.defaultdict(list)
+  elapsed = 0
+  for i in range(0, len(stream), 64):
+    start = time.time()
+    scapyHunt.processBatch(session, stream[i:i + 64])
+    elapsed += time.time() - start
+    payloads(got)
+  complete = sum(1 for i in range(clients)
+                 if [load[:len(prefix)] for load, prefix in
+                     zip(greetings[20000 + i] + got[20000 + i], replies)] == replies)
+  print("%d clients, %d segments of 1-3 bytes: %.0f segments/sec, %d of %d clients got every reply" %
+        (clients, len(stream), len(stream) / elapsed, complete, clients))
+
+  # One segment with every command, then the same segment again
+  scapyHunt.processPacket(session, ftp(40000, 'S', 0))
+  scapyHunt.processPacket(session, ftp(40000, 'A', 1))
+  payloads()
+  scapyHunt.processPacket(session, ftp(40000, 'PA', 1, commands))
+  pipelined = len(payloads()[40000])
+  scapyHunt.processPacket(session, ftp(40000, 'PA', 1, commands))
+  resent = len(queue), len(payloads()[40000])
+  print("pipelined: %d replies to 4 commands in one segment; resent: %d ACK, %d replies" %
+        (pipelined, resent[0], resent[1]))
+
+  # A command crafted without a line ending
+  scapyHunt.processPacket(session, ftp(40001, 'S', 0))
+  scapyHunt.processPacket(session, ftp(40001, 'A', 1))
+  payloads()
+  scapyHunt.processPacket(session, ftp(40001, 'PA', 1, b'USER admin'))
+  before = len(payloads()[40001])
+  asyncio.get_event_loop().run_until_complete(asyncio.sleep(scapyHunt.COMMAND_TIMEOUT * 2))
+  print("unterminated: %d replies at once, %s after %.1fs" %
+        (before, [load for load in payloads()[40001]], scapyHunt.COMMAND_TIMEOUT))
+  closeReplaySession(handles)
+  return complete != clients and 1 or 0
+
+
+# File Transfers
+# -----
+
+# scapyHunt.py's options for each RETR over tap0: on an event loop, and on the
+#  default threads, each with and without 1% loss from the FTP server
+RETR_LIVE_OPTIONS = [["--asyncio"], [],
+                     ["--asyncio", "--link", "10.1.8.0/24=0:0:1"], ["--link", "10.1.8.0/24=0:0:1"]]
+
+# A scenario directory holding one file of random bytes, as (directory, its contents)
+def retrScenario(size):
+  import tempfile
+  directory = tempfile.mkdtemp(prefix="scapyhunt-retr-")
+  data = os.urandom(size)
+  with open(os.path.join(directory, "loot.bin"), "wb") as f:
+    f.write(data)
+  return directory, data
+
+# RETR of the scenario file through the engine alone, the client acking every batch
+#  of segments and losing each with the given probability. Returns (MB/s, retrieved
+#  intact, sender).
+def retrOffline(scapyHunt, data, loss):
+  import asyncio
+  session, handles = replaySession(scapyHunt)
+  session.writer.drain = lambda: None
+  writer = session.writer
+  gwMAC = session.clients['10.5.0.6']
+  sport = 40000
+
+  def ftp(flags, seq, ack, load=b'', options=[]):
+    return bytearray((Ether(src=gwMAC)/IP(src='10.5.0.6', dst='10.1.8.6')/
+                      TCP(sport=sport, dport=21, flags=flags, seq=seq, ack=ack, window=65535,
+                          options=options)/load).build())
+
+  scapyHunt.processPacket(session, ftp('S', 0, 0, options=[('MSS', 1460), ('WScale', 7)]))
+  scapyHunt.processPacket(session, ftp('A', 1, 0x1001))
+  seq = 1
+  for line in [b'USER admin\r\n', b'PASS admin\r\n']:
+    scapyHunt.processPacket(session, ftp('PA', seq, 0x1001, line))
+    seq += len(line)
+  received = bytearray()
+  expected = None
+  for reply in writer.queue:
+    frame = parseFrame(reply)
+    if frame.payloadLen:
+      expected = (frame.seq + frame.payloadLen) & 0xffffffff
+  writer.queue.clear()
+
+  # Every ACK is the same frame with its ack patched in. Like a kernel receiver, the
+  #  client acks every second segment, holds segments arriving after a hole and
+  #  acks each of them at once (a duplicate ACK).
+  command = b'RETR loot.bin\r\n'
+  ack = ftp('A', seq + len(command), 0)
+  def sendAck():
+    ack[42:46] = expected.to_bytes(4, 'big')
+    scapyHunt.processPacket(session, ack)
+
+  start = time.time()
+  scapyHunt.processPacket(session, ftp('PA', seq, expected, command))
+  sender = next(iter(session.flows.flows.values())).sender
+  held = dict()
+  stall = 0
+  while not received.endswith(b'226-Transfer complete.\r\n'):
+    batch = writer.queue
+    writer.queue = collections.deque()
+    if not batch:
+      # Everything in flight was lost: wait for the retransmit timer
+      stall += 1
+      if stall > 100:
+        break
+      asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.05))
+      continue
+    stall = 0
+    unacked = 0
+    for reply in batch:
+      if random() < loss:
+        continue
+      frame = parseFrame(reply)
+      ahead = (frame.seq - expected) & 0xffffffff
+      if ahead == 0:
+        received += frame.payload
+        expected = (expected + frame.payloadLen) & 0xffffffff
+        while expected in held:
+          payload = held.pop(expected)
+          received += payload
+          expected = (expected + len(payload)) & 0xffffffff
+        unacked += 1
+        if unacked == 2:
+          sendAck()
+          unacked = 0
+      else:
+        if ahead < 0x80000000:
+          held[frame.seq] = bytes(frame.payload)
+        sendAck()
+    if unacked:
+      sendAck()
+  elapsed = time.time() - start
+  closeReplaySession(handles)
+  body = bytes(received)
+  intact = body == b'150-Retreiving file loot.bin\r\n' + data + b'226-Transfer complete.\r\n'
+  return len(data) / elapsed / 1e6, intact, sender
+
+# RETR of the scenario file by a kernel TCP client over tap0, after ARP spoofing .6
+#  (needs root and /dev/net/tun, and tap0 must not exist yet). Returns (MB/s, intact).
+def retrLive(directory, data, options):
+  import subprocess
+  import hashlib
+  here = os.path.dirname(os.path.abspath(__file__))
+  game = subprocess.Popen([sys.executable, os.path.join(here, "scapyHunt.py"),
+                           "--scenario", directory] + options,
+                          cwd=here, stdout=subprocess.DEVNULL)
+  try:
+    if firstArpReply("tap0", time.time() + 30) is None:
+      print("no ARP reply from the game within 30s")
+      return 0, False
+    spoof = arpSocket()
+    spoof.bind(("tap0", 0))
+    spoof.send(bytes(Ether(src=playerMAC, dst='ff:ff:ff:ff:ff:ff')/
+                     ARP(op=2, hwsrc=playerMAC, psrc='10.5.0.6', pdst='10.5.0.1')))
+    spoof.close()
+    time.sleep(0.1)
+
+    conn = socket.create_connection(('10.1.8.6', 21), timeout=10)
+    stream = conn.makefile('rb')
+    stream.readline()
+    for command in [b'USER admin\r\n', b'PASS admin\r\n']:
+      conn.sendall(command)
+      stream.readline()
+    conn.sendall(b'RETR loot.bin\r\n')
+    start = time.time()
+    stream.readline()
+    body = stream.read(len(data))
+    elapsed = time.time() - start
+    done = stream.readline()
+    conn.close()
+    intact = (hashlib.sha1(body).digest() == hashlib.sha1(data).digest() and
+              done == b'226-Transfer complete.\r\n')
+    return len(data) / elapsed / 1e6, intact
+  finally:
+    game.send_signal(signal.SIGINT)
+    game.wait()
+
+def benchRetr(args):
+  import scapyHunt
+  import shutil
+  size = int(float(args[0]) * (1 << 20)) if args else 16 << 20
+  directory, data = retrScenario(size)
+  try:
+    scapyHunt.loadScenario(directory)
+    ok = True
+    for loss in [0.0, 0.01]:
+      rate, intact, sender = retrOffline(scapyHunt, data, loss)
+      ok = ok and intact
+      print("engine, %4.1f%% loss: %.1f MB/s, %d segments (%d resent, %d fast retransmits, "
+            "%d timeouts), intact: %s" % (loss * 100, rate, sender.segments, sender.retransmits,
+                                          sender.fastRetransmits, sender.timeouts, intact))
+    if os.geteuid() == 0:
+      # Over a lossy link, retransmit timers fire on the wheel while acks arrive
+      for options in RETR_LIVE_OPTIONS:
+        rate, intact = retrLive(directory, data, options)
+        ok = ok and intact
+        print("tap0, kernel client, %-36s: %.1f MB/s, intact: %s" %
+              (" ".join(options) or "threads", rate, intact))
+  finally:
+    shutil.rmtree(directory)
+  return not ok and 1 or 0
+
+
+# Admission Control
+# -----
+
+# Runs frames arriving at pps through a session whose admission control (if any) is
+#  on a simulated clock, in batches of 64. Returns the replies (and how many of them
+#  went to the player), the session and the time (real) spent.
+def shedRun(scapyHunt, frames, pps, admission):
+  from admission import AdmissionControl
+  session, handles = replaySession(scapyHunt)
+  now = [0.0]
+  if admission:
+    session.admission = AdmissionControl(session.hosts, clock=lambda: now[0])
+  queue = session.writer.queue
+  player = bytes.fromhex(playerMAC.replace(':', ''))
+  replies = toPlayer = 0
+  start = time.time()
+  for i in range(0, len(frames), 64):
+    now[0] = i / float(pps)
+    scapyHunt.processBatch(session, frames[i:i + 64])
+    replies += len(queue)
+    toPlayer += sum(1 for reply in queue if reply[0:6] == player)
+    queue.clear()
+  elapsed = time.time() - start
+  closeReplaySession(handles)
+  return (replies, toPlayer), session, elapsed
+
+# macofFrames, made quicker by patching random addresses and ports into one frame
+#  (checksums are left as they are, nothing checks them). With a target, every
+#  frame is a SYN to it.
+def quickMacofFrames(count, target=None):
+  template = bytearray(macofFrames(1)[0])
+  frames = []
+  for i in range(count):
+    frame = bytearray(template)
+    noise = os.urandom(24)
+    frame[0:12] = noise[0:12]
+    frame[26:38] = noise[12:24]
+    if target is not None:
+      frame[30:34] = socket.inet_aton(target)
+    frames.append(bytes(frame))
+  return frames
+
+def benchShed(args):
+  import scapyHunt
+  from admission import ADMIT_NAMES
+  floodPps = int(args[0]) if args else 100000
+  seconds = 2
+  probes = synScanFrames(100)
+  expected = shedRun(scapyHunt, probes, 1000, False)[0][0]
+
+  # The player's SYN scan of every host, spread through a macof flood of random
+  #  addresses, then through one aimed at .4
+  for target in [None, '10.5.0.4']:
+    flood = quickMacofFrames(floodPps * seconds, target)
+    every = len(flood) // len(probes)
+    mixed = []
+    for i, frame in enumerate(probes):
+      mixed.extend(flood[i * every:(i + 1) * every])
+      mixed.append(frame)
+    print("macof at %d frames/sec for %ds (to %s), with a scan (%d SYNs) through it:" %
+          (floodPps, seconds, target or "random addresses", len(probes)))
+    for admission in [False, True]:
+      replies, session, elapsed = shedRun(scapyHunt, mixed, floodPps, admission)
+      control = session.admission
+      shed = control and ", %d passed over, shed %s" % (
+        control.passed, dict(zip(ADMIT_NAMES, control.shed))) or ""
+      print("  admission %-3s: %.0f frames/sec, %d replies, %d of %d to the player's scan, "
+            "CAM overflowed: %s%s" % (admission and "on" or "off", len(mixed) / elapsed,
+                                      replies[0], replies[1], expected,
+                                      session.macTable.overflows > 0, shed))
+
+  # nmap -T5 from the player alone: its own SYN budget holds it back
+  scan = synScanFrames(5000)
+  for pps in [2000, 50000]:
+    replies, session, elapsed = shedRun(scapyHunt, scan, pps, True)
+    print("SYN scan of %d ports at %d frames/sec: %d replies, shed %d" %
+          (len(scan), pps, replies[0], sum(session.admission.shed)))
+
+  # The walkthrough at a player's pace is never shed
+  frames = walkthroughFrames()
+  plain = shedRun(scapyHunt, frames, 2000, False)[0][0]
+  replies, session, elapsed = shedRun(scapyHunt, frames, 2000, True)
+  print("walkthrough at 2000 frames/sec: %d replies (%d without admission), shed %d" %
+        (replies[0], plain, sum(session.admission.shed)))
+  return 0
+
+
+# Port Scan
+# -----
+
+def benchScan(args):
+  import scapyHunt
+  ports = int(args[0]) if args else 65535
+  player = (Ether(src=playerMAC)/IP(src='10.5.0.1', dst='10.5.0.4')/
+            TCP(sport=40000, dport=1, flags=0x002, options=[('MSS', 1460)])).build()
+  probes = []
+  for dst in sorted(hostAddrs):
+    for port in range(1, ports + 1):
+      probe = bytearray(player)
+      probe[30:34] = dst.to_bytes(4, 'big')
+      probe[36:38] = port.to_bytes(2, 'big')
+      probes.append(bytes(probe))
+
+  def scan(process):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    session = scapyHunt.newSession("tap0", devnull)
+    session.reader = TapReader(devnull, "tap0")
+    session.writer = TapWriter(devnull, capacity=len(probes))
+    session.batch = None
+    replies = []
+    start = time.time()
+    for i in range(0, len(probes), 64):
+      process(session, probes[i:i + 64])
+      replies.extend(session.writer.queue)
+      session.writer.drain()
+    elapsed = time.time() - start
+    os.close(devnull)
+    return replies, elapsed
+
+  def handlers(session, batch):
+    for probe in batch:
+      scapyHunt.processPacket(session, probe)
+
+  slow, slowTime = scan(handlers)
+  fast, fastTime = scan(scapyHunt.processBatch)
+  mismatches = sum(1 for a, b in zip(slow, fast) if bytes(a) != bytes(b)) + abs(len(slow) - len(fast))
+  print("%d probes (%d hosts x %d ports), %d replies, %d mismatches" %
+        (len(probes), len(hostAddrs), ports, len(fast), mismatches))
+  print("handlers:  %10.0f probes/sec, %.2fs" % (len(probes) / slowTime, slowTime))
+  print("fast path: %10.0f probes/sec, %.2fs (%.1fx)" % (len(probes) / fastTime, fastTime, slowTime / fastTime))
+  return mismatches != 0
+
+
+# Replay
+# -----
+# The engine runs in a child process on one end of a SOCK_SEQPACKET socketpair,
+#  which like a tap device carries one frame per read/write. Each frame's replies
+#  are worked out beforehand on a session that is never run (so no daemons), then
+#  the stream is sent in windows and every frame coming back is matched to the
+#  frame it answers by its bytes. Frames that match nothing (daemon traffic) are
+#  counted as unsolicited.
+
+replayScenarios = {
+  'sweep': sweepFrames,
+  'synscan': lambda: synScanFrames(1024),
+  'macof': lambda: macofFrames(20000),
+  'knock': knockFrames,
+  'walkthrough': walkthroughFrames,
+}
+
+REPLAY_WINDOW = 16
+
+# A fresh session on a socketpair, on a runtime whose loop never runs
+def replaySession(scapyHunt):
+  tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+  runtime = scapyHunt.AsyncioRuntime(scapyHunt.processBatch)
+  session = scapyHunt.newSession("replay0", tap.fileno())
+  runtime.addSession(session)
+  return session, (tap, player, runtime)
+
+def closeReplaySession(handles):
+  tap, player, runtime = handles
+  runtime.loop.close()
+  tap.close()
+  player.close()
+
+# Frames/sec through processBatch, in batches of 64, on a fresh session
+def replayRate(scapyHunt, frames):
+  session, handles = replaySession(scapyHunt)
+  queue = session.writer.queue
+  start = time.time()
+  for i in range(0, len(frames), 64):
+    scapyHunt.processBatch(session, frames[i:i + 64])
+    queue.clear()
+  rate = len(frames) / (time.time() - start)
+  closeReplaySession(handles)
+  return rate
+
+# Frames/sec through processBatch of a stream replayed on fresh sessions until at
+#  least total frames have gone through
+def replayRateOver(scapyHunt, frames, total):
+  repeats = max(1, total // len(frames))
+  return len(frames) * repeats / sum(len(frames) / replayRate(scapyHunt, frames)
+                                     for r in range(repeats))
+
+# The replies to each frame, frames/sec through processBatch, and allocations per frame
+def replayOffline(scapyHunt, frames):
+  session, handles = replaySession(scapyHunt)
+  queue = session.writer.queue
+  expected = []
+  for frame in frames:
+    scapyHunt.processBatch(session, [frame])
+    expected.append([bytes(reply) for reply in queue])
+    queue.clear()
+  closeReplaySession(handles)
+
+  rate = replayRate(scapyHunt, frames)
+
+  session, handles = replaySession(scapyHunt)
+  queue = session.writer.queue
+  peak = 0
+  tracemalloc.start()
+  blocks = sys.getallocatedblocks()
+  for frame in frames:
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    scapyHunt.processBatch(session, [frame])
+    queue.clear()
+    peak += tracemalloc.get_traced_memory()[1] - base
+  blocks = sys.getallocatedblocks() - blocks
+  tracemalloc.stop()
+  closeReplaySession(handles)
+  return expected, rate, peak / float(len(frames)), blocks / float(len(frames))
+
+# Sends the stream through the engine, returning (frames/sec, latencies, missing, unsolicited)
+def replayLive(frames, expected):
+  tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+  pid = os.fork()
+  if pid == 0:
+    try:
+      import scapyHunt
+      player.close()
+      runtime = scapyHunt.AsyncioRuntime(scapyHunt.processBatch)
+      runtime.addSession(scapyHunt.newSession("replay0", tap.fileno()))
+      runtime.run()
+    finally:
+      os._exit(0)
+  tap.close()
+
+  # Wait for the engine to answer an ARP request before starting the clock
+  poller = select.poll()
+  poller.register(player, select.POLLIN)
+  player.send((Ether(src=playerMAC, dst='ff:ff:ff:ff:ff:ff')/
+               ARP(op=1, hwsrc=playerMAC, psrc='10.5.0.1', pdst='10.5.0.4')).build())
+  player.recv(65535)
+  waiting = collections.defaultdict(collections.deque)
+  sent = [0.0] * len(frames)
+  latencies = []
+  missing = unsolicited = 0
+  start = time.perf_counter()
+  for w in range(0, len(frames), REPLAY_WINDOW):
+    outstanding = 0
+    for i in range(w, min(w + REPLAY_WINDOW, len(frames))):
+      for reply in expected[i]:
+        waiting[reply].append(i)
+      outstanding += len(expected[i])
+      sent[i] = time.perf_counter()
+      player.send(frames[i])
+    while outstanding:
+      if not poller.poll(500):
+        missing += outstanding
+        waiting.clear()
+        break
+      reply = player.recv(65535)
+      now = time.perf_counter()
+      senders = waiting.get(reply)
+      if senders:
+        latencies.append(now - sent[senders.popleft()])
+        outstanding -= 1
+      else:
+        unsolicited += 1
+  rate = len(frames) / (time.perf_counter() - start)
+
+  os.kill(pid, signal.SIGTERM)
+  os.waitpid(pid, 0)
+  player.close()
+  return rate, latencies, missing, unsolicited
+
+def benchReplay(args):
+  import scapyHunt
+  names = args or sorted(replayScenarios)
+  print("%-12s %7s %8s %10s %10s %9s %9s %10s %8s" %
+        ("stream", "frames", "replies", "engine/s", "e2e/s", "p50 us", "p99 us",
+         "peak B/f", "blocks/f"))
+  for name in names:
+    if name in replayScenarios:
+      frames = replayScenarios[name]()
+    else:
+      frames = list(readPcap(name))
+      name = os.path.basename(name)
+    expected, engineRate, peak, blocks = replayOffline(scapyHunt, frames)
+    rate, latencies, missing, unsolicited = replayLive(frames, expected)
+    latencies.sort()
+    p50 = p99 = 0.0
+    if latencies:
+      p50 = latencies[len(latencies) // 2] * 1e6
+      p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6
+    print("%-12s %7d %8d %10.0f %10.0f %9.1f %9.1f %10.0f %8.2f" %
+          (name, len(frames), len(latencies), engineRate, rate, p50, p99, peak, blocks))
+    if missing or unsolicited:
+      print("%-12s %d replies missing, %d unsolicited frames (daemon traffic)" % ("", missing, unsolicited))
+  return 0
+
+
+# Metrics
+# -----
+
+# Batch path
+# -----
+
+# Runs frames through processBatch in batches of 64, copied into a reused pool of
+#  buffers as TapReader does, with the batch path on or off. Returns the replies (as
+#  bytes), the session and the time spent.
+def batchRun(scapyHunt, frames, batched):
+  session, handles = replaySession(scapyHunt)
+  session.batch = batched and scapyHunt.batchReplier(session) or None
+  pool = [memoryview(bytearray(2048)) for i in range(64)]
+  queue = session.writer.queue
+  replies = []
+  elapsed = 0.0
+  for i in range(0, len(frames), 64):
+    batch = []
+    for j, frame in enumerate(frames[i:i + 64]):
+      pool[j][:len(frame)] = frame
+      batch.append(pool[j][:len(frame)])
+    start = time.perf_counter()
+    scapyHunt.processBatch(session, batch)
+    elapsed += time.perf_counter() - start
+    replies.extend(bytes(reply) for reply in queue)
+    queue.clear()
+  closeReplaySession(handles)
+  return replies, session, elapsed
+
+def benchBatch(args):
+  import scapyHunt
+  rounds = int(args[0]) if args else 3
+  if not scapyHunt.batchAvailable:
+    print("NumPy isn't installed, there is no batch path")
+    return 1
+  streams = [(name, replayScenarios[name]()) for name in sorted(replayScenarios)]
+  streams.append(('probes', [frame for kind, frame in randomProbes(2000)]))
+  streams.append(('nmap', nmapFrames(1024)))
+  ok = True
+  print("%-12s %7s %8s %12s %12s %7s  %s" % ("stream", "frames", "replies", "per-packet/s",
+                                              "batch/s", "speedup", "identical"))
+  for name, frames in streams:
+    slow, slowSession, slowTime = batchRun(scapyHunt, frames, False)
+    fast, fastSession, fastTime = batchRun(scapyHunt, frames, True)
+    same = (slow == fast and slowSession.frameCounts == fastSession.frameCounts and
+            list(slowSession.macTable.entries) == list(fastSession.macTable.entries) and
+            slowSession.macTable.overflows == fastSession.macTable.overflows)
+    for r in range(rounds - 1):
+      slowTime = min(slowTime, batchRun(scapyHunt, frames, False)[2])
+      fastTime = min(fastTime, batchRun(scapyHunt, frames, True)[2])
+    ok = ok and same
+    print("%-12s %7d %8d %12.0f %12.0f %6.2fx  %s" % (name, len(frames), len(fast), len(frames) / slowTime,
+                                                     len(frames) / fastTime, slowTime / fastTime, same))
+  return not ok and 1 or 0
+
+# Large topologies
+# -----
+
+# A frame to every address of a CIDR block, made from one frame to the first address
+#  by writing each address in at dstAt (and the IPv4 header's checksum, if ip)
+def sweepOf(cidr, frame, dstAt, ip):
+  network, prefixLen = cidr.split("/")
+  first = ipToInt(network) & (0xffffffff << (32 - int(prefixLen))) & 0xffffffff
+  frames = []
+  for addr in range(first, first + (1 << (32 - int(prefixLen)))):
+    buf = bytearray(frame)
+    struct.pack_into("!I", buf, dstAt, addr)
+    if ip:
+      buf[24:26] = b"\x00\x00"
+      struct.pack_into("!H", buf, 24, replyEngine.internetChecksum(bytes(buf[14:34])))
+    frames.append(bytes(buf))
+  return frames
+
+# nmap -sn of a block on the player's network: an ARP who-has to every address
+def arpSweep(cidr):
+  return sweepOf(cidr, (Ether(src=playerMAC, dst='ff:ff:ff:ff:ff:ff')/
+                        ARP(op=1, hwsrc=playerMAC, psrc='10.5.0.1', pdst='0.0.0.0')).build(), 38, False)
+
+# nmap -sn --send-ip of a block: an ICMP echo-request to every address
+def pingSweep(cidr):
+  return sweepOf(cidr, (Ether(src=playerMAC)/IP(src='10.5.0.1', dst='0.0.0.0')/ICMP()).build(), 30, True)
+
+# Frames/sec through processBatch (in batches of 64, as TapReader's memoryviews),
+#  or with traced set, the peak and retained memory of the session handling them
+def sweepRun(scapyHunt, frames, batched, traced):
+  session, handles = replaySession(scapyHunt)
+  session.batch = batched and scapyHunt.batchReplier(session) or None
+  pool = [memoryview(bytearray(2048)) for i in range(64)]
+  queue = session.writer.queue
+  replies = 0
+  elapsed = 0.0
+  if traced:
+    tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  for i in range(0, len(frames), 64):
+    batch = []
+    for j, frame in enumerate(frames[i:i + 64]):
+      pool[j][:len(frame)] = frame
+      batch.append(pool[j][:len(frame)])
+    start = time.perf_counter()
+    scapyHunt.processBatch(session, batch)
+    elapsed += time.perf_counter() - start
+    replies += len(queue)
+    queue.clear()
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  closeReplaySession(handles)
+  if traced:
+    return replies, peak - before, current - before, session
+  return len(frames) / elapsed
+
+def benchTopology(args):
+  import scapyHunt
+  from hostTable import RANGE_CACHE
+  cidr = args[0] if args else "10.5.0.0/16"
+  ports, filtered = scapyHunt.portProfiles["workstation"]
+  scapyHunt.hostRanges[:] = [(cidr, False, scapyHunt.rangeHost, ports, filtered, scapyHunt.rangeMACPrefix)]
+  status = 0
+
+  # Every host answers alike on both paths, and as the handler would without the
+  #  range's shared templates (a Host made for it on its own)
+  sample = arpSweep(cidr)[:1024] + pingSweep(cidr)[-1024:]
+  hosts = sorted(set(ipToInt(a) for a in ('10.5.0.4', '10.5.0.77', '10.5.1.2')
+                     if ipToInt(a) in scapyHunt.compileHosts([], scapyHunt.hostRanges)))
+  for addr in hosts:
+    sample += synScanFrames(512, [socket.inet_ntoa(struct.pack("!I", addr))])
+  slow = batchRun(scapyHunt, sample, False)[0]
+  fast = batchRun(scapyHunt, sample, True)[0]
+  session, handles = replaySession(scapyHunt)
+  expected = []
+  for frame in sample:
+    parsed = parseFrame(frame)
+    dst = parsed.arpPdst if parsed.kind == FRAME_ARP else parsed.ipDst
+    host = dict.get(session.hosts, dst)
+    if host is None and dst in session.hosts:
+      host = session.hosts.ranges[0].host(dst)
+    if host is None:
+      continue
+    writer = session.writer
+    queue = writer.queue
+    host.handler(session, parsed, host)
+    expected.extend(bytes(reply) for reply in queue)
+    queue.clear()
+  closeReplaySession(handles)
+  same = slow == fast == expected
+  print("sample of %d frames (ARP, ping, SYN scans): %d replies, batch and per-packet identical: %s" %
+        (len(sample), len(fast), same))
+  if not same:
+    status = 1
+
+  for name, frames in (("arp sweep", arpSweep(cidr)), ("ping sweep", pingSweep(cidr))):
+    for batched in (False, True):
+      rate = sweepRun(scapyHunt, frames, batched, False)
+      replies, peak, retained, session = sweepRun(scapyHunt, frames, batched, True)
+      print("%-10s %-10s %6d frames, %6d replies: %8.0f frames/sec, peak %6.1f KB, retained %6.1f KB, "
+            "%d range hosts made" % (name, batched and "batch" or "per-packet", len(frames), replies,
+                                     rate, peak / 1024.0, retained / 1024.0, len(session.hosts.cache)))
+      if replies != len(frames) - 3 or len(session.hosts.cache) > RANGE_CACHE:
+        print("FAIL: expected %d replies, and at most %d range hosts made" % (len(frames) - 3, RANGE_CACHE))
+        status = 1
+  return status
+
+# Frames each stream is replayed for, per round
+METRICS_FRAMES = 50000
+
+def benchMetrics(args):
+  import scapyHunt
+  rounds = int(args[0]) if args else 5
+  streams = [(name, replayScenarios[name]()) for name in sorted(replayScenarios) if name != 'knock']
+
+  # What enableMetrics replaces, without and with it, so rounds can switch between them
+  names = scapyHunt.instrumentedReplies + ("hostDeclarations", "hostRanges", "metrics")
+  plain = dict((name, getattr(scapyHunt, name)) for name in names)
+  scapyHunt.enableMetrics()
+  timed = dict((name, getattr(scapyHunt, name)) for name in names)
+
+  # Each replay with metrics off is followed by one with them on (or the other way
+  #  round, every other time), so drift in the machine's speed falls on both alike
+  for name, frames in streams:
+    rates = ([], [])
+    replays = rounds * max(1, METRICS_FRAMES // len(frames))
+    for r in range(replays):
+      for on in (r % 2, 1 - r % 2):
+        for attr, value in (timed if on else plain).items():
+          setattr(scapyHunt, attr, value)
+        rates[on].append(replayRate(scapyHunt, frames))
+    off, on = [sorted(found)[replays // 2] for found in rates]
+    print("%-12s %7d frames: %10.0f frames/sec off, %10.0f on (%+.1f%%, medians of %d replays)" %
+          (name, len(frames), off, on, (on / off - 1) * 100, replays))
+
+  for attr, value in timed.items():
+    setattr(scapyHunt, attr, value)
+  session, handles = replaySession(scapyHunt)
+  path = "/tmp/scapyHunt-stats.%d.json" % os.getpid()
+  start = time.time()
+  for r in range(100):
+    scapyHunt.metrics.writeFile(path, [session])
+  print("stats file: %.2f ms per write, %d bytes" % ((time.time() - start) * 10, os.path.getsize(path)))
+  os.unlink(path)
+  closeReplaySession(handles)
+  return 0
+
+
+# Profiling
+# -----
+
+# Frames each stream is replayed for, per round
+PROFILE_FRAMES = 50000
+# Seconds the idle game's profile runs for
+PROFILE_IDLE_DURATION = 0.2
+
+def benchProfile(args):
+  import scapyHunt
+  import tempfile
+  import shutil
+  from profiler import HANDLER_PREFIXES, SamplingProfiler
+  rounds = int(args[0]) if args else 3
+  streams = [(name, replayScenarios[name]()) for name in sorted(replayScenarios) if name != 'knock']
+  scapyHunt.profileDir = directory = tempfile.mkdtemp()
+  scapyHunt.profileDuration = 3600.0
+  scapyHunt.installProfiler()
+
+  # (the streams are short, and the profile needs the samples)
+  def rate(frames):
+    return replayRateOver(scapyHunt, frames, PROFILE_FRAMES)
+  off = dict((name, max(rate(frames) for r in range(rounds))) for name, frames in streams)
+
+  # Started and stopped as from outside, with SIGUSR2
+  cpu = time.process_time()
+  os.kill(os.getpid(), signal.SIGUSR2)
+  on = dict((name, max(rate(frames) for r in range(rounds))) for name, frames in streams)
+  os.kill(os.getpid(), signal.SIGUSR2)
+  cpu = time.process_time() - cpu
+  for name, frames in streams:
+    print("%-12s %7d frames: %10.0f frames/sec off, %10.0f sampling (%+.1f%%)" %
+          (name, len(frames), off[name], on[name], (on[name] / off[name] - 1) * 100))
+
+  paths = os.listdir(directory)
+  status = 0
+  if len(paths) != 1 or not paths[0].endswith(".folded"):
+    print("FAIL: expected one profile, found %s" % paths)
+    status = 1
+  else:
+    samples = 0
+    handlers = set()
+    with open(os.path.join(directory, paths[0])) as f:
+      for line in f:
+        stack, count = line.rsplit(" ", 1)
+        samples += int(count)
+        handlers.update(name for name in [label.rsplit(":", 1)[1] for label in stack.split(";")[1:]]
+                        if name.startswith(HANDLER_PREFIXES))
+    print("profile: %d samples over %.1fs of CPU (%.0f/s), handlers seen: %s" %
+          (samples, cpu, samples / cpu, ", ".join(sorted(handlers))))
+    if not samples or not handlers:
+      print("FAIL: the profile has no samples inside the handlers")
+      status = 1
+
+  # A game idle all along (blocked, as the packet loop is on its tap) still writes
+  #  its profile once the duration is up
+  idle = SamplingProfiler(directory, PROFILE_IDLE_DURATION)
+  idle.toggle()
+  select.select([], [], [], PROFILE_IDLE_DURATION * 5)
+  written = idle.path is not None and os.path.exists(idle.path)
+  print("idle for %gs with a %gs profile: written: %s" %
+        (PROFILE_IDLE_DURATION * 5, PROFILE_IDLE_DURATION, written))
+  if not written:
+    print("FAIL: the idle profile wasn't written when its duration was up")
+    status = 1
+  shutil.rmtree(directory)
+  return status
+
+
+# Recording
+# -----
+
+def benchRecord(args):
+  import scapyHunt
+  import tempfile
+  import shutil
+  from recorder import PcapRecorder
+  frames = walkthroughFrames() + synScanFrames(1024) + macofFrames(10000)
+  directory = tempfile.mkdtemp()
+  devnull = os.open(os.devnull, os.O_WRONLY)
+
+  def run(recorder):
+    session, handles = replaySession(scapyHunt)
+    session.writer = TapWriter(devnull, recorder=recorder)
+    start = time.time()
+    for i in range(0, len(frames), 64):
+      batch = frames[i:i + 64]
+      if recorder is not None:
+        recorder.recordBatch(batch)   # as TapReader.drain does
+      scapyHunt.processBatch(session, batch)
+      session.writer.drain()
+      if recorder is not None and i % 4096 == 0:
+        recorder.flush()              # as the flusher thread does
+    rate = len(frames) / (time.time() - start)
+    closeReplaySession(handles)
+    return rate, session.writer.frames
+
+  off, replies = run(None)
+  recorder = PcapRecorder(directory, "rec0", fileSize=1 << 20, files=1000)
+  on, replies = run(recorder)
+  recorder.close()
+  print("%d frames in, %d out: %.0f frames/sec without recording, %.0f with (%+.1f%%)" %
+        (len(frames), replies, off, on, (on / off - 1) * 100))
+  stored = sum(1 for n in range(recorder.written) for frame in readPcap(recorder.path(n)))
+  print("recorded %d frames (%d dropped) in %d files, %d frames read back" %
+        (recorder.frames, recorder.dropped, recorder.written, stored))
+
+  # A ring nobody flushes: once full, frames are dropped at the same speed
+  full = PcapRecorder(directory, "full0", ringSize=1 << 16)
+  start = time.time()
+  for i in range(0, len(frames), 64):
+    full.recordBatch(frames[i:i + 64])
+  elapsed = time.time() - start
+  print("unflushed 64 KiB ring: %d recorded, %d dropped, %.2f us per frame" %
+        (full.frames, full.dropped, elapsed * 1e6 / len(frames)))
+  os.close(devnull)
+  shutil.rmtree(directory)
+  return stored != recorder.frames and 1 or 0
+
+
+# Background traffic
+# -----
+
+def benchTraffic(args):
+  import scapyHunt
+  from trafficGen import FrameTemplate
+  from timingWheel import TimingWheel
+  pps = int(args[0]) if args else 5000
+  count = int(args[1]) if len(args) > 1 else 50
+
+  def scapyFrame(srcMAC, dstMAC, src, dst, sport, dport):
+    return (Ether(src=srcMAC, dst=dstMAC)/IP(src=src, dst=dst)/
+            TCP(sport=sport, dport=dport, flags=0x002, window=2048, seq=0)).build()
+
+  srcMAC, dstMAC = "12:67:7e:b7:6d:06", "12:67:7e:b7:6d:23"
+  template = FrameTemplate(srcMAC, dstMAC, ipToInt("10.5.0.6"), ipToInt("10.1.8.2"))
+  ports = [(randint(0, 65535), randint(0, 65535)) for i in range(5000)]
+  mismatches = sum(1 for sport, dport in ports
+                   if bytes(template.frame(sport, dport)) !=
+                      scapyFrame(srcMAC, dstMAC, "10.5.0.6", "10.1.8.2", sport, dport))
+  print("%d template frames checked against scapy, %d differ" % (len(ports), mismatches))
+  scapyRate = timeFrames(lambda p: scapyFrame(srcMAC, dstMAC, "10.5.0.6", "10.1.8.2", *p), ports)
+  templateRate = timeFrames(lambda p: template.frame(*p), ports)
+  print("scapy build: %.0f frames/sec, template: %.0f frames/sec (%.0fx)" %
+        (scapyRate, templateRate, templateRate / scapyRate))
+
+  # A knock-solved session with the noise split over count generators, on a
+  #  simulated clock so the scheduler's ticks can be counted
+  session, handles = replaySession(scapyHunt)
+  now = [0.0]
+  session.wheel = TimingWheel(session.writer.queueMany, clock=lambda: now[0])
+  for i in range(count):
+    scapyHunt.startTraffic(session, scapyHunt.GatewayNoise(session, float(pps) / count))
+  scapyHunt.startTraffic(session, scapyHunt.FtpHint(session))
+  queue = session.writer.queue
+  wakeups = frames = 0
+  start = time.process_time()
+  while now[0] < 10.0:
+    delay = session.wheel.runDue()
+    frames += len(queue)
+    queue.clear()
+    wakeups += 1
+    now[0] += delay
+  cpu = time.process_time() - start
+  closeReplaySession(handles)
+  print("%d generators, %d frames/sec: %d sends (%d skipped) and %d frames with replies in 10s "
+        "on %d wakeups, %.1f%% of a core" %
+        (count + 1, pps, session.traffic.sends, session.traffic.skipped, frames, wakeups,
+         cpu * 10))
+
+  errors = trafficThreaded(scapyHunt, pps, TRAFFIC_THREADED_SECONDS)
+  print("gateway noise from a ThreadRuntime's wheel during a macof flood for %gs: %d errors%s" %
+        (TRAFFIC_THREADED_SECONDS, len(errors), errors and " (%r)" % errors[0] or ""))
+  return (mismatches or errors) and 1 or 0
+
+# Seconds of noise and flood for trafficThreaded
+TRAFFIC_THREADED_SECONDS = 3.0
+
+# Gateway noise at pps from the timing wheel of a ThreadRuntime (in a thread of its
+#  own), while a macof flood through the tap keeps a small CAM table learning and
+#  aging out entries. Returns the exceptions raised in any thread.
+def trafficThreaded(scapyHunt, pps, seconds):
+  import threading
+  from camTable import CamTable
+  errors = []
+  hook = threading.excepthook
+  threading.excepthook = lambda args: errors.append(args.exc_value)
+  # (switching threads as often as possible, so a race shows sooner)
+  interval = sys.getswitchinterval()
+  sys.setswitchinterval(1e-6)
+  tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+  player.setblocking(False)
+  runtime = scapyHunt.ThreadRuntime(scapyHunt.processBatch)
+  session = scapyHunt.newSession("tap0", tap.fileno())
+  session.macTable = CamTable(64, 0.001)
+  runtime.addSession(session)
+  threading.Thread(target=runtime.run, daemon=True).start()
+  scapyHunt.startTraffic(session, scapyHunt.GatewayNoise(session, pps))
+  flood = quickMacofFrames(4096)
+  end = time.time() + seconds
+  i = 0
+  while time.time() < end and not errors:
+    try:
+      player.send(flood[i % len(flood)])
+      i += 1
+    except BlockingIOError:
+      time.sleep(0.0001)
+    try:
+      while 1:
+        player.recv(2048)
+    except BlockingIOError:
+      pass
+  # (the runtime's threads are left blocked on the tap)
+  threading.excepthook = hook
+  sys.setswitchinterval(interval)
+  return errors
+
+
+# Link Emulation
+# -----
+
+# count frames through a TimingWheel on a simulated clock, each delayed by up to span
+#  seconds. Returns (CPU microseconds per frame, frames released early, most ticks
+#  any was late).
+def wheelRun(count, span):
+  from timingWheel import TimingWheel
+  now = [0.0]
+  batches = []
+  wheel = TimingWheel(lambda frames: batches.append((now[0], frames)), clock=lambda: now[0])
+  delays = [random() * span for i in range(count)]
+  start = time.process_time()
+  for i in range(count):
+    wheel.send(delays[i], i)
+  while len(wheel):
+    now[0] += max(wheel.runDue(), 1e-6)
+  cpu = time.process_time() - start
+  early = late = 0
+  for released, frames in batches:
+    for i in frames:
+      if released < delays[i]:
+        early += 1
+      late = max(late, (released - delays[i]) / wheel.tick)
+  return cpu * 1e6 / count, early, late
+
+# The same frames through a heap, as the scheduler used to run its generators
+def heapRun(count, span):
+  import heapq
+  queue = []
+  delays = [random() * span for i in range(count)]
+  start = time.process_time()
+  for i in range(count):
+    heapq.heappush(queue, (delays[i], i))
+  while queue:
+    heapq.heappop(queue)
+  return (time.process_time() - start) * 1e6 / count
+
+# Seconds each of count connects to 10.1.8.6:21 takes from a kernel client, through a
+#  game on tap0 run with the given extra arguments
+def linkLive(count, extra):
+  import subprocess
+  here = os.path.dirname(os.path.abspath(__file__))
+  game = subprocess.Popen([sys.executable, os.path.join(here, "scapyHunt.py")] + extra,
+                          cwd=here, stdout=subprocess.DEVNULL)
+  try:
+    if firstArpReply("tap0", time.time() + 30) is None:
+      print("no ARP reply from the game within 30s")
+      return []
+    spoof = arpSocket()
+    spoof.bind(("tap0", 0))
+    spoof.send(bytes(Ether(src=playerMAC, dst='ff:ff:ff:ff:ff:ff')/
+                     ARP(op=2, hwsrc=playerMAC, psrc='10.5.0.6', pdst='10.5.0.1')))
+    spoof.close()
+    time.sleep(0.1)
+    times = []
+    for i in range(count):
+      start = time.time()
+      try:
+        conn = socket.create_connection(('10.1.8.6', 21), timeout=5)
+      except socket.timeout:
+        continue
+      times.append(time.time() - start)
+      conn.close()
+      time.sleep(0.05)
+    return times
+  finally:
+    game.send_signal(signal.SIGINT)
+    game.wait()
+
+def benchLinks(args):
+  import scapyHunt
+  from random import Random
+  from timingWheel import TimingWheel
+  from linkEmulator import Link, LinkEmulator
+  count = int(args[0]) if args else 100000
+  ok = True
+  for n in [count // 100, count // 10, count]:
+    perFrame, early, late = wheelRun(n, 2.0)
+    print("%8d frames waiting: wheel %.2fus/frame, heap %.2fus/frame; %d released early, "
+          "at most %.1f ticks late" % (n, perFrame, heapRun(n, 2.0), early, late))
+    ok = ok and not early and late <= 1.0
+
+  # A ping every millisecond to a host on the link and one off it, on a simulated clock
+  latency, jitter, loss = 0.040, 0.010, 0.05
+  session, handles = replaySession(scapyHunt)
+  now = [0.0]
+  session.wheel = TimingWheel(session.writer.queueMany, clock=lambda: now[0])
+  session.link = session.writer.link = LinkEmulator(
+    session, [Link("10.1.8.0/24", latency, jitter, loss)], Random(1))
+  gwMAC = session.clients['10.5.0.35']
+  pings = 5000
+  def ping(dst, mac, seq):
+    return bytearray((Ether(src=playerMAC, dst=mac)/IP(src='10.5.0.1', dst=dst)/
+                      ICMP(id=1, seq=seq)).build())
+  onLink = [ping('10.1.8.2', gwMAC, i) for i in range(pings)]
+  offLink = [ping('10.5.0.4', session.clients['10.5.0.4'], i) for i in range(pings)]
+  queue = session.writer.queue
+  delays = dict()
+  immediate = 0
+  for i in range(pings + 100):
+    if i < pings:
+      scapyHunt.processBatch(session, [onLink[i], offLink[i]])
+    session.wheel.runDue()
+    for reply in queue:
+      seq = struct.unpack_from("!H", reply, 40)[0]
+      if bytes(reply[26:30]) == socket.inet_aton('10.5.0.4'):
+        immediate += seq == i
+      else:
+        delays[seq] = now[0] - seq * 0.001
+    queue.clear()
+    now[0] += 0.001
+  closeReplaySession(handles)
+  values = sorted(delays.values())
+  lost = 1.0 - float(len(values)) / pings
+  mean = sum(values) / len(values)
+  print("link %.0fms, %.0fms jitter, %.0f%% loss: %d pings, %.1f%% lost, delay min %.1fms, "
+        "mean %.1fms, max %.1fms; off the link %d of %d answered at once" %
+        (latency * 1e3, jitter * 1e3, loss * 100, pings, lost * 100, values[0] * 1e3,
+         mean * 1e3, values[-1] * 1e3, immediate, pings))
+  ok = (ok and abs(lost - loss) < 0.02 and abs(mean - latency) < 0.002 and
+        values[0] >= latency - jitter and values[-1] <= latency + jitter + 0.002 and
+        immediate == pings)
+
+  if os.geteuid() == 0:
+    for extra in [[], ["--link", "10.1.8.0/24=40:10"], ["--asyncio", "--link", "10.1.8.0/24=40:10"]]:
+      times = sorted(linkLive(20, extra))
+      if not times:
+        ok = False
+        continue
+      print("tap0 %-40s %d connects, median %.1fms, max %.1fms" %
+            (" ".join(extra) or "(no link)", len(times), times[len(times) // 2] * 1e3,
+             times[-1] * 1e3))
+      if extra:
+        ok = ok and latency - jitter - 0.005 <= times[len(times) // 2] <= latency + jitter + 0.01
+  return not ok and 1 or 0
+
+
+# Startup
+# -----
+
+arpRequest = None
+
+# A raw socket for ARP frames, opened in the named network namespace (or this one)
+def arpSocket(netns=None):
+  if netns is None:
+    return socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x0806))
+  import ctypes
+  libc = ctypes.CDLL(None, use_errno=True)
+  home = os.open("/proc/self/ns/net", os.O_RDONLY)
+  target = os.open("/var/run/netns/%s" % netns, os.O_RDONLY)
+  try:
+    if libc.setns(target, 0x40000000) != 0:   # CLONE_NEWNET
+      raise OSError(ctypes.get_errno(), "setns")
+    try:
+      return socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x0806))
+    finally:
+      libc.setns(home, 0x40000000)
+  finally:
+    os.close(home)
+    os.close(target)
+
+# Asks for .6's MAC on the given tap until the game answers, returning when it did
+#  (or None at the deadline)
+def firstArpReply(ifname, deadline, netns=None):
+  global arpRequest
+  if arpRequest is None:
+    arpRequest = bytes(Ether(src="12:67:7e:b7:6d:c8", dst="ff:ff:ff:ff:ff:ff")/
+                       ARP(op=1, hwsrc="12:67:7e:b7:6d:c8", psrc="10.5.0.1", pdst="10.5.0.6"))
+  target = ipToInt("10.5.0.6")
+  sock = None
+  while time.time() < deadline:
+    try:
+      if sock is None:
+        sock = arpSocket(netns)
+        sock.bind((ifname, 0))
+      sock.send(arpRequest)
+      while select.select([sock], [], [], 0.002)[0]:
+        frame = parseFrame(sock.recv(2048))
+        if frame.kind == FRAME_ARP and frame.arpOp == 2 and frame.arpPsrc == target:
+          sock.close()
+          return time.time()
+    except OSError:
+      # (no such tap yet, or it is still down)
+      if sock is not None:
+        sock.close()
+        sock = None
+      time.sleep(0.002)
+  return None
+
+def benchStartup(args):
+  import subprocess
+  rounds = int(args[0]) if args else 5
+  here = os.path.dirname(os.path.abspath(__file__))
+  script = os.path.join(here, "scapyHunt.py")
+
+  def timed(argv):
+    start = time.time()
+    subprocess.check_call(argv, cwd=here, stdout=subprocess.DEVNULL)
+    return time.time() - start
+
+  base = min(timed([sys.executable, "-c", "pass"]) for i in range(rounds))
+  imports = min(timed([sys.executable, "-c", "import scapyHunt"]) for i in range(rounds))
+  print("interpreter: %.0f ms, import scapyHunt: %.0f ms" % (base * 1000, imports * 1000))
+
+  # Each player's tap has the same routes, so without --netns several players (or
+  #  workers) are refused before any tap is opened; with it, every tap answers
+  for extra in (["--players", "2"], ["--workers", "2"]):
+    status = subprocess.call([sys.executable, script] + extra, cwd=here,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if status != 2 or os.path.exists("/sys/class/net/tap0"):
+      print("%s without --netns: exit status %d and tap0 %s, expected a usage error and no tap" %
+            (" ".join(extra), status, "opened" if os.path.exists("/sys/class/net/tap0") else "not opened"))
+      return 1
+  game = subprocess.Popen([sys.executable, script, "--players", "2", "--netns"], cwd=here,
+                          stdout=subprocess.DEVNULL)
+  replies = [firstArpReply("tap%d" % i, time.time() + 30, "scapyhunt%d" % i) for i in range(2)]
+  game.send_signal(signal.SIGINT)
+  game.wait()
+  if None in replies:
+    print("--players 2 --netns: no ARP reply on tap%d within 30s" % replies.index(None))
+    return 1
+  print("--players 2 or --workers 2 refused without --netns; with it, both taps answer")
+
+  times = []
+  for i in range(rounds):
+    start = time.time()
+    game = subprocess.Popen([sys.executable, script], cwd=here, stdout=subprocess.DEVNULL)
+    replied = firstArpReply("tap0", start + 30)
+    game.send_signal(signal.SIGINT)
+    game.wait()
+    if replied is None:
+      print("no ARP reply from the game within 30s")
+      return 1
+    times.append(replied - start)
+  times.sort()
+  print("start to first ARP reply: min %.0f ms, median %.0f ms (%d rounds)" %
+        (times[0] * 1000, times[len(times) // 2] * 1000, rounds))
+  return 0
+
+# Session pool
+# -----
+
+def benchPool(args):
+  import subprocess
+  players = int(args[0]) if args else 8
+  size = int(args[1]) if len(args) > 1 else 4
+  here = os.path.dirname(os.path.abspath(__file__))
+  path = "/tmp/scapyhunt-bench-%d.sock" % os.getpid()
+  env = dict(os.environ, PYTHONUNBUFFERED="1")
+  start = time.time()
+  game = subprocess.Popen([sys.executable, os.path.join(here, "scapyHunt.py"),
+                           "--pool", str(size), "--pool-socket", path],
+                          cwd=here, env=env, stdout=subprocess.PIPE, text=True)
+  for line in game.stdout:
+    if line.startswith("Session pool ready"):
+      break
+  print("pool of %d games ready %.0f ms after starting" % (size, (time.time() - start) * 1000))
+
+  # Waits for a player's game, returning its tap and network namespace, and the
+  #  times (ms) to being told where it is and to the tap's first ARP reply
+  def join(conn, asked):
+    ifname, netns = conn.recv(64).decode().split()
+    allocated = time.time()
+    replied = firstArpReply(ifname, allocated + 10, netns)
+    return "%s/%s" % (netns, ifname), (allocated - asked) * 1000, (replied - asked) * 1000
+
+  def connect():
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    return conn
+
+  conns = []
+  print("%-10s %-20s %12s %14s" % ("phase", "game", "allocate ms", "first reply ms"))
+  # One player at a time, each served from a full pool
+  for i in range(size):
+    asked = time.time()
+    conn = connect()
+    ifname, allocated, replied = join(conn, asked)
+    conns.append(conn)
+    print("%-10s %-20s %12.2f %14.2f" % ("one", ifname, allocated, replied))
+    time.sleep(0.5)
+  # Everyone at once: the first ones get pooled games, the rest wait for refills
+  asked = time.time()
+  burst = [connect() for i in range(players)]
+  for conn in burst:
+    ifname, allocated, replied = join(conn, asked)
+    print("%-10s %-20s %12.2f %14.2f" % ("burst", ifname, allocated, replied))
+  conns.extend(burst)
+
+  def games():
+    return len([name for name in os.listdir("/var/run/netns") if name.startswith("scapyhunt")])
+  playing = games()
+  for conn in conns:
+    conn.close()
+  time.sleep(1.0)
+  print("%d games while playing (%d players + %d ready), %d after everyone left" %
+        (playing, len(conns), size, games()))
+  game.send_signal(signal.SIGINT)
+  game.communicate()
+  print("%d games after stopping the pool" % games())
+  return 0
+
+
+# Multi-queue tap
+# -----
+
+# Times the knock is sent over two workers at once
+QUEUES_KNOCK_ROUNDS = 2000
+
+# Checks that what one queue's partition of a game sees holds on all of them
+def queuesOffline(scapyHunt, queues):
+  from multiQueue import SharedState
+  scapyHunt.queueState = SharedState(queues, scapyHunt.initialClients())
+  sessions = []
+  handles = []
+  for q in range(queues):
+    tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    runtime = scapyHunt.AsyncioRuntime(scapyHunt.processBatch)
+    session = scapyHunt.newQueueSession("tap0", tap.fileno(), q)
+    runtime.addSession(session)
+    sessions.append(session)
+    handles.append((tap, player, runtime))
+  watchers = [scapyHunt.watchEvents(session) for session in sessions]
+  def poll():
+    for watcher in watchers:
+      next(watcher)
+
+  # Each frame lands on a queue of its own, round robin
+  def spread(frames):
+    for i, frame in enumerate(frames):
+      scapyHunt.processBatch(sessions[i % queues], [frame])
+    poll()
+
+  ok = True
+  spread(quickMacofFrames(scapyHunt.camSize * 2))
+  hub = [session.hubMode for session in sessions]
+  knockers = [session.traffic is not None and
+              any(isinstance(g, scapyHunt.KnockTraffic) for g in session.traffic.generators)
+              for session in sessions]
+  print("macof over %d queues: hub mode on every queue: %s, knock traffic started by %d of them" %
+        (queues, all(hub), sum(knockers)))
+  ok = ok and all(hub) and sum(knockers) == 1
+
+  if queues > 1:
+    # Every partition's table overflowed, one queue after another, then the first one
+    #  aging out: the switch stays in hub mode while the others are overflowed
+    for session in sessions[1:]:
+      for frame in quickMacofFrames(session.macTable.capacity + 1):
+        scapyHunt.processBatch(session, [frame])
+    cam = sessions[0].macTable
+    cam.clock = lambda: time.monotonic() + cam.aging + 1
+    scapyHunt.processBatch(sessions[0], quickMacofFrames(1))
+    cam.clock = time.monotonic
+    aged = [session.hubMode for session in sessions]
+    print("queue 0's table aged out, the others' overflowed: hub mode on every queue: %s" %
+          all(aged))
+    ok = ok and not cam.overflowed and all(aged)
+
+  spread(knockFrames())
+  opened = [session.openPorts['10.5.0.6'].state(25) == scapyHunt.PORT_OPEN for session in sessions]
+  noise = [sum(1.0 / g.interval for g in session.traffic.generators
+               if isinstance(g, scapyHunt.GatewayNoise)) for session in sessions]
+  print("knock over %d queues: port 25 open on every queue: %s, noise %s frames/sec" %
+        (queues, all(opened), "+".join("%g" % rate for rate in noise)))
+  ok = ok and all(opened) and abs(sum(noise) - scapyHunt.noiseRate) < 1e-9
+
+  spoof = (Ether(src=playerMAC, dst='ff:ff:ff:ff:ff:ff')/
+           ARP(op=2, hwsrc=playerMAC, psrc='10.5.0.6', pdst='10.5.0.1')).build()
+  scapyHunt.processBatch(sessions[-1], [spoof])
+  spoofed = [session.clients['10.5.0.6'] == playerMAC for session in sessions]
+  print("ARP spoof on queue %d: seen on every queue: %s" % (queues - 1, all(spoofed)))
+  ok = ok and all(spoofed)
+
+  for tap, player, runtime in handles:
+    runtime.loop.close()
+    tap.close()
+    player.close()
+  scapyHunt.queueState = None
+  return ok
+
+# Knocks on two queues' workers at once: forks a worker per queue, each handling the
+#  frames of its own socketpair, and knocks over them out of round-robin order, the
+#  first two knocks (both on port 951) reaching both workers together. Returns the
+#  rounds of rounds in which the knock wasn't solved.
+def queuesKnockRace(scapyHunt, rounds):
+  from multiQueue import SharedState
+  state = scapyHunt.queueState = SharedState(2, scapyHunt.initialClients())
+  # The queue each knock of the sequence reaches
+  order = [1, 0, 1, 1, 0, 1]
+  frames = knockFrames()
+  done, ack = os.pipe()
+  players = []
+  pids = []
+  for q in range(2):
+    tap, player = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    pid = os.fork()
+    if pid == 0:
+      try:
+        player.close()
+        session = scapyHunt.newQueueSession("tap0", tap.fileno(), q)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        session.reader = TapReader(devnull, "tap0")
+        session.writer = TapWriter(devnull)
+        while 1:
+          frame = tap.recv(2048)
+          if not frame:
+            break
+          scapyHunt.processBatch(session, [frame])
+          os.write(ack, b".")
+      finally:
+        os._exit(0)
+    tap.close()
+    players.append(player)
+    pids.append(pid)
+  os.close(ack)
+
+  def knock(indexes):
+    for i in indexes:
+      players[order[i]].send(frames[i])
+    for i in indexes:
+      if not os.read(done, 1):
+        raise RuntimeError("a queue's worker died")
+
+  unsolved = 0
+  for r in range(rounds):
+    state.knockSequence = 0
+    knock([0, 1])
+    for i in range(2, len(frames)):
+      knock([i])
+    if state.knockSequence != len(frames):
+      unsolved += 1
+  for player in players:
+    player.close()
+  for pid in pids:
+    os.waitpid(pid, 0)
+  os.close(done)
+  scapyHunt.queueState = None
+  return unsolved
+
+# CPU seconds used so far by each of a process's children
+def childCpu(pid):
+  try:
+    with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+      children = [int(child) for child in f.read().split()]
+  except IOError:
+    return {}
+  ticks = os.sysconf("SC_CLK_TCK")
+  times = {}
+  for child in children:
+    try:
+      with open("/proc/%d/stat" % child) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    except IOError:
+      continue
+    times[child] = (int(fields[11]) + int(fields[12])) / float(ticks)
+  return times
+
+# Runs the game on tap0 with the given queues, solves the knock and floods it with
+#  SYNs for seconds. Returns (replies/sec, knock solved, CPU seconds per worker).
+def queuesLive(queues, seconds):
+  import subprocess
+  here = os.path.dirname(os.path.abspath(__file__))
+  argv = [sys.executable, os.path.join(here, "scapyHunt.py")]
+  argv += ["--queues", str(queues)] if queues > 1 else ["--asyncio"]
+  game = subprocess.Popen(argv, cwd=here, stdout=subprocess.DEVNULL)
+  try:
+    if firstArpReply("tap0", time.time() + 30) is None:
+      print("no ARP reply from the game within 30s")
+      return 0, False, {}
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x0800))
+    sock.bind(("tap0", 0))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+    for frame in knockFrames():
+      sock.send(frame)
+      time.sleep(0.01)
+    time.sleep(0.2)
+    ourMAC = bytes.fromhex(playerMAC.replace(':', ''))
+    smtp = (Ether(src=playerMAC, dst='12:67:7e:b7:6d:06')/IP(src='10.5.0.1', dst='10.5.0.6')/
+            TCP(sport=43000, dport=25, flags=0x002)).build()
+    sock.send(smtp)
+    solved = False
+    deadline = time.time() + 1
+    while not solved and time.time() < deadline:
+      if select.select([sock], [], [], 0.05)[0]:
+        data, addr = sock.recvfrom(2048)
+        frame = parseFrame(data)
+        solved = (addr[2] != socket.PACKET_OUTGOING and frame.kind == FRAME_TCP and
+                  frame.sport == 25 and frame.tcpFlags == 0x012)
+
+    # SYNs to .4's closed ports, from a new flow each, answered with RST-ACKs
+    frames = [(Ether(src=playerMAC, dst='12:67:7e:b7:6d:04')/IP(src='10.5.0.1', dst='10.5.0.4')/
+               TCP(sport=1024 + i, dport=1000, flags=0x002)).build() for i in range(4096)]
+    four = ipToInt('10.5.0.4').to_bytes(4, 'big')
+    pid = os.fork()
+    if pid == 0:
+      try:
+        end = time.time() + seconds
+        while time.time() < end:
+          for frame in frames:
+            try:
+              sock.send(frame)
+            except OSError:
+              time.sleep(0.0005)
+      finally:
+        os._exit(0)
+    before = childCpu(game.pid)
+    replies = 0
+    end = time.time() + seconds
+    while time.time() < end + 0.5:
+      if not select.select([sock], [], [], 0.1)[0]:
+        continue
+      data, addr = sock.recvfrom(2048)
+      if addr[2] != socket.PACKET_OUTGOING and data[26:30] == four and data[6:12] != ourMAC:
+        replies += 1
+    os.waitpid(pid, 0)
+    after = childCpu(game.pid)
+    sock.close()
+    cpu = dict((child, after[child] - before.get(child, 0.0)) for child in after)
+    return replies / float(seconds), solved, cpu
+  finally:
+    game.send_signal(signal.SIGINT)
+    game.wait()
+
+def benchQueues(args):
+  import scapyHunt
+  maxQueues = int(args[0]) if args else max(2, os.cpu_count() or 2)
+  seconds = float(args[1]) if len(args) > 1 else 3.0
+  ok = queuesOffline(scapyHunt, maxQueues)
+  unsolved = queuesKnockRace(scapyHunt, QUEUES_KNOCK_ROUNDS)
+  print("knock over 2 queues' workers at once, out of order: unsolved in %d of %d rounds" %
+        (unsolved, QUEUES_KNOCK_ROUNDS))
+  ok = ok and not unsolved
+  if os.geteuid() == 0:
+    for queues in range(1, maxQueues + 1):
+      rate, solved, cpu = queuesLive(queues, seconds)
+      ok = ok and solved
+      print("%d queue(s): %.0f replies/sec, knock solved: %s, CPU s per worker: %s" %
+            (queues, rate, solved, " ".join("%.2f" % t for t in sorted(cpu.values())) or "-"))
+  return not ok and 1 or 0
+
+benchmarks = {
+  'batch': benchBatch,
+  'queues': benchQueues,
+  'shed': benchShed,
+  'retr': benchRetr,
+  'lines': benchLines,
+  'pool': benchPool,
+  'startup': benchStartup,
+  'traffic': benchTraffic,
+  'links': benchLinks,
+  'record': benchRecord,
+  'metrics': benchMetrics,
+  'topology': benchTopology,
+  'profile': benchProfile,
+  'replay': benchReplay,
+  'scan': benchScan,
+  'flows': benchFlows,
+  'cam': benchCam,
+  'classify': benchClassify,
+  'replies': benchReplies,
+  'sessions': benchSessions,
+  'shards': benchShards,
+}
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+    print("Usage: python benchmark.py [%s] [args...]" % '|'.join(sorted(benchmarks)))
+    sys.exit(2)
+  sys.exit(benchmarks[sys.argv[1]](sys.argv[2:]))
@@ -0,0 +1,257 @@
+#
+# Windowed bulk TCP sender for scapyHunt.py
+#
+# Streams files (ie, what RETR retrieves from the FTP server) down a service's
+# connection the way a TCP sender would, so a file isn't limited to what fits in
+# one segment:
+#  - the file is cut into segments of the client's MSS, each built straight from
+#    the file's FileImage (a read-only mmap, shared by every session and every
+#    forked process), so the only copy made is into the outgoing frame
+#  - no more than the client's advertised window (or MAX_FLIGHT) is in flight; each
+#    ACK slides the window on and sends whatever fits in it now (ACK clocking)
+#  - DUPACKS duplicate ACKs resend the first unacknowledged segment (fast
+#    retransmit); until everything sent before it is acked, each ACK that still
+#    leaves a hole resends the next one (NewReno's partial ACKs) and nothing new is
+#    sent
+#  - when the ACKs stop making progress for an RTO, sending goes back to the first
+#    unacknowledged byte (go-back-N), doubling the RTO each time, and the connection
+#    is reset after MAX_RETRIES timeouts in a row. A client that keeps answering
+#    with a closed window is probed without being given up on.
+# Whatever the service sends while a file is being streamed (ie, the 226 after it)
+# is queued behind it on the same sender, so the stream stays in order.
+#
+# The one's complement sums of a file's MSS-sized chunks are worked out once per
+# image and MSS, and reused by every transfer and retransmission, so a segment's
+# checksum only sums its headers (see replyEngine.tcpSegment).
+#
+
+import bisect
+import mmap
+import os
+
+import replyEngine
+from timingWheel import sessionWheel
+
+# Retransmission timeout (seconds): to start with, and the most it backs off to
+RTO_MIN = 0.2
+RTO_MAX = 3.0
+# Timeouts in a row without progress before the connection is reset
+MAX_RETRIES = 8
+# Duplicate ACKs taken as a lost segment
+DUPACKS = 3
+# Most bytes in flight at once, whatever the window (bounds the writer's queue)
+MAX_FLIGHT = 256 << 10
+
+# A file served by the services
+class FileImage(object):
+  __slots__ = ("name", "data", "size", "sums")
+
+  # data - the file's contents, as bytes or an mmap (see openImage)
+  def __init__(self, name, data):
+    self.name = name
+    self.data = memoryview(data)
+    self.size = len(data)
+    # MSS -> onesSum of each MSS-sized chunk
+    self.sums = dict()
+
+  # The onesSum (see replyEngine.py) of each mss-sized chunk of the file
+  def chunkSums(self, mss):
+    sums = self.sums.get(mss)
+    if sums is None:
+      data = self.data
+      sums = [replyEngine.onesSum(data[i:i + mss]) for i in range(0, self.size, mss)]
+      self.sums[mss] = sums
+    return sums
+
+# Maps a file into a FileImage (read-only, so every process shares its pages)
+def openImage(path):
+  name = os.path.basename(path)
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return FileImage(name, b"")
+    return FileImage(name, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+class BulkSender(object):
+
+  # Sends on the established flow of the session, from its next sequence number on
+  def __init__(self, session, flow):
+    self.session = session
+    self.flow = flow
+    # Sequence number of the first byte sent; everything else is kept as offsets
+    #  from it
+    self.iss = flow.sndNxt
+    # What is queued: (offset, data, chunk sums or None) per part, and the offset of
+    #  each part (to find the part an offset falls in)
+    self.parts = []
+    self.starts = []
+    self.end = 0
+    # First byte not acknowledged yet, next byte to send, and the highest byte sent
+    self.una = 0
+    self.nxt = 0
+    self.sent = 0
+    self.rto = RTO_MIN
+    self.retries = 0
+    self.heard = False
+    # Duplicate ACKs in a row, and while recovering from a loss, the highest byte
+    #  sent when it was found (None otherwise)
+    self.dupacks = 0
+    self.recover = None
+    self.finished = False
+    self.timer = False
+
+    # Accounting
+    #  segments    - segments sent, including retransmissions
+    #  retransmits - segments sent again
+    #  fastRetransmits - losses found from duplicate ACKs
+    #  timeouts    - times the RTO expired without progress
+    self.segments = 0
+    self.retransmits = 0
+    self.fastRetransmits = 0
+    self.timeouts = 0
+
+  # Queues a file (a FileImage) to be sent
+  def sendImage(self, image):
+    self.append(image.data, image.chunkSums(self.flow.mss))
+
+  # Queues a payload to be sent
+  def send(self, payload):
+    self.append(memoryview(payload), None)
+
+  def append(self, data, sums):
+    if not len(data):
+      return
+    self.parts.append((self.end, data, sums))
+    self.starts.append(self.end)
+    self.end += len(data)
+    self.pump()
+    if not self.timer:
+      self.timer = True
+      sessionWheel(self.session).spawn(self.retransmitTimer())
+
+  # Length of the segment starting at offset nxt: up to the end of its MSS-sized
+  #  chunk, or of its part
+  def segmentLength(self, nxt):
+    start, data, sums = self.parts[bisect.bisect_right(self.starts, nxt) - 1]
+    offset = nxt - start
+    return min(self.flow.mss - offset % self.flow.mss, len(data) - offset)
+
+  # Sends length bytes from offset nxt as one segment. Returns False if the writer
+  #  had no room for it.
+  def transmit(self, nxt, length):
+    flow = self.flow
+    mss = flow.mss
+    start, data, sums = self.parts[bisect.bisect_right(self.starts, nxt) - 1]
+    offset = nxt - start
+    payloadSum = None
+    if sums is not None and not offset % mss and length == min(mss, len(data) - offset):
+      payloadSum = sums[offset // mss]
+    flags = 0x010 # ACK, and PSH at the end of each part
+    if offset + length == len(data):
+      flags = 0x018
+    segment = replyEngine.tcpSegment(flow.peer, self.iss + nxt, flow.seq, flags,
+                                     data[offset:offset + length], payloadSum)
+    if not self.session.writer.write(segment):
+      return False
+    self.segments += 1
+    if nxt < self.sent:
+      self.retransmits += 1
+    if nxt + length > self.sent:
+      self.sent = nxt + length
+      flow.sndNxt = (self.iss + self.sent) & 0xffffffff
+    return True
+
+  # Sends what the window allows (nothing new while recovering from a loss)
+  def pump(self):
+    if self.recover is not None:
+      return
+    limit = self.una + min(self.flow.window, MAX_FLIGHT)
+    while self.nxt < self.end:
+      nxt = self.nxt
+      length = self.segmentLength(nxt)
+      if nxt + length > limit:
+        # Only part of the segment fits: wait for the window to open, unless
+        #  nothing is in flight to open it
+        if nxt > self.una or nxt >= limit:
+          break
+        length = limit - nxt
+      if not self.transmit(nxt, length):
+        break
+      self.nxt = nxt + length
+
+  # Sends the first unacknowledged segment again, even into a closed window (as a
+  #  probe)
+  def resend(self):
+    una = self.una
+    length = self.segmentLength(una)
+    if self.transmit(una, length) and self.nxt < una + length:
+      self.nxt = una + length
+
+  # Takes in the ack and window of a segment just received on the flow
+  def acked(self):
+    self.heard = True
+    acked = (self.flow.ack - self.iss) & 0xffffffff
+    if self.una < acked <= self.sent:
+      self.una = acked
+      self.dupacks = 0
+      if self.nxt < acked:
+        self.nxt = acked
+      if acked == self.end:
+        self.finish()
+        return
+      if self.recover is not None:
+        if acked < self.recover:
+          self.resend()
+          return
+        self.recover = None
+    elif acked == self.una and self.una < self.sent:
+      self.dupacks += 1
+      if self.dupacks == DUPACKS and self.recover is None:
+        self.fastRetransmits += 1
+        self.recover = self.sent
+        self.resend()
+        return
+    self.pump()
+
+  # Everything was acknowledged: the flow sends directly again
+  def finish(self):
+    self.finished = True
+    if self.flow.sender is self:
+      self.flow.sender = None
+
+  def stop(self):
+    self.finished = True
+
+  # Goes back to the first unacknowledged byte whenever an RTO passes without the
+  #  ACKs making progress (yields its delay to the session's timing wheel, see
+  #  timingWheel.py)
+  def retransmitTimer(self):
+    while not self.finished:
+      una = self.una
+      yield self.rto
+      if self.finished:
+        return
+      session = self.session
+      flow = self.flow
+      if not session.flows.tracked(flow):
+        self.stop()
+        return
+      heard, self.heard = self.heard, False
+      if self.una != una:
+        self.rto = RTO_MIN
+        self.retries = 0
+        continue
+      self.recover = None
+      self.dupacks = 0
+      # A client still answering with a closed window is only probed
+      if not heard or flow.window:
+        self.timeouts += 1
+        self.retries += 1
+        if self.retries > MAX_RETRIES:
+          session.writer.write(replyEngine.tcpSegment(flow.peer, self.iss + self.una, flow.seq,
+                                                      0x014, b""))
+          session.flows.close(flow)
+          return
+        self.rto = min(self.rto * 2, RTO_MAX)
+      self.nxt = self.una
+      self.resend()
+      self.pump()
@@ -0,0 +1,64 @@
+#
+# Simulated switch CAM table for scapyHunt.py
+#
+# A bounded map from source MAC to (port, last seen), kept in last-seen order so
+# both refreshing an entry and aging out the oldest ones are O(1). Once the table
+# is full, new MACs are not learned; the switch overflows and floods everything
+# (hub mode) until enough entries age out for it to learn again.
+#
+
+import collections
+import time
+
+class CamTable(object):
+
+  # capacity - the most MACs the switch can learn
+  # aging    - seconds an entry lives without its MAC being seen again
+  def __init__(self, capacity=1024, aging=300.0, clock=time.monotonic):
+    self.capacity = capacity
+    self.aging = aging
+    self.clock = clock
+    self.entries = collections.OrderedDict()
+    # True from the first MAC refused on a full table until entries age out
+    self.overflowed = False
+    # MACs that could not be learned because the table was full
+    self.overflows = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  # Learns (or refreshes) a source MAC seen on the given port
+  def learn(self, mac, port=0):
+    entries = self.entries
+    now = self.clock()
+    if mac in entries:
+      entries.move_to_end(mac)
+    elif len(entries) >= self.capacity and not self.expire(now):
+      self.overflows += 1
+      self.overflowed = True
+      return
+    entries[mac] = (port, now)
+
+  # Drops every entry older than the aging time. Returns True if there is room for
+  #  a new entry afterwards (which also ends an overflow).
+  def expire(self, now=None):
+    if now is None:
+      now = self.clock()
+    entries = self.entries
+    oldest = now - self.aging
+    while entries:
+      mac, (port, seen) = next(iter(entries.items()))
+      if seen > oldest:
+        break
+      del entries[mac]
+    if len(entries) < self.capacity:
+      self.overflowed = False
+      return True
+    return False
+
+  # Port a MAC was learned on, or None
+  def lookup(self, mac):
+    entry = self.entries.get(mac)
+    if entry is None:
+      return None
+    return entry[0]
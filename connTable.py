@@ -0,0 +1,168 @@
+#
+# Per-flow TCP connection table for scapyHunt.py
+#
+# Every TCP connection to a simulated service gets its own Flow, keyed by its
+# 4-tuple packed into one int (see flowKey), so the handshake, the sequence numbers
+# and the service's state (ie, who is logged in to the FTP server) of one connection
+# can't be touched by another one, or by a port scan.
+#
+# Like the CAM table (camTable.py) the flows are kept in last-seen order, so a lookup
+# is O(1) and idle flows are aged out from the front. The table is bounded: opening
+# a flow on a full table first ages out idle flows, then evicts the least recently
+# used one.
+#
+
+import collections
+import struct
+import time
+
+from fastPath import tcpOptions
+
+# Flow states (from the simulated server's side)
+FLOW_SYN_RCVD = 0     # SYN-ACK sent, waiting for the handshake's ACK
+FLOW_ESTABLISHED = 1  # banner sent, service commands are answered
+
+# TCP options read from a SYN (echoed back by the SYN-ACK, see tcpReply, so both
+#  ends agree on them)
+OPT_MSS = 2
+OPT_WSCALE = 3
+# MSS assumed when a SYN has no MSS option (RFC 879), and the largest used (the
+#  taps have an MTU of 1500)
+DEFAULT_MSS = 536
+MAX_MSS = 1460
+
+# Packs a TCP frame's 4-tuple (see fastPath.Frame) into a flow key
+def flowKey(frame):
+  return (frame.ipSrc << 64) | (frame.ipDst << 32) | (frame.sport << 16) | frame.dport
+
+class Flow(object):
+  __slots__ = ("key", "state", "seq", "ack", "window", "mss", "windowShift",
+               "sndNxt", "peer", "lines", "sender", "lastSeen",
+               "user", "userEntered", "passEntered")
+
+  def __init__(self, key, seq, now, mss=DEFAULT_MSS, windowShift=0):
+    self.key = key
+    self.state = FLOW_SYN_RCVD
+    # Next sequence number expected from the client, and the last one it acked
+    self.seq = seq
+    self.ack = 0
+    # The client's receive window (in bytes, scaled by windowShift) as last
+    #  advertised, and the largest segment it takes
+    self.window = 0
+    self.mss = mss
+    self.windowShift = windowShift
+    # Once established: the next sequence number the service sends, the
+    #  addresses its segments go to (see replyEngine.servicePeer) and the client's
+    #  stream reassembled into lines (see lineBuffer.py)
+    self.sndNxt = 0
+    self.peer = None
+    self.lines = None
+    # The BulkSender streaming a file down the connection (see bulkSender.py), if any
+    self.sender = None
+    self.lastSeen = now
+    # Service state (FTP login)
+    self.user = None
+    self.userEntered = False
+    self.passEntered = False
+
+  # Records the client's ack and window of a frame received on the flow
+  def update(self, frame, now):
+    self.ack = frame.ack
+    self.window = frame.window << self.windowShift
+    self.lastSeen = now
+
+  # The part of a segment's payload that continues the client's stream (advancing
+  #  seq past it): empty for a retransmission of data already received, None for a
+  #  segment starting beyond seq (after a gap), which is left for the client to resend
+  def receive(self, seq, payload):
+    offset = (self.seq - seq) & 0xffffffff
+    if offset & 0x80000000:
+      return None
+    if offset >= len(payload):
+      return payload[:0]
+    self.seq = (seq + len(payload)) & 0xffffffff
+    return payload[offset:]
+
+class ConnTable(object):
+
+  # capacity - the most flows tracked at once
+  # idle     - seconds a flow lives without traffic
+  def __init__(self, capacity=256, idle=120.0, clock=time.monotonic):
+    self.capacity = capacity
+    self.idle = idle
+    self.clock = clock
+    self.flows = collections.OrderedDict()
+    # Flows dropped to make room for new ones, before they were idle
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.flows)
+
+  # Starts tracking the connection a SYN opens, replacing any earlier flow on the
+  #  same 4-tuple
+  def open(self, frame):
+    flows = self.flows
+    key = flowKey(frame)
+    now = self.clock()
+    if key in flows:
+      del flows[key]
+    elif len(flows) >= self.capacity and not self.expire(now):
+      flows.popitem(last=False)
+      self.evictions += 1
+    options = tcpOptions(frame)
+    mss = DEFAULT_MSS
+    if len(options.get(OPT_MSS, b"")) == 2:
+      mss = min(struct.unpack("!H", options[OPT_MSS])[0], MAX_MSS) or DEFAULT_MSS
+    windowShift = 0
+    if len(options.get(OPT_WSCALE, b"")) == 1:
+      windowShift = min(options[OPT_WSCALE][0], 14)
+    flow = Flow(key, (frame.seq + 1) & 0xffffffff, now, mss, windowShift)
+    flows[key] = flow
+    return flow
+
+  # The flow a frame belongs to (refreshed with the frame's sequence numbers), or None
+  def lookup(self, frame):
+    flows = self.flows
+    key = flowKey(frame)
+    flow = flows.get(key)
+    if flow is None:
+      return None
+    now = self.clock()
+    if now - flow.lastSeen > self.idle:
+      del flows[key]
+      return None
+    flows.move_to_end(key)
+    flow.update(frame, now)
+    return flow
+
+  def close(self, flow):
+    self.flows.pop(flow.key, None)
+    if flow.sender is not None:
+      flow.sender.stop()
+
+  # Is the flow still in the table (not closed, replaced, expired or evicted)?
+  def tracked(self, flow):
+    return self.flows.get(flow.key) is flow
+
+  # Drops every flow idle for longer than the idle timeout. Returns True if there is
+  #  room for a new flow afterwards.
+  def expire(self, now=None):
+    if now is None:
+      now = self.clock()
+    flows = self.flows
+    oldest = now - self.idle
+    while flows:
+      key, flow = next(iter(flows.items()))
+      if flow.lastSeen > oldest:
+        break
+      del flows[key]
+    return len(flows) < self.capacity
+
+  # Is there an established flow to the given packed address and port?
+  def established(self, addr, port):
+    for flow in self.flows.values():
+      if (flow.state == FLOW_ESTABLISHED and
+          (flow.key >> 32) & 0xffffffff == addr and
+          flow.key & 0xffff == port):
+        return True
+    return False
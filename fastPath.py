@@ -0,0 +1,140 @@
+#
+# Raw-bytes frame classifier for scapyHunt.py
+#
+# Reads just enough of the Ethernet, ARP, IPv4, ICMP and TCP headers straight out
+# of the frame to decide which handler it belongs to. The handlers work from the
+# same fields, and a TCP payload is a view of the frame (frame.payload): nothing is
+# ever dissected.
+#
+
+import struct
+
+# Frame kinds
+# -----
+# FRAME_IGNORE - 802.3/truncated frames, never seen by any handler
+# FRAME_OTHER  - Ethernet II frames carrying nothing we answer (counted toward the CAM table)
+# FRAME_ARP    - ARP over Ethernet
+# FRAME_ICMP   - ICMP over IPv4 (first fragment only)
+# FRAME_TCP    - TCP over IPv4 (first fragment only)
+FRAME_IGNORE = 0
+FRAME_OTHER = 1
+FRAME_ARP = 2
+FRAME_ICMP = 3
+FRAME_TCP = 4
+
+ETH_P_IP = 0x0800
+ETH_P_ARP = 0x0806
+
+ethHeader = struct.Struct("!6s6sH")
+arpHeader = struct.Struct("!HHBBH6sI6sI")
+ipHeader = struct.Struct("!BBHHHBBHII")
+tcpHeader = struct.Struct("!HHIIBBH")
+icmpHeader = struct.Struct("!B")
+
+# Formats a 6 byte hardware address the way scapy does (lowercase, colon separated)
+def macToStr(mac):
+  return "%02x:%02x:%02x:%02x:%02x:%02x" % struct.unpack("!6B", mac)
+
+# Header fields of a single frame, pulled out without dissecting it.
+#  IPv4 addresses are kept as packed integers (see hostTable.ipToInt).
+#  Fields that do not apply to the frame's kind are left as None.
+class Frame(object):
+  __slots__ = ("data", "kind", "ethDst", "ethSrc",
+               "arpOp", "arpHwsrc", "arpPsrc", "arpPdst",
+               "ipSrc", "ipDst", "ipLen", "ipHeaderLen", "icmpType",
+               "sport", "dport", "seq", "ack", "tcpFlags", "tcpHeaderLen", "window")
+
+  def __init__(self, data):
+    self.data = data
+    self.kind = FRAME_IGNORE
+    self.ethDst = self.ethSrc = None
+    self.arpOp = self.arpHwsrc = self.arpPsrc = self.arpPdst = None
+    self.ipSrc = self.ipDst = self.ipLen = self.ipHeaderLen = self.icmpType = None
+    self.sport = self.dport = self.seq = self.ack = None
+    self.tcpFlags = self.tcpHeaderLen = self.window = None
+
+  @property
+  def macSrc(self):
+    return macToStr(self.ethSrc)
+
+  @property
+  def macDst(self):
+    return macToStr(self.ethDst)
+
+  # Length of the TCP payload, excluding any Ethernet padding
+  @property
+  def payloadLen(self):
+    end = min(14 + self.ipLen, len(self.data))
+    return max(0, end - 14 - self.ipHeaderLen - self.tcpHeaderLen)
+
+  # The TCP payload (a view of the frame, so only valid while the frame is)
+  @property
+  def payload(self):
+    start = 14 + self.ipHeaderLen + self.tcpHeaderLen
+    return memoryview(self.data)[start:max(start, min(14 + self.ipLen, len(self.data)))]
+
+# The options of a TCP frame, as a dictionary of kind -> value bytes (ie, a SYN's
+#  MSS and window scale). Stops at the first malformed option.
+def tcpOptions(frame):
+  data = frame.data
+  offset = 14 + frame.ipHeaderLen + 20
+  end = min(offset - 20 + frame.tcpHeaderLen, len(data))
+  options = dict()
+  while offset < end:
+    kind = data[offset]
+    if kind == 0:   # End of options
+      break
+    if kind == 1:   # NOP
+      offset += 1
+      continue
+    if offset + 1 >= end or data[offset + 1] < 2 or offset + data[offset + 1] > end:
+      break
+    options[kind] = bytes(data[offset + 2:offset + data[offset + 1]])
+    offset += data[offset + 1]
+  return options
+
+# Classifies a raw Ethernet frame, mirroring how scapy would have dissected it:
+#  - EtherType <= 1500 is 802.3 (scapy's Dot3), which the game never answered
+#  - non-zero fragment offsets leave the IP payload undissected
+def parseFrame(data):
+  frame = Frame(data)
+  size = len(data)
+  if size < 14:
+    return frame
+  frame.ethDst, frame.ethSrc, etherType = ethHeader.unpack_from(data, 0)
+  if etherType <= 1500:
+    return frame
+  frame.kind = FRAME_OTHER
+
+  if etherType == ETH_P_ARP:
+    if size < 42:
+      return frame
+    (hwtype, ptype, hwlen, plen, frame.arpOp, frame.arpHwsrc,
+        frame.arpPsrc, hwdst, frame.arpPdst) = arpHeader.unpack_from(data, 14)
+    if hwlen != 6 or plen != 4:
+      return frame
+    frame.kind = FRAME_ARP
+
+  elif etherType == ETH_P_IP:
+    if size < 34:
+      return frame
+    (verIhl, tos, ipLen, ipId, frag, ttl, proto,
+        chksum, frame.ipSrc, frame.ipDst) = ipHeader.unpack_from(data, 14)
+    ihl = (verIhl & 0x0f) * 4
+    if verIhl >> 4 != 4 or ihl < 20 or frag & 0x1fff:
+      return frame
+    frame.ipLen = ipLen
+    frame.ipHeaderLen = ihl
+    offset = 14 + ihl
+
+    if proto == 1 and size >= offset + 4:
+      frame.icmpType, = icmpHeader.unpack_from(data, offset)
+      frame.kind = FRAME_ICMP
+    elif proto == 6 and size >= offset + 20:
+      (frame.sport, frame.dport, frame.seq, frame.ack,
+          offsetByte, flagsByte, frame.window) = tcpHeader.unpack_from(data, offset)
+      frame.tcpHeaderLen = (offsetByte >> 4) * 4
+      frame.tcpFlags = ((offsetByte & 0x01) << 8) | flagsByte
+      frame.kind = FRAME_TCP
+
+  return frame
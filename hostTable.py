@@ -0,0 +1,153 @@
+#
+# Host registry for scapyHunt.py
+#
+# The simulated hosts are declared as data and compiled once at startup into a
+# table keyed by packed IPv4 address, so dispatching a frame is a single dict
+# lookup on the integer straight out of the header.
+#
+# Larger networks are declared as CIDR ranges of hosts all alike (see HostRange):
+# one shared PortIndex for the whole range, and a MAC made from each host's address.
+# Their Host entries are only made when a frame first reaches them, and only the
+# most recently made RANGE_CACHE are kept, so a sweep of a /16 doesn't grow the
+# table by a host per address (see HostStore).
+#
+
+import socket
+import struct
+
+from portIndex import PortIndex
+
+# Packs a dotted-quad IPv4 address into an integer
+def ipToInt(ip):
+  return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+# Unpacks an integer IPv4 address into dotted-quad notation
+def intToIp(addr):
+  return socket.inet_ntoa(struct.pack("!I", addr))
+
+# A single simulated host
+#  ip       - dotted-quad address (key into clients/internalClients/openPorts)
+#  addr     - packed address (key into the compiled table)
+#  internal - True if the host sits behind the 10.5.0.35 gateway
+#  handler  - function(session, frame, host) answering frames sent to this host
+#  ports    - PortIndex of open/filtered/closed ports, shared with openPorts[ip]
+#  synHooks - ports whose SYNs the handler has to see; SYNs to any other port are
+#             answered straight from the port index (None - the handler sees every SYN)
+#  mac      - the host's MAC, for a host of a HostRange (None - it is in the session's
+#             clients/internalClients, and changes with an ARP spoof)
+#  arpTemplate/arpTemplateMAC - pre-assembled ARP is-at reply, and the MAC it was built for
+class Host(object):
+  __slots__ = ("ip", "addr", "internal", "handler", "ports", "synHooks", "mac",
+               "arpTemplate", "arpTemplateMAC")
+
+  def __init__(self, ip, internal, handler, ports, synHooks, mac=None):
+    self.ip = ip
+    self.addr = ipToInt(ip)
+    self.internal = internal
+    self.handler = handler
+    self.ports = ports
+    self.synHooks = synHooks
+    self.mac = mac
+    self.arpTemplate = None
+    self.arpTemplateMAC = None
+
+# Range hosts' Host entries kept by a HostStore at once
+RANGE_CACHE = 4096
+
+# The SYN hooks of a range's hosts: their handlers never need to see a SYN
+NO_HOOKS = frozenset()
+
+# Every address of a CIDR block but its network and broadcast addresses, as hosts
+#  alike but for their addresses and MACs
+#  cidr      - ie "10.5.0.0/16"
+#  internal  - True if the hosts sit behind the 10.5.0.35 gateway
+#  handler   - function(session, frame, host) answering frames sent to any of them
+#  ports     - PortIndex shared by all of them (their port profile)
+#  macPrefix - first three bytes of their MACs, ie "12:67:7f"; the rest are the low
+#              three bytes of the host's address
+class HostRange(object):
+  __slots__ = ("cidr", "net", "mask", "broadcast", "internal", "handler", "ports",
+               "macPrefix")
+
+  def __init__(self, cidr, internal, handler, ports, macPrefix):
+    network, prefixLen = cidr.split("/")
+    self.cidr = cidr
+    self.mask = (0xffffffff << (32 - int(prefixLen))) & 0xffffffff
+    self.net = ipToInt(network) & self.mask
+    self.broadcast = self.net | (~self.mask & 0xffffffff)
+    self.internal = internal
+    self.handler = handler
+    self.ports = ports
+    self.macPrefix = macPrefix
+
+  def __contains__(self, addr):
+    return addr & self.mask == self.net and addr != self.net and addr != self.broadcast
+
+  def __len__(self):
+    return max(0, self.broadcast - self.net - 1)
+
+  # The MAC of the host at addr
+  def mac(self, addr):
+    return "%s:%02x:%02x:%02x" % (self.macPrefix, (addr >> 16) & 0xff, (addr >> 8) & 0xff, addr & 0xff)
+
+  def host(self, addr):
+    return Host(intToIp(addr), self.internal, self.handler, self.ports, NO_HOOKS, self.mac(addr))
+
+# The host table of a session with host ranges: the declared hosts are its entries,
+#  as in a plain table, and get/'in' also find the hosts of the ranges (the declared
+#  hosts first, then the ranges in order). Iterating over it only gives the
+#  declared hosts.
+#  reserved - addresses in the ranges that aren't hosts (ie, the player's own)
+class HostStore(dict):
+
+  def __init__(self, hosts, ranges, reserved=()):
+    dict.__init__(self, hosts)
+    self.ranges = ranges
+    self.reserved = frozenset(reserved)
+    # Packed address -> Host of the range hosts made most recently
+    self.cache = dict()
+
+  # The range holding a host at addr, or None
+  def rangeFor(self, addr):
+    if addr in self.reserved:
+      return None
+    for hostRange in self.ranges:
+      if addr in hostRange:
+        return hostRange
+    return None
+
+  def get(self, addr, default=None):
+    host = dict.get(self, addr)
+    if host is not None:
+      return host
+    cache = self.cache
+    host = cache.get(addr)
+    if host is not None:
+      return host
+    hostRange = self.rangeFor(addr)
+    if hostRange is None:
+      return default
+    if len(cache) >= RANGE_CACHE:
+      del cache[next(iter(cache))]
+    host = cache[addr] = hostRange.host(addr)
+    return host
+
+  def __contains__(self, addr):
+    return dict.__contains__(self, addr) or self.rangeFor(addr) is not None
+
+# Compiles a list of (ip, internal, handler, open ports, filtered ports, SYN hooks)
+#  declarations into a table mapping packed addresses to Host objects. With any
+#  (cidr, internal, handler, open ports, filtered ports, MAC prefix) range
+#  declarations, the table is a HostStore that also holds the ranges' hosts.
+def compileHosts(declarations, ranges=(), reserved=()):
+  table = dict()
+  for ip, internal, handler, ports, filtered, synHooks in declarations:
+    if synHooks is not None:
+      synHooks = frozenset(synHooks)
+    host = Host(ip, internal, handler, PortIndex(ports, filtered), synHooks)
+    table[host.addr] = host
+  if not ranges:
+    return table
+  return HostStore(table, [HostRange(cidr, internal, handler, PortIndex(ports, filtered), macPrefix)
+                           for cidr, internal, handler, ports, filtered, macPrefix in ranges],
+                   reserved)
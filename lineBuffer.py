@@ -0,0 +1,66 @@
+#
+# Line reassembly for the line-based services (SMTP/FTP) in scapyHunt.py
+#
+# Each service connection has a LineBuffer taking the in-order bytes of its TCP
+# stream (see connTable.Flow.receive) as they arrive, in whatever segments they
+# came in, and handing back the complete command lines: a command split over
+# several segments comes out once its line ending arrives, and several commands
+# pipelined in one segment come out one by one.
+#
+# Segments are appended to one buffer, and only the part not searched yet is
+# searched for line endings. Consumed lines are removed from the front only once
+# they make up half the buffer (or all of it), so a segment costs its own length
+# rather than a copy of everything buffered.
+#
+
+# Longest line kept waiting for its ending; anything longer is taken as a line as it is
+MAX_LINE = 4096
+
+class LineBuffer(object):
+  __slots__ = ("buf", "start", "received")
+
+  def __init__(self):
+    self.buf = bytearray()
+    # Where the first unconsumed line starts
+    self.start = 0
+    # Bytes pushed so far (also tells whether anything arrived since some point)
+    self.received = 0
+
+  # Bytes of an unfinished line waiting for its ending
+  @property
+  def pending(self):
+    return len(self.buf) - self.start
+
+  # Adds data from the stream, returning the lines it completed (as str, without
+  #  their line endings)
+  def push(self, data):
+    buf = self.buf
+    searched = len(buf)
+    buf += data
+    self.received += len(data)
+    start = self.start
+    lines = []
+    end = buf.find(b"\n", searched)
+    while end >= 0:
+      lines.append(buf[start:end].decode("latin-1").rstrip("\r"))
+      start = end + 1
+      end = buf.find(b"\n", start)
+    if len(buf) - start > MAX_LINE:
+      lines.append(buf[start:].decode("latin-1"))
+      start = len(buf)
+
+    if start == len(buf):
+      del buf[:]
+      start = 0
+    elif start > len(buf) // 2:
+      del buf[:start]
+      start = 0
+    self.start = start
+    return lines
+
+  # Takes whatever is waiting as a line of its own, even without a line ending
+  def flush(self):
+    line = self.buf[self.start:].decode("latin-1").rstrip("\r")
+    del self.buf[:]
+    self.start = 0
+    return line
@@ -0,0 +1,111 @@
+#
+# Link emulation for scapyHunt.py
+#
+# Without it every reply goes out the moment it is made. A Link gives the hosts of
+# a network the latency, jitter and loss of a real one (ie, the 10.1.8.0/24 network
+# behind the 10.5.0.35 gateway): every frame one of them sends is lost with the
+# link's loss rate, or held back for the link's latency, give or take up to its
+# jitter, on the session's timing wheel (see timingWheel.py), which releases it
+# to the tap with whatever else is due on the same tick. As on a real link with
+# jitter, frames can arrive in a different order than they were sent.
+#
+# A Link delays what its hosts send to the player, so its latency is what it adds to
+# the player's round trips. Frames of hosts on no link are written at once.
+#
+
+import random
+import struct
+
+from hostTable import ipToInt
+from timingWheel import sessionWheel
+
+address = struct.Struct("!I")
+
+# Offsets of the sender's address in an IPv4 frame, and in an ARP frame
+IP_SRC_OFFSET = 26
+ARP_SRC_OFFSET = 28
+
+# Parses a --link, CIDR=LATENCY[:JITTER[:LOSS]] (milliseconds, milliseconds and
+#  percent), into a Link
+def parseLink(text):
+  cidr, sep, value = text.partition("=")
+  network, slash, prefixLen = cidr.partition("/")
+  fields = value.split(":")
+  try:
+    if not sep or not slash or len(fields) > 3 or not 0 <= int(prefixLen) <= 32:
+      raise ValueError
+    ipToInt(network)
+    latency, jitter, loss = [float(field) for field in fields] + [0.0] * (3 - len(fields))
+  except (ValueError, OSError):
+    raise ValueError("link should be CIDR=LATENCY[:JITTER[:LOSS]], not %r" % text)
+  if latency < 0 or jitter < 0 or not 0 <= loss <= 100:
+    raise ValueError("link %r needs a latency and jitter >= 0 and a loss from 0 to 100%%" % text)
+  return Link(cidr, latency / 1000.0, jitter / 1000.0, loss / 100.0)
+
+# The hosts of a CIDR block, and what their frames go through
+#  latency - seconds each frame is held back
+#  jitter  - most seconds a frame's delay is off the latency, either way
+#  loss    - probability a frame is lost
+class Link(object):
+  __slots__ = ("cidr", "net", "mask", "latency", "jitter", "loss")
+
+  def __init__(self, cidr, latency, jitter=0.0, loss=0.0):
+    network, prefixLen = cidr.split("/")
+    self.cidr = cidr
+    self.mask = (0xffffffff << (32 - int(prefixLen))) & 0xffffffff
+    self.net = ipToInt(network) & self.mask
+    self.latency = latency
+    self.jitter = jitter
+    self.loss = loss
+
+# Holds back the frames of a session's hosts on links (installed as its writer's
+#  link, see tapWriter.py)
+class LinkEmulator(object):
+
+  # links - the Links, the first matching a host's address applying to it
+  def __init__(self, session, links, rng=None):
+    self.session = session
+    self.links = links
+    self.random = rng or random.Random()
+
+    # Accounting
+    #  delayed - frames held back and released later
+    #  lost    - frames lost
+    self.delayed = 0
+    self.lost = 0
+
+  # The link the frame's sender is on, or None
+  def linkOf(self, frame):
+    if frame[12:14] == b"\x08\x00":
+      offset = IP_SRC_OFFSET
+    elif frame[12:14] == b"\x08\x06":
+      offset = ARP_SRC_OFFSET
+    else:
+      return None
+    addr = address.unpack_from(frame, offset)[0]
+    for link in self.links:
+      if addr & link.mask == link.net:
+        return link
+    return None
+
+  # Takes the frame if its sender is on a link, to lose it or release it later.
+  #  Returns False if it is to be written now.
+  def hold(self, frame):
+    link = self.linkOf(frame)
+    if link is None:
+      return False
+    rng = self.random
+    if link.loss and rng.random() < link.loss:
+      self.lost += 1
+      return True
+    delay = link.latency
+    if link.jitter:
+      delay = max(0.0, delay + rng.uniform(-link.jitter, link.jitter))
+    self.delayed += 1
+    sessionWheel(self.session).send(delay, frame)
+    return True
+
+  # The frames not taken by hold, in order
+  def holdMany(self, frames):
+    hold = self.hold
+    return [frame for frame in frames if not hold(frame)]
@@ -0,0 +1,153 @@
+#
+# Instrumentation for scapyHunt.py
+#
+# Counters and latency histograms for the handlers and reply builders, tap traffic
+# and each player's progress, dumped to a JSON stats file by a background thread.
+# The file is replaced atomically, so it can be scraped at any time without
+# involving the packet loop.
+#
+# The timing is only on the packet path when it is switched on (--stats): turning it
+# on wraps the instrumented functions (see scapyHunt.enableMetrics), so there are
+# no 'if enabled' checks for frames to pay when it is off. Frame and byte counts
+# are plain counters kept by the sessions and taps all the time.
+#
+
+import json
+import os
+import threading
+import time
+
+from admission import ADMIT_NAMES
+
+# Latency histograms have fixed power-of-two buckets: bucket i counts the calls that
+#  took [2^(i-1), 2^i) ns, which is just the bit length of the time in ns.
+BUCKETS = 64
+
+# Names of the entries of Session.frameCounts: frames of each fastPath kind that
+#  reached processPacket, then frames answered by the scan fast path
+FRAME_COUNT_NAMES = ("ignore", "other", "arp", "icmp", "tcp", "scan")
+
+class Histogram(object):
+  __slots__ = ("counts", "total")
+
+  def __init__(self):
+    self.counts = [0] * BUCKETS
+    # Total time (ns)
+    self.total = 0
+
+  def add(self, ns):
+    self.counts[ns.bit_length()] += 1
+    self.total += ns
+
+  # Upper bound (ns) of the bucket holding the given fraction of the calls
+  def percentile(self, fraction):
+    target = sum(self.counts) * fraction
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= target:
+        return 1 << i
+    return 0
+
+class Metrics(object):
+
+  def __init__(self):
+    # Name -> Histogram of the time spent in each handler/builder (which also
+    #  counts the calls)
+    self.latency = dict()
+    # Player's interface -> {progress marker: time first reached}
+    self.progress = dict()
+    self.started = time.time()
+
+  # Wraps fn so that every call is counted and timed under name
+  def timed(self, name, fn):
+    histogram = self.latency.setdefault(name, Histogram())
+    counts = histogram.counts
+    clock = time.perf_counter_ns
+    def wrapper(*args):
+      start = clock()
+      result = fn(*args)
+      ns = clock() - start
+      counts[ns.bit_length()] += 1
+      histogram.total += ns
+      return result
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+  # Records the first time a player reaches a step of the game
+  def mark(self, session, marker):
+    markers = self.progress.setdefault(session.ifname, dict())
+    if marker not in markers:
+      markers[marker] = time.time()
+
+  # Everything as a JSON-ready dict. sessions gives the tap readers/writers and
+  #  the per-protocol frame counts (see Session.frameCounts).
+  def snapshot(self, sessions):
+    taps = dict()
+    for session in sessions:
+      reader = session.reader
+      writer = session.writer
+      taps[session.ifname] = {
+        "framesIn": reader.frames, "bytesIn": reader.bytes, "droppedIn": reader.totalDropped,
+        "framesOut": writer.frames, "bytesOut": writer.bytes, "droppedOut": writer.dropped,
+        "writeErrors": writer.errors, "writeQueueMax": writer.maxDepth,
+        "frames": dict(zip(FRAME_COUNT_NAMES, session.frameCounts)),
+      }
+      admission = session.admission
+      if admission is not None:
+        taps[session.ifname]["passed"] = admission.passed
+        taps[session.ifname]["admitted"] = dict(zip(ADMIT_NAMES, admission.admitted))
+        taps[session.ifname]["shed"] = dict(zip(ADMIT_NAMES, admission.shed))
+      link = session.link
+      if link is not None:
+        taps[session.ifname]["linkDelayed"] = link.delayed
+        taps[session.ifname]["linkLost"] = link.lost
+      recorder = session.recorder
+      if recorder is not None:
+        taps[session.ifname]["recorded"] = recorder.frames
+        taps[session.ifname]["recordDropped"] = recorder.dropped
+    latency = dict()
+    for name, histogram in self.latency.items():
+      counts = list(histogram.counts)
+      calls = sum(counts)
+      while counts and not counts[-1]:
+        counts.pop()
+      latency[name] = {
+        "calls": calls,
+        "bucketsNs": counts,
+        "meanNs": histogram.total // max(1, calls),
+        "p50Ns": histogram.percentile(0.5),
+        "p99Ns": histogram.percentile(0.99),
+      }
+    return {
+      "pid": os.getpid(),
+      "uptime": time.time() - self.started,
+      "latency": latency,
+      "taps": taps,
+      "progress": dict((k, dict(v)) for k, v in self.progress.items()),
+    }
+
+  # Replaces the stats file at path with a fresh snapshot
+  def writeFile(self, path, sessions):
+    tmp = "%s.tmp" % path
+    f = open(tmp, "w")
+    try:
+      json.dump(self.snapshot(sessions), f, indent=1, sort_keys=True)
+    finally:
+      f.close()
+    os.replace(tmp, path)
+
+  # Starts a thread rewriting the stats file every interval seconds, for the
+  #  sessions in the given list (ie, runtime.sessions)
+  def start(self, path, sessions, interval=1.0):
+    def run():
+      while 1:
+        time.sleep(interval)
+        try:
+          self.writeFile(path, list(sessions))
+        except (IOError, OSError, RuntimeError):
+          pass
+    thread = threading.Thread(target=run, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,180 @@
+#
+# Multi-queue tap backend for scapyHunt.py (--queues)
+#
+# A single player's game can be served by several worker processes at once: tap0 is
+# opened with IFF_MULTI_QUEUE, once per worker (see scapyHunt.openTapQueues), and
+# the kernel hashes each flow it sends to the tap onto one of the queues. Every
+# worker runs its own Session over its queue's fd, and owns that partition of the
+# game outright:
+#  - the flows (ConnTable), whose frames all arrive on the same queue
+#  - a share of the switch's CAM table (camSize / queues), as macof's random
+#    sources are spread over the queues like everything else
+#  - its share of the background traffic once the knock is solved (see
+#    scapyHunt.applyEvent)
+# so nothing is locked on the way through the packet loop.
+#
+# What the whole game agrees on is only changed at a few steps of it, and lives in a
+# SharedState, a small anonymous shared mapping made before the workers are forked:
+#  - the knock sequence, whichever queues the knocks arrive on: each knock is a flow
+#    of its own, so two can be handled at once by two workers, and the sequence is
+#    only stepped under the state's knockLock (see scapyHunt.knockAnswer)
+#  - the visible clients' MACs (an ARP spoof seen on one queue holds on them all)
+#  - whether each partition's CAM table is overflowed; the switch is in hub mode
+#    while any of them is
+#  - the game events published (ie, the knock being solved), which each worker
+#    applies to its own partition when it next polls them (see scapyHunt.watchEvents)
+# Each field is a byte or a run of bytes only ever written whole, so a racing read
+# sees either the old value or the new one (a MAC could read torn if two spoofs of
+# the same host land at once, on two queues). Knocks reaching two queues at the same
+# moment are still taken in whichever order their workers get to them.
+#
+# Admission budgets (see admission.py) are per partition; a source whose flows
+# hash over several queues gets its budget on each.
+#
+
+import mmap
+import multiprocessing
+
+from systemGlobals import Session
+
+# Game events a SharedState holds, see scapyHunt.EVENT_*
+MAX_EVENTS = 8
+# A MAC as text, ie "12:67:7e:b7:6d:04"
+MAC_TEXT = 17
+
+KNOCK_AT = 0
+EVENTS_AT = 8
+OVERFLOWED_AT = EVENTS_AT + MAX_EVENTS
+
+# The visible clients' MACs in a SharedState, used as Session.clients
+class SharedClients(object):
+  __slots__ = ("buf", "slots")
+
+  # slots - IP -> offset of its MAC in buf
+  def __init__(self, buf, slots):
+    self.buf = buf
+    self.slots = slots
+
+  def __getitem__(self, ip):
+    at = self.slots[ip]
+    return self.buf[at:at + MAC_TEXT].decode()
+
+  def __setitem__(self, ip, mac):
+    at = self.slots[ip]
+    self.buf[at:at + MAC_TEXT] = mac.encode()
+
+  def __contains__(self, ip):
+    return ip in self.slots
+
+  def __iter__(self):
+    return iter(self.slots)
+
+  def __len__(self):
+    return len(self.slots)
+
+  def get(self, ip, default=None):
+    if ip in self.slots:
+      return self[ip]
+    return default
+
+  # Every client's MAC was set when the state was made, so this never replaces one
+  #  (ie, a worker restarting doesn't undo an ARP spoof)
+  def setdefault(self, ip, mac):
+    return self[ip]
+
+  def keys(self):
+    return self.slots.keys()
+
+  def values(self):
+    return [self[ip] for ip in self.slots]
+
+  def items(self):
+    return [(ip, self[ip]) for ip in self.slots]
+
+class SharedState(object):
+
+  # queues  - number of queues (and workers) sharing the game
+  # clients - the visible clients' initial MACs, IP -> MAC
+  def __init__(self, queues, clients):
+    self.queues = queues
+    clientsAt = OVERFLOWED_AT + queues
+    slots = dict()
+    for i, ip in enumerate(clients):
+      slots[ip] = clientsAt + i * MAC_TEXT
+    # Anonymous and shared, so every process forked from here on maps the same pages
+    self.buf = mmap.mmap(-1, clientsAt + len(slots) * MAC_TEXT)
+    self.clients = SharedClients(self.buf, slots)
+    for ip, mac in clients.items():
+      self.clients[ip] = mac
+    self.noOverflow = bytes(queues)
+    # Held while a worker steps the knock sequence (a semaphore, shared like the
+    #  mapping with the processes forked from here on)
+    self.knockLock = multiprocessing.Lock()
+
+  @property
+  def knockSequence(self):
+    return self.buf[KNOCK_AT]
+
+  @knockSequence.setter
+  def knockSequence(self, value):
+    self.buf[KNOCK_AT] = value
+
+  # Is any partition's CAM table overflowed?
+  def overflowed(self):
+    return self.buf[OVERFLOWED_AT:OVERFLOWED_AT + self.queues] != self.noOverflow
+
+  # Is the queue's partition's CAM table overflowed?
+  def isOverflowed(self, queue):
+    return self.buf[OVERFLOWED_AT + queue] != 0
+
+  def setOverflowed(self, queue, overflowed):
+    self.buf[OVERFLOWED_AT + queue] = overflowed
+
+  def publish(self, event):
+    self.buf[EVENTS_AT + event] = 1
+
+  # The events published so far
+  def published(self):
+    buf = self.buf
+    return [event for event in range(MAX_EVENTS) if buf[EVENTS_AT + event]]
+
+# A worker's partition of a game shared over the queues of a multi-queue tap: the
+#  knock sequence, clients and hub mode are read from and written to the
+#  SharedState, the rest of the session is the worker's own
+class QueueSession(Session):
+  __slots__ = ()
+
+  # queue - the partition's index (queue 0 also runs the traffic there is one of)
+  def __init__(self, ifname, fd, shared, queue):
+    # Session.__init__ gives the shared fields their initial values before shared
+    #  is set, which leaves the SharedState as it is
+    Session.__init__(self, ifname, fd)
+    self.shared = shared
+    self.queue = queue
+
+  @property
+  def knockSequence(self):
+    return self.shared.knockSequence
+
+  @knockSequence.setter
+  def knockSequence(self, value):
+    if self.shared is not None:
+      self.shared.knockSequence = value
+
+  @property
+  def clients(self):
+    return self.shared.clients
+
+  @clients.setter
+  def clients(self, value):
+    pass
+
+  # Set to this partition's CAM table state; reads as the whole switch's
+  @property
+  def hubMode(self):
+    return self.shared.overflowed()
+
+  @hubMode.setter
+  def hubMode(self, value):
+    if self.shared is not None:
+      self.shared.setOverflowed(self.queue, value)
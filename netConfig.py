@@ -0,0 +1,138 @@
+#
+# Interface configuration for scapyHunt.py
+#
+# Brings up a tap device with its hardware address, IPv4 address and routes
+# straight through the kernel's interfaces - the SIOCSIF* ioctls that ifconfig
+# uses, and an rtnetlink RTM_NEWROUTE message for what route(8) did - rather than
+# by running ifconfig and route once per setting.
+#
+
+import fcntl
+import os
+import socket
+import struct
+
+# Interface ioctls (linux/sockios.h)
+SIOCGIFFLAGS = 0x8913
+SIOCSIFFLAGS = 0x8914
+SIOCSIFADDR = 0x8916
+SIOCSIFBRDADDR = 0x891a
+SIOCSIFNETMASK = 0x891c
+SIOCSIFHWADDR = 0x8924
+
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+ARPHRD_ETHER = 1
+
+# struct ifreq (40 bytes) holding flags, an IPv4 sockaddr or a hardware sockaddr
+ifreqFlags = struct.Struct("16sH22x")
+ifreqAddr = struct.Struct("16sHH4s16x")
+ifreqHwAddr = struct.Struct("16sH6s16x")
+
+# rtnetlink (linux/netlink.h, linux/rtnetlink.h)
+NETLINK_ROUTE = 0
+RTM_NEWROUTE = 24
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RTN_UNICAST = 1
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+
+nlmsghdr = struct.Struct("=IHHII")
+rtmsg = struct.Struct("=BBBBBBBBI")
+rtattr = struct.Struct("=HH")
+nlmsgerr = struct.Struct("=i")
+
+class NetConfig(object):
+
+  def __init__(self, ifname):
+    self.ifname = ifname
+    self.name = ifname.encode()
+    # Any socket will do for the interface ioctls
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def close(self):
+    self.sock.close()
+
+  def flags(self):
+    ifreq = fcntl.ioctl(self.sock, SIOCGIFFLAGS, ifreqFlags.pack(self.name, 0))
+    return ifreqFlags.unpack(ifreq)[1]
+
+  # ifconfig <ifname> up/down
+  def setUp(self, up):
+    flags = self.flags()
+    if up:
+      flags |= IFF_UP | IFF_RUNNING
+    else:
+      flags &= ~IFF_UP
+    fcntl.ioctl(self.sock, SIOCSIFFLAGS, ifreqFlags.pack(self.name, flags))
+
+  # ifconfig <ifname> hw ether <mac>
+  def setHwAddr(self, mac):
+    hwaddr = bytes.fromhex(mac.replace(":", ""))
+    fcntl.ioctl(self.sock, SIOCSIFHWADDR, ifreqHwAddr.pack(self.name, ARPHRD_ETHER, hwaddr))
+
+  # ifconfig <ifname> <addr> netmask <netmask> broadcast <broadcast>
+  def setAddr(self, addr, netmask, broadcast):
+    for request, value in ((SIOCSIFADDR, addr), (SIOCSIFNETMASK, netmask),
+                           (SIOCSIFBRDADDR, broadcast)):
+      fcntl.ioctl(self.sock, request,
+                  ifreqAddr.pack(self.name, socket.AF_INET, 0, socket.inet_aton(value)))
+
+  # route add -net <net> netmask <netmask> gw <gateway> dev <ifname>
+  #  (without gw if gateway is None: the net is on the link)
+  def addRoute(self, net, netmask, gateway):
+    prefixLen = bin(struct.unpack("!I", socket.inet_aton(netmask))[0]).count("1")
+    attrs = rtAttr(RTA_DST, socket.inet_aton(net))
+    scope = RT_SCOPE_LINK
+    if gateway is not None:
+      attrs += rtAttr(RTA_GATEWAY, socket.inet_aton(gateway))
+      scope = RT_SCOPE_UNIVERSE
+    attrs += rtAttr(RTA_OIF, struct.pack("=i", socket.if_nametoindex(self.ifname)))
+    body = rtmsg.pack(socket.AF_INET, prefixLen, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT,
+                      scope, RTN_UNICAST, 0) + attrs
+    flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL
+    netlinkRequest(nlmsghdr.pack(nlmsghdr.size + len(body), RTM_NEWROUTE, flags, 1, 0) + body)
+
+# A route attribute, padded to 4 bytes
+def rtAttr(kind, data):
+  attr = rtattr.pack(rtattr.size + len(data), kind) + data
+  return attr + b"\x00" * (-len(attr) % 4)
+
+# Sends an rtnetlink request and waits for the kernel's acknowledgement, raising
+#  OSError if it was refused
+def netlinkRequest(message):
+  sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+  try:
+    sock.bind((0, 0))
+    sock.send(message)
+    reply = sock.recv(4096)
+  finally:
+    sock.close()
+  length, kind, flags, seq, pid = nlmsghdr.unpack_from(reply, 0)
+  if kind == NLMSG_ERROR:
+    error, = nlmsgerr.unpack_from(reply, nlmsghdr.size)
+    if error:
+      raise OSError(-error, "rtnetlink: %s" % os.strerror(-error))
+
+# Brings the interface up with the given addresses and routes (as (net, netmask,
+#  gateway or None)), replacing its earlier hardware address
+def configureTap(ifname, mac, addr, netmask, broadcast, routes=()):
+  config = NetConfig(ifname)
+  try:
+    config.setUp(False)
+    config.setHwAddr(mac)
+    config.setAddr(addr, netmask, broadcast)
+    config.setUp(True)
+    for net, routeNetmask, gateway in routes:
+      config.addRoute(net, routeNetmask, gateway)
+  finally:
+    config.close()
@@ -0,0 +1,58 @@
+#
+# Minimal libpcap file reading/writing for scapyHunt.py
+#
+# Only handles what we record ourselves: classic pcap, Ethernet link type,
+# either byte order, micro or nanosecond timestamps.
+#
+
+import struct
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+LINKTYPE_ETHERNET = 1
+
+fileHeader = struct.Struct("=IHHiIII")
+recordHeader = struct.Struct("=IIII")
+
+# Yields every frame (as bytes) stored in the pcap file at path
+def readPcap(path):
+  f = open(path, "rb")
+  try:
+    head = f.read(24)
+    magic, = struct.unpack("<I", head[:4])
+    if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+      order = "<"
+    else:
+      order = ">"
+      magic, = struct.unpack(">I", head[:4])
+      if magic not in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        raise ValueError("%s is not a pcap file" % path)
+    record = struct.Struct(order + "IIII")
+    while 1:
+      head = f.read(16)
+      if len(head) < 16:
+        return
+      sec, frac, capLen, origLen = record.unpack(head)
+      yield f.read(capLen)
+  finally:
+    f.close()
+
+# Writes the global pcap header to an open file object
+def writePcapHeader(f, snapLen=65535):
+  f.write(fileHeader.pack(PCAP_MAGIC, 2, 4, 0, 0, snapLen, LINKTYPE_ETHERNET))
+
+# Writes a single frame record to an open file object
+def writePcapRecord(f, frame, timestamp):
+  sec = int(timestamp)
+  f.write(recordHeader.pack(sec, int((timestamp - sec) * 1000000), len(frame), len(frame)))
+  f.write(frame)
+
+# Writes a list of frames to a new pcap file at path
+def writePcap(path, frames, timestamp=0.0):
+  f = open(path, "wb")
+  try:
+    writePcapHeader(f)
+    for frame in frames:
+      writePcapRecord(f, frame, timestamp)
+  finally:
+    f.close()
@@ -0,0 +1,59 @@
+#
+# Per-host port index for scapyHunt.py
+#
+# The state of all 65536 TCP ports of a host (closed, open or filtered) packed two
+# bits per port into a 16 KiB bitmap, so answering a probe is one index and shift
+# whatever the port and however many ports are open.
+#
+# Hosts are compiled once per session, so the bitmap built from a declaration is
+# shared by every session using it; a session only gets its own copy when it
+# changes a port (ie, the knock opening .6:25).
+#
+
+PORT_CLOSED = 0
+PORT_OPEN = 1
+PORT_FILTERED = 2
+
+BITMAP_SIZE = 65536 // 4
+
+# Bitmaps already built, keyed by their (open, filtered) port lists
+bitmapCache = dict()
+
+# Cache key for a list of ports (ranges are kept as they are, rather than expanded)
+def portsKey(ports):
+  if isinstance(ports, range):
+    return ports
+  return tuple(ports)
+
+# Builds (or reuses) the read-only bitmap with the given ports open and filtered
+def compileBitmap(openPorts, filteredPorts):
+  key = (portsKey(openPorts), portsKey(filteredPorts))
+  bits = bitmapCache.get(key)
+  if bits is None:
+    buf = bytearray(BITMAP_SIZE)
+    for ports, state in ((filteredPorts, PORT_FILTERED), (openPorts, PORT_OPEN)):
+      for port in ports:
+        shift = (port & 3) * 2
+        buf[port >> 2] = (buf[port >> 2] & ~(3 << shift)) | (state << shift)
+    bits = bitmapCache[key] = bytes(buf)
+  return bits
+
+class PortIndex(object):
+  __slots__ = ("bits",)
+
+  def __init__(self, openPorts=(), filteredPorts=()):
+    self.bits = compileBitmap(openPorts, filteredPorts)
+
+  def state(self, port):
+    return (self.bits[port >> 2] >> ((port & 3) * 2)) & 3
+
+  # 'port in index' is True for open ports
+  def __contains__(self, port):
+    return (self.bits[port >> 2] >> ((port & 3) * 2)) & 3 == PORT_OPEN
+
+  def setState(self, port, state):
+    bits = self.bits
+    if type(bits) is bytes:
+      bits = self.bits = bytearray(bits)
+    shift = (port & 3) * 2
+    bits[port >> 2] = (bits[port >> 2] & ~(3 << shift)) | (state << shift)
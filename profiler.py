@@ -0,0 +1,140 @@
+#
+# On-demand sampling profiler for a running scapyHunt.py
+#
+# A game that starts to lag can be profiled where it is, without restarting it and
+# losing the state that made it slow: SIGUSR2 starts a profile (see
+# scapyHunt.installProfiler), which samples the process for the set duration (or
+# until the next SIGUSR2). Samples are taken by a SIGPROF interval timer, so they
+# come every interval of CPU time the process uses (an idle game isn't sampled);
+# the duration is kept by a SIGALRM one, in real time, so a profile is written when
+# it runs out even if the game sat waiting on its tap all along.
+# The kernel only fires it on its timer tick (1/HZ, 4ms with the usual HZ=250), so
+# that is as fine as the interval gets: about 250 samples per second of CPU. Each
+# sample records the stack of every thread: the packet loop (and, on an event loop,
+# the daemons it resumes), the tap writer, the recorder and metrics threads and,
+# with ThreadRuntime, each daemon's thread. Once the profile is over the stacks are
+# written out collapsed, one line per distinct stack with how many samples it was
+# seen in:
+#
+#   MainThread;scapyHunt.py:main;runtime.py:run;scapyHunt.py:processBatch;... 42
+#
+# which flamegraph.pl (or speedscope, etc) draws as is, one tower per thread. How
+# much of the packet loop's time was spent in each host's handler (dot*/internalDot*)
+# is printed alongside.
+#
+# The timer's signal handler runs on the main thread between bytecodes, so its
+# stack is exactly where the packet loop was; a thread sampling the others instead
+# would only get the GIL where the loop gave it up, and skew the profile towards
+# those places. Nothing is armed until SIGUSR2 arrives, so until then the packet
+# path costs what it does without the profiler.
+#
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+# Prefixes of the hosts' handlers (see scapyHunt.hostDeclarations)
+HANDLER_PREFIXES = ("dot", "internalDot")
+
+class SamplingProfiler(object):
+
+  # directory - where profiles are written, as scapyhunt-<pid>-<time>.folded
+  # duration  - seconds each profile runs for, unless stopped sooner
+  # interval  - seconds of CPU time between samples (rounded up to the kernel's tick)
+  def __init__(self, directory, duration, interval=0.004):
+    self.directory = directory
+    self.duration = duration
+    self.interval = interval
+    self.stacks = None
+    self.started = 0
+    # Code object -> its frame's label in a stack, ie "scapyHunt.py:processBatch"
+    self.labels = dict()
+    # Path of the last profile written
+    self.path = None
+
+  # Starts a profile, or stops the one running (which is then written out as usual).
+  #  Must be called on the main thread (ie, from a signal handler).
+  def toggle(self):
+    if self.stacks is not None:
+      self.stop()
+      return
+    self.stacks = collections.Counter()
+    self.started = time.time()
+    signal.signal(signal.SIGPROF, self.sample)
+    signal.signal(signal.SIGALRM, self.expire)
+    signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    signal.setitimer(signal.ITIMER_REAL, self.duration)
+
+  # Disarms the timers and writes the profile out
+  def stop(self):
+    signal.setitimer(signal.ITIMER_PROF, 0)
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    # A signal already on its way would otherwise end the process
+    signal.signal(signal.SIGPROF, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, signal.SIG_IGN)
+    stacks = self.stacks
+    self.stacks = None
+    self.path = os.path.join(self.directory, "scapyhunt-%d-%s.folded" %
+                             (os.getpid(), time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))))
+    self.write(self.path, stacks)
+    print("Profile of %d samples over %.1fs written to %s%s" %
+          (sum(stacks.values()), time.time() - self.started, self.path, handlerSummary(stacks)))
+
+  # SIGALRM handler: the profile's duration is up
+  def expire(self, signum, frame):
+    if self.stacks is not None:
+      self.stop()
+
+  # SIGPROF handler: records every thread's stack, the main thread's from where it
+  #  was interrupted
+  def sample(self, signum, frame):
+    if self.stacks is None:
+      return
+    main = threading.main_thread()
+    names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+    frames = sys._current_frames()
+    frames[main.ident] = frame
+    for ident, top in frames.items():
+      self.stacks[self.stack(names.get(ident, "thread-%d" % ident), top)] += 1
+
+  # A frame's stack as (thread name, label of the outermost frame, ..., its own)
+  def stack(self, name, frame):
+    labels = self.labels
+    stack = []
+    while frame is not None:
+      code = frame.f_code
+      label = labels.get(code)
+      if label is None:
+        label = labels[code] = "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+      stack.append(label)
+      frame = frame.f_back
+    stack.append(name)
+    stack.reverse()
+    return tuple(stack)
+
+  # Writes the stacks in collapsed form, the most seen first
+  def write(self, path, stacks):
+    with open(path + ".tmp", "w") as f:
+      for stack, count in stacks.most_common():
+        f.write("%s %d\n" % (";".join(stack), count))
+    os.rename(path + ".tmp", path)
+
+# Each host's handler's share of the main thread's samples, as text
+def handlerSummary(stacks):
+  main = threading.main_thread().name
+  total = 0
+  handlers = collections.Counter()
+  for stack, count in stacks.items():
+    if stack[0] != main:
+      continue
+    total += count
+    for name in set(label.rsplit(":", 1)[1] for label in stack[1:]):
+      if name.startswith(HANDLER_PREFIXES):
+        handlers[name] += count
+  if not handlers:
+    return ""
+  return "\n handlers: " + ", ".join(["%s %.1f%%" % (name, 100.0 * count / total)
+                                      for name, count in handlers.most_common()])
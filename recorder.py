@@ -0,0 +1,177 @@
+#
+# Ring-buffer pcap recorder for scapyHunt.py
+#
+# Keeps a copy of every frame a session's tap reads and writes, for instructors to
+# review afterwards, without running tcpdump next to every game. The packet path
+# only copies frames (as pcap records) into a preallocated, anonymous mmap ring; a
+# background flusher thread writes the ring out to rotating pcap files.
+#
+# Recording never blocks the packet path: a frame that doesn't fit in the ring is
+# dropped from the recording and counted instead.
+#
+# Ring layout - head/tail are byte counters that only grow, positions are taken
+#  modulo the ring size. Records are a pcap record header and the frame, and are
+#  never split: when one doesn't fit before the end of the ring, the rest of the
+#  ring is skipped (marked with a SKIP header if there is room for one).
+#
+
+import mmap
+import os
+import threading
+import time
+
+from pcapFile import recordHeader, writePcapHeader
+
+SKIP = 0xffffffff
+
+class PcapRecorder(object):
+
+  # directory/name  - files are written as directory/name-<n>.pcap
+  # ringSize        - bytes of frames (plus 16 bytes each) buffered before dropping
+  # fileSize        - bytes in a file before moving on to the next one
+  # files           - most files kept, older ones are deleted
+  def __init__(self, directory, name, ringSize=4 << 20, fileSize=64 << 20, files=8):
+    self.directory = directory
+    self.name = name
+    self.ring = mmap.mmap(-1, ringSize)
+    self.size = ringSize
+    self.fileSize = fileSize
+    self.files = files
+    self.head = 0
+    self.tail = 0
+    # Producers are the packet loop and (with threads) the writer thread
+    self.lock = threading.Lock()
+
+    # Accounting
+    #  frames/bytes - frames recorded, and their size
+    #  dropped      - frames left out because the ring was full
+    #  written      - pcap files started
+    self.frames = 0
+    self.bytes = 0
+    self.dropped = 0
+    self.written = 0
+    self.file = None
+    self.fileBytes = 0
+
+  # Copies a batch of frames into the ring, all stamped with the current time
+  def recordBatch(self, frames):
+    now = time.time()
+    sec = int(now)
+    usec = int((now - sec) * 1000000)
+    ring = self.ring
+    size = self.size
+    with self.lock:
+      head = self.head
+      free = size - (head - self.tail)
+      for frame in frames:
+        length = len(frame)
+        need = 16 + length
+        pos = head % size
+        skip = size - pos
+        if skip < need:
+          if free < skip + need:
+            self.dropped += 1
+            continue
+          if skip >= 16:
+            recordHeader.pack_into(ring, pos, 0, 0, SKIP, 0)
+          head += skip
+          free -= skip
+          pos = 0
+        elif free < need:
+          self.dropped += 1
+          continue
+        recordHeader.pack_into(ring, pos, sec, usec, length, length)
+        ring[pos + 16:pos + need] = frame
+        head += need
+        free -= need
+        self.frames += 1
+        self.bytes += length
+      self.head = head
+
+  # Writes everything recorded so far to the current pcap file (flusher thread only).
+  #  Records are walked by their headers to find the skips and file boundaries, but
+  #  written out in contiguous runs (run is where the current one starts).
+  def flush(self):
+    head = self.head
+    tail = self.tail
+    if head == tail:
+      return
+    ring = self.ring
+    size = self.size
+    unpack = recordHeader.unpack_from
+    if self.file is None:
+      self.rotate()
+    fileBytes = self.fileBytes
+    run = tail
+    while tail < head:
+      pos = tail % size
+      if size - pos < 16 or unpack(ring, pos)[2] == SKIP:
+        self.writeRun(run, tail)
+        tail += size - pos
+        run = tail
+        continue
+      if pos == 0 or fileBytes >= self.fileSize:
+        self.writeRun(run, tail)
+        run = tail
+        if fileBytes >= self.fileSize:
+          self.rotate()
+          fileBytes = self.fileBytes
+      need = 16 + unpack(ring, pos)[2]
+      fileBytes += need
+      tail += need
+    self.writeRun(run, tail)
+    self.file.flush()
+    self.fileBytes = fileBytes
+    # Only now is the space handed back to the producers
+    self.tail = tail
+
+  # Writes the records between two ring positions that don't wrap
+  def writeRun(self, start, end):
+    if end > start:
+      pos = start % self.size
+      self.file.write(self.ring[pos:pos + end - start])
+
+  def path(self, n):
+    return os.path.join(self.directory, "%s-%d.pcap" % (self.name, n))
+
+  # Starts the next file, deleting the oldest one past the limit
+  def rotate(self):
+    if self.file is not None:
+      self.file.close()
+    self.file = open(self.path(self.written), "wb")
+    writePcapHeader(self.file)
+    self.fileBytes = 24
+    self.written += 1
+    if self.written > self.files:
+      try:
+        os.unlink(self.path(self.written - self.files - 1))
+      except OSError:
+        pass
+
+  def close(self):
+    self.flush()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+# Background thread flushing every recorder in the process
+class RecorderFlusher(object):
+
+  def __init__(self, interval=0.25):
+    self.interval = interval
+    self.recorders = []
+    self.thread = None
+
+  def add(self, recorder):
+    self.recorders.append(recorder)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name="recorder")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    while 1:
+      time.sleep(self.interval)
+      for recorder in list(self.recorders):
+        recorder.flush()
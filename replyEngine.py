@@ -0,0 +1,140 @@
+#
+# Byte-level reply construction for scapyHunt.py
+#
+# Replies to probes are built by copying the incoming frame (which is what
+# pkt.copy() did) and patching the swapped addresses, ports, seq/ack and flags in
+# place. Checksums are carried over incrementally (RFC 1624) rather than being
+# recomputed over the whole packet:
+#  - swapping src/dst addresses and ports never changes a checksum
+#  - only the words holding flags, seq and ack (or the ICMP type) are adjusted
+# This relies on the incoming checksums being valid, as they are for frames
+# from the kernel, nmap and scapy.
+#
+# Segments the services send with a payload (see servicePeer/tcpSegment) are
+# assembled from scratch instead, with checksums over the whole segment.
+#
+
+import struct
+
+macHeader = struct.Struct("!6s6s")
+ipAddrs = struct.Struct("!II")
+ipAddrBytes = struct.Struct("!4s4s")
+tcpFixed = struct.Struct("!HHIIHHH")
+word = struct.Struct("!H")
+icmpHeader = struct.Struct("!HH")
+# Ethernet, IPv4 (no options) and TCP (no options) headers
+ethIpTcp = struct.Struct("!6s6sHBBHHHBBHIIHHIIBBHHH")
+pseudoHeader = struct.Struct("!IIBBH")
+
+ARP_TEMPLATE_LEN = 42
+
+# Folds the carries of a one's complement sum back into 16 bits
+def foldSum(s):
+  while s >> 16:
+    s = (s & 0xffff) + (s >> 16)
+  return s
+
+# One's complement sum of a buffer's 16-bit words, folded (padded with a zero byte if
+#  its length is odd). 0x10000 is 1 mod 0xffff, so the whole buffer read as one
+#  big-endian integer is congruent to the sum of its words, and the fold is a single
+#  modulo (see checksumAdjust) - done by int.from_bytes in C rather than per word.
+def onesSum(data):
+  n = int.from_bytes(data, "big")
+  if len(data) & 1:
+    n <<= 8
+  return n and (n - 1) % 0xffff + 1
+
+# One's complement checksum of a buffer (padded with a zero byte if its length is odd)
+def internetChecksum(data):
+  return ~onesSum(data) & 0xffff
+
+# RFC 1624 eqn. 3: HC' = ~(~HC + ~m + m'), where oldSum/newSum are the plain sums
+#  of the 16-bit words that changed.
+#  One's complement addition is addition mod 0xffff (with ~x == -x), and folding a
+#  non-zero sum gives a value in 1..0xffff, so the folds are done with a single
+#  modulo. Only when every term is zero would the folded sum be 0 instead.
+#  (Since a 32-bit value is congruent to the sum of its halves mod 0xffff, the
+#  sums may add whole 32-bit fields rather than their 16-bit halves.)
+def checksumAdjust(chksum, oldSum, newSum):
+  if not newSum and chksum == 0xffff and foldSum(oldSum) == 0xffff:
+    return 0xffff
+  return 0xfffe - (0xfffe - chksum - oldSum + newSum) % 0xffff
+
+# Copies the frame and swaps the Ethernet and IPv4 source/destination addresses
+def swappedCopy(frame):
+  buf = bytearray(frame.data)
+  dst, src = macHeader.unpack_from(buf, 0)
+  macHeader.pack_into(buf, 0, src, dst)
+  ipAddrs.pack_into(buf, 26, frame.ipDst, frame.ipSrc)
+  return buf
+
+# Builds the reply to a TCP frame, with ports swapped and the given flags/seq/ack.
+#  Flags replace all 9 flag bits, as scapy's TCP.flags did.
+def tcpReply(frame, flags, seq, ack):
+  return tcpReplyAt(frame.data, 14 + frame.ipHeaderLen, flags, seq, ack)
+
+# tcpReply straight from the raw frame, with the TCP header at offset (used without
+#  a parsed Frame by the scan fast path in scapyHunt.py)
+def tcpReplyAt(data, offset, flags, seq, ack):
+  seq &= 0xffffffff
+  ack &= 0xffffffff
+  buf = bytearray(data)
+  dst, src = macHeader.unpack_from(data, 0)
+  macHeader.pack_into(buf, 0, src, dst)
+  ipSrc, ipDst = ipAddrBytes.unpack_from(data, 26)
+  ipAddrBytes.pack_into(buf, 26, ipDst, ipSrc)
+
+  sport, dport, oldSeq, oldAck, oldFlagsWord, window, chksum = tcpFixed.unpack_from(data, offset)
+  flagsWord = (oldFlagsWord & 0xfe00) | flags
+  chksum = checksumAdjust(chksum, oldSeq + oldAck + oldFlagsWord, seq + ack + flagsWord)
+  tcpFixed.pack_into(buf, offset, dport, sport, seq, ack, flagsWord, window, chksum)
+  return buf
+
+# Where a service's segments to the sender of a TCP frame go: the frame's
+#  (destination MAC, source MAC, destination IP, source IP, destination port, source port)
+def servicePeer(frame):
+  return (frame.ethDst, frame.ethSrc, frame.ipDst, frame.ipSrc, frame.dport, frame.sport)
+
+# Builds a TCP segment to a peer (see servicePeer) carrying payload, with the headers
+#  scapy would have given Ether()/IP()/TCP() (IP id 1, TTL 64, window 8192).
+#  payloadSum is the payload's onesSum, if already known (see bulkSender.FileImage).
+def tcpSegment(peer, seq, ack, flags, payload, payloadSum=None):
+  ethSrc, ethDst, src, dst, sport, dport = peer
+  buf = bytearray(ethIpTcp.pack(ethDst, ethSrc, 0x0800, 0x45, 0, 40 + len(payload), 1, 0, 64, 6,
+                                0, src, dst, sport, dport, seq & 0xffffffff, ack & 0xffffffff,
+                                0x50, flags, 8192, 0, 0))
+  buf += payload
+  word.pack_into(buf, 24, internetChecksum(buf[14:34]))
+  if payloadSum is None:
+    payloadSum = onesSum(payload)
+  tcpLength = 20 + len(payload)
+  s = onesSum(pseudoHeader.pack(src, dst, 0, 6, tcpLength)) + onesSum(buf[34:54]) + payloadSum
+  word.pack_into(buf, 50, ~foldSum(s) & 0xffff)
+  return buf
+
+# Builds the echo-reply to an ICMP echo-request frame
+def icmpEchoReply(frame):
+  buf = swappedCopy(frame)
+  offset = 14 + frame.ipHeaderLen
+  oldTypeWord, chksum = icmpHeader.unpack_from(frame.data, offset)
+  typeWord = oldTypeWord & 0x00ff # type 0 (echo-reply), same code
+  word.pack_into(buf, offset, typeWord)
+  word.pack_into(buf, offset + 2, checksumAdjust(chksum, oldTypeWord, typeWord))
+  return buf
+
+# Pre-assembles an ARP is-at reply from the given MAC/IP to 10.5.0.1.
+#  The requester's hardware address (bytes 0-6 and 32-38) is patched in per reply.
+def arpTemplate(mac, addr):
+  hwsrc = struct.pack("!6B", *[int(b, 16) for b in mac.split(":")])
+  buf = bytearray(ARP_TEMPLATE_LEN)
+  struct.pack_into("!6s6sH", buf, 0, b"\x00" * 6, hwsrc, 0x0806)
+  struct.pack_into("!HHBBH6sI6sI", buf, 14, 1, 0x0800, 6, 4, 2,
+                   hwsrc, addr, b"\x00" * 6, 0x0a050001)
+  return bytes(buf)
+
+# Builds an ARP is-at reply to an ARP who-has frame from a template
+def arpReply(template, frame):
+  buf = bytearray(template)
+  buf[0:6] = frame.arpHwsrc
+  buf[32:38] = frame.arpHwsrc
+  return buf
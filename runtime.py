@@ -0,0 +1,138 @@
+#
+# Runtimes driving scapyHunt.py
+#
+# A runtime owns the packet loop of every session added to it (TapReader ->
+# processBatch -> TapWriter) and runs the simulated traffic daemons. Daemons are
+# generators that send their traffic and then yield how many seconds to wait
+# before they are resumed, ie. each session's traffic scheduler (trafficGen.py)
+#
+#   def run(self):
+#     while 1:
+#       ...queue whatever is due on session.writer...
+#       yield self.runDue()
+#
+# spawn returns a function that resumes the daemon early, cutting its wait short
+# (ie, when something is scheduled on a session's timing wheel, see timingWheel.py,
+# sooner than the wheel was going to wake).
+#
+# ThreadRuntime - blocking main loop, a thread per daemon and a writer thread (default).
+#   Serves a single session. Each batch, and each step of a daemon, is run holding
+#   the runtime's lock, so a daemon only ever sees the session between batches (as
+#   on an AsyncioRuntime), whichever thread it runs in.
+# AsyncioRuntime - everything on one asyncio event loop: every session's tap fd is
+#   watched with loop.add_reader, daemons are resumed by loop timers, and writers
+#   are drained at the end of each callback instead of by their own thread. All
+#   sessions share one read buffer pool, as only one batch is handled at a time.
+#
+
+import threading
+
+from tapReader import TapReader, allocateBuffers
+from tapWriter import TapWriter
+
+class ThreadRuntime(object):
+
+  def __init__(self, processBatch):
+    self.processBatch = processBatch
+    self.sessions = []
+    self.lock = threading.Lock()
+
+  def addSession(self, session):
+    if self.sessions:
+      raise ValueError("ThreadRuntime serves a single session, use AsyncioRuntime")
+    session.reader = TapReader(session.fd, session.ifname, recorder=session.recorder)
+    session.writer = TapWriter(session.fd, recorder=session.recorder, link=session.link)
+    session.runtime = self
+    self.sessions.append(session)
+
+  # Runs the session's daemon in its own thread, sleeping between steps (each step
+  #  holding the lock). Returns a function waking it early (from any thread).
+  def spawn(self, session, steps):
+    alarm = threading.Event()
+    lock = self.lock
+    def run():
+      while 1:
+        with lock:
+          delay = next(steps, None)
+        if delay is None:
+          return
+        alarm.wait(delay)
+        alarm.clear()
+    thread = threading.Thread(target=run, name=steps.__name__)
+    thread.daemon = True
+    thread.start()
+    return alarm.set
+
+  def run(self):
+    session = self.sessions[0]
+    session.writer.start()
+    lock = self.lock
+    while 1:
+      frames = session.reader.readBatch()
+      with lock:
+        self.processBatch(session, frames)
+
+# A daemon on an AsyncioRuntime, and the loop timer resuming it next (None - while it
+#  runs, or once it is done)
+class LoopDaemon(object):
+  __slots__ = ("loop", "session", "steps", "handle")
+
+  def __init__(self, loop, session, steps):
+    self.loop = loop
+    self.session = session
+    self.steps = steps
+    self.handle = None
+
+  # Runs one step of the daemon, and schedules the next one after the delay it yields
+  def resume(self):
+    self.handle = None
+    try:
+      delay = next(self.steps)
+    except StopIteration:
+      return
+    finally:
+      self.session.writer.drain()
+    self.handle = self.loop.call_later(delay, self.resume)
+
+  # Resumes the daemon on the loop's next pass instead
+  def wake(self):
+    if self.handle is not None:
+      self.handle.cancel()
+      self.handle = self.loop.call_soon(self.resume)
+
+class AsyncioRuntime(object):
+
+  def __init__(self, processBatch, loop=None):
+    import asyncio
+    self.processBatch = processBatch
+    self.sessions = []
+    self.buffers = allocateBuffers()
+    if loop is None:
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+    self.loop = loop
+
+  def addSession(self, session):
+    session.reader = TapReader(session.fd, session.ifname, self.buffers, session.recorder)
+    session.writer = TapWriter(session.fd, recorder=session.recorder, link=session.link)
+    session.runtime = self
+    self.sessions.append(session)
+    self.loop.add_reader(session.fd, self.onReadable, session)
+
+  def removeSession(self, session):
+    self.loop.remove_reader(session.fd)
+    self.sessions.remove(session)
+
+  # Schedules the session's daemon's first step on the loop. Returns a function
+  #  waking it early (from the loop's thread).
+  def spawn(self, session, steps):
+    daemon = LoopDaemon(self.loop, session, steps)
+    daemon.handle = self.loop.call_soon(daemon.resume)
+    return daemon.wake
+
+  def onReadable(self, session):
+    self.processBatch(session, session.reader.drain())
+    session.writer.drain()
+
+  def run(self):
+    self.loop.run_forever()
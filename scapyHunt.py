@@ -14,44 +14,61 @@
 #
 #        
 
-# Surpress scapy warnings
-import logging
-logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
-
-from scapy.all import *
+# The game never imports scapy: frames are classified and answered from their raw
+#  bytes (see fastPath.py and replyEngine.py)
 from random import randint
-import systemGlobals as state
-import threading
-import time
+import random
+from systemGlobals import Session
+from fastPath import *
+from hostTable import *
+from camTable import CamTable
+from connTable import *
+from portIndex import *
+from lineBuffer import LineBuffer
+from bulkSender import BulkSender, FileImage, openImage
+import replyEngine
+from runtime import ThreadRuntime, AsyncioRuntime
+from supervisor import Supervisor, runWorker
+from multiQueue import QueueSession, SharedState
+from sessionPool import SessionPool
+from metrics import Metrics
+from profiler import SamplingProfiler
+from admission import AdmissionControl, parseBudget
+from batchReplies import BatchReplier, NO_REPLY, available as batchAvailable
+from recorder import PcapRecorder, RecorderFlusher
+from trafficGen import FrameTemplate, TrafficGenerator, TrafficScheduler
+from timingWheel import sessionWheel
+from linkEmulator import LinkEmulator, parseLink
+from netConfig import configureTap
+import argparse
 import os
 import sys
-import socket
+import struct
+import subprocess
 import fcntl
 
 import signal
-import sys
+import time
 
-# Global variables/states
+# Session variables/states
 # -----
-# clients - a dictionary mapping IP addresses to MAC addresses
-# openPorts - a dictionary mapping IP addresses to a list of their open ports
-# macTable - an integer that corresponds to the number of recieved CAM table entries
-
-# Visible clients - Key is IP, Value is MAC Addr.
-clients = state.clientList
-# Clients in the internal network behind .35 - Key is IP, value is MAC Addr.
-internalClients = state.internalClientList
-# Dictionary associating each client to a list of their open ports.
-openPorts = state.clientOpenPorts
-# The number of entries in the CAM table (simulated) for exploiting purposes.
-macTable = state.macTable
+# Every game function takes the player's Session (see systemGlobals.py) first:
+# session.clients - a dictionary mapping IP addresses to MAC addresses
+# session.openPorts - a dictionary mapping IP addresses to their PortIndex (see portIndex.py)
+# session.hosts - a dictionary mapping packed IP addresses to their Host entry and handler
+#   (with --hosts, a HostStore that also finds the ranges' hosts - see hostTable.py)
+# session.macTable - the switch's CAM table, learning the source MAC of every frame (see camTable.py)
+# session.flows - every open TCP connection to the SMTP/FTP services, with its service state
+# session.writer - queues frames to the session's tap device
+# session.runtime - runs the session's daemons (see runtime.py)
+# session.admission - sheds frames over their source's budget (see admission.py), or None
+# session.shared - the state shared with the game's other queues (see multiQueue.py), or None
 
 
 # Tools
 # -----
 # getLastOctet - split a given IP address and return the last octet (String)
 # getMAC - generate a fake MAC address based on a given IP
-# swapSrcAndDst - given a packet and layer, swaps the src and dst variables
 
 # Returns the last octet as a string for a given IP address
 def getLastOctet(IP):
@@ -63,262 +80,408 @@ def getMAC(IP):
 # Returns a fake MAC Address based on a given IP in the internal network
 def getInternalMAC(IP):
   return "12:67:4f:a2:6d:" + ("%02x" % int(getLastOctet(IP)))
-# About-face for given packet on a particular layer
-def swapSrcAndDst(pkt,layer):
-  pkt[layer].src, pkt[layer].dst = pkt[layer].dst, pkt[layer].src
 
 
 
 # Port Knocking handling
 # -----
-# knockDaemon - Daemon thread that handles automated traffic from .4 to .6 to reveal knock sequence
+# KnockTraffic - Generator sending the knock sequence from .4 to .6 every 10 seconds
 #   Terminates on successful knock from user
-# knockSequence - Main loop that will send a knock sequence from .4 to .6 on a time interval
-#   Target of knockDaemon
 # knockAnswer - Increments the knock step as the correct pattern is sent by the user
 
+# The client that knocks on its own (knocks from it are not the user's)
+knockSource = ipToInt('10.5.0.4')
+# The knock sequence, and the ports in it
+knockPorts = (951,951,4826,443,100,21)
+knockPortSet = frozenset(knockPorts)
+
 # Loops a specific port-knocking sequence from .4 to .6 with a pause in between runs
-def knockSequence():
-  ports = [951,951,4826,443,100,21]
-  ip = IP(dst ='10.5.0.6',src = '10.5.0.4') 
-  ether = Ether(dst = clients['10.5.0.6'], src = clients['10.5.0.4'])
-  while state.knockSequence < 6:
-    randomPort = randint(1,65535 - 6) # Random port number
-    offset = 0
-    for p in ports:
-      SYN = ether/ip/TCP(sport = randomPort+offset, dport = p, flags = 0x002, window = 2048, seq = 0)
-      os.write(tun, SYN.build())
-      offset += 1
-    time.sleep(10)
+class KnockTraffic(TrafficGenerator):
+
+  def __init__(self, session):
+    TrafficGenerator.__init__(self, 0.1)
+    self.session = session
+    self.template = FrameTemplate(session.clients['10.5.0.4'], session.clients['10.5.0.6'],
+                                  knockSource, ipToInt('10.5.0.6'))
+
+  def send(self, count):
+    session = self.session
+    if session.knockSequence >= 6:
+      return False
+    # The knocks only reach the player while the switch is flooding; once enough
+    #  CAM entries age out it switches them to .6's port again
+    session.macTable.expire()
+    session.hubMode = session.macTable.overflowed
+    if session.hubMode:
+      frame = self.template.frame
+      write = session.writer.write
+      for i in range(count):
+        randomPort = randint(1,65535 - 6) # Random port number
+        for offset, p in enumerate(knockPorts):
+          write(frame(randomPort + offset, p))
 
 # Increments the knock step as the user sends the correct port knock pattern
-def knockAnswer(pkt):
-  ports = [951,951,4826,443,100,21]
-  if (pkt[IP].src == '10.5.0.4' or 
-        pkt[TCP].dport not in ports or 
-        state.knockSequence >= len(ports)):
+#  A game over several queues shares the sequence, and each knock can reach any
+#  queue's worker, so it is stepped under the shared state's lock.
+def knockAnswer(session, frame):
+  if frame.ipSrc == knockSource or frame.dport not in knockPortSet:
     return
-  if pkt[TCP].dport == ports[state.knockSequence]:
-    state.knockSequence += 1
+  if session.shared is not None:
+    with session.shared.knockLock:
+      solved = knockStep(session, frame.dport)
+  else:
+    solved = knockStep(session, frame.dport)
+  if solved:
+    gameEvent(session, EVENT_KNOCK_SOLVED)
+    progress(session, "knockSolved")
+
+# Steps the knock sequence for a knock on port. Returns True if it completed it.
+def knockStep(session, port):
+  ports = knockPorts
+  sequence = session.knockSequence
+  if sequence >= len(ports):
+    return False
+  if port == ports[sequence]:
+    sequence += 1
+  else:
+    sequence = 0
+  session.knockSequence = sequence
+  return sequence >= len(ports)
+
+# The internal FTP server
+ftpServer = ipToInt('10.1.8.6')
+
+# Frames to the internal network all go to the gateway's MAC
+gatewayIP = '10.5.0.35'
+
+# SYNs sent on behalf of the simulated hosts are also seen, and answered, by the
+#  simulated network (as if they had come from the tap)
+def answerTraffic(session, frame):
+  if not scanReply(session, frame):
+    processPacket(session, frame)
+
+# Simulated Traffic from clients behind 10.5.0.35 to local clients: random SYNs
+#  from .6/.4 to .2/.22 in the internal network, of little interest, rate times a
+#  second (see --noise-rate)
+class GatewayNoise(TrafficGenerator):
+
+  srcs = ('10.5.0.6','10.5.0.4')
+  dsts = ('10.1.8.2','10.1.8.22')
+
+  def __init__(self, session, rate):
+    TrafficGenerator.__init__(self, rate)
+    self.session = session
+    # (source's MAC, source, destination) -> FrameTemplate, as the clients' MACs
+    #  can change (ie, after an ARP spoof)
+    self.templates = dict()
+
+  def send(self, count):
+    session = self.session
+    clients = session.clients
+    gwMAC = clients[gatewayIP]
+    templates = self.templates
+    write = session.writer.write
+    rand = random.random
+    for i in range(count):
+      source = self.srcs[rand() < 0.5]
+      dest = self.dsts[rand() < 0.5]
+      mac = clients[source]
+      key = (mac, source, dest)
+      template = templates.get(key)
+      if template is None:
+        template = templates[key] = FrameTemplate(mac, gwMAC, ipToInt(source), ipToInt(dest))
+      randomPort = 1 + int(rand() * 65534)
+      SYN = template.frame(randomPort, randomPort + 1)
+      write(SYN)
+      answerTraffic(session, SYN)
+
+# Every 25 seconds, a SYN from 10.5.0.6:21 > 10.1.8.6:21 (FTP), until someone is
+#  connected to the FTP server
+class FtpHint(TrafficGenerator):
+
+  def __init__(self, session):
+    TrafficGenerator.__init__(self, 1.0 / 25)
+    self.session = session
+    self.template = None
+
+  def send(self, count):
+    session = self.session
+    if session.flows.established(ftpServer, 21):
+      return
+    mac = session.clients['10.5.0.6']
+    if self.template is None or self.template.ethSrc != mac:
+      self.template = FrameTemplate(mac, session.clients[gatewayIP],
+                                    ipToInt('10.5.0.6'), ftpServer, 21, 21)
+    SYN = self.template.frame(21, 21)
+    session.writer.write(SYN)
+    answerTraffic(session, SYN)
+
+# Starts a generator on the session's traffic scheduler, which is made with the
+#  first one
+def startTraffic(session, generator):
+  if session.traffic is None:
+    session.traffic = TrafficScheduler(sessionWheel(session))
+  session.traffic.add(generator)
+
+# Steps of the game that change what the simulated network does
+EVENT_HUB_MODE = 0      # the CAM table first overflowed
+EVENT_KNOCK_SOLVED = 1  # the port knock was completed
+
+# Seconds between each queue's polls for events (see watchEvents)
+EVENT_POLL = 0.05
+
+# Sets off what a step of the game changes. A game served over several queues
+#  publishes it for every queue's worker to apply (see multiQueue.py).
+def gameEvent(session, event):
+  if session.shared is not None:
+    session.shared.publish(event)
   else:
-    state.knockSequence = 0  
-
-  if state.knockSequence >= len(ports):
-    openPorts['10.5.0.6'].append(25)
-    gwTrafficDaemon.start()
-
-# Simulated Traffic from clients behind 10.5.0.35 to local clients.
-#  Every fifth packet will be a SYN packet from 10.5.0.6:25 > 10.1.8.6:25,
-#  and all other packets are random and of little interest.
-def gwTraffic():
-  srcs = ['10.5.0.6','10.5.0.4']
-  dsts = ['10.1.8.2','10.1.8.22']
-  pktInterval = 0
-  gwMAC = clients['10.5.0.35']
+    applyEvent(session, event)
+
+# Applies an event to a session: traffic that only happens once is sent from queue 0,
+#  the background noise is split over every queue
+def applyEvent(session, event):
+  primary = session.queue == 0
+  if event == EVENT_HUB_MODE:
+    if primary:
+      startTraffic(session, KnockTraffic(session))
+  elif event == EVENT_KNOCK_SOLVED:
+    session.openPorts['10.5.0.6'].setState(25, PORT_OPEN)
+    share = 1
+    if session.shared is not None:
+      share = session.shared.queues
+    startTraffic(session, GatewayNoise(session, noiseRate / share))
+    if primary:
+      startTraffic(session, FtpHint(session))
+
+# Applies the events published by any queue to this queue's session, as they come
+#  (yields its delay to the runtime, see runtime.py)
+def watchEvents(session):
+  applied = set()
   while 1:
-    if pktInterval != 4:
-      # Generate some mac/port combination
-      randomPort = randint(1,65535 - 1)
-      rndSrc = randint(0,1)
-      rndDst = randint(0,1) 
-      source = srcs[rndSrc]
-      dest = dsts[rndDst]
-      ip = IP(src = source, dst = dest)
-      ether = Ether(src = clients[source], dst = gwMAC)
-      tcp = TCP(sport = randomPort, dport = randomPort + 1, flags = 0x002, window = 2048, seq = 0)
-    
-    elif state.ftpIsAlive == False:
-      # Send a TCP packet from 10.5.0.6:21 to 10.1.8.6:21 (FTP)
-      source = '10.5.0.6'
-      dest = '10.1.8.6'
-      ip = IP(src = source, dst = dest)
-      ether = Ether(src = clients[source], dst = gwMAC)
-      tcp = TCP(sport = 21, dport = 21, flags = 0x002, window = 2048, seq = 0)
-    
-    # Send packet
-    SYN = ether/ip/tcp
-    os.write(tun, SYN.build())
-    # Response
-    processPacket(SYN)
-    # increment pktInterval mod 5 and sleep for 5 seconds
-    pktInterval = (pktInterval + 1) % 5
-    time.sleep(5)
+    for event in session.shared.published():
+      if event not in applied:
+        applied.add(event)
+        applyEvent(session, event)
+    yield EVENT_POLL
 
 
-# Creates a daemon thread that will handle simulating traffic from .4 to .6
+# Simulated traffic is sent by generators on the session's TrafficScheduler (see
+#  trafficGen.py), run from its timing wheel and started with
+#  startTraffic(session, generator):
+#
+# KnockTraffic - simulates traffic from .4 to .6
 # Start conditions: User has performed CAM table overflow, forcing routing to hub
+#  (only sends while the switch is still in hub mode)
 # Termination conditions: Port-knock sequence has been completed by user
-knockDaemon = threading.Thread(group=None, target=knockSequence, name=None, args=(), kwargs={}) 
-knockDaemon.daemon = True
-
-# Creates a daemon thread that will handle simulating traffic through the .35 gateway
+#
+# GatewayNoise - simulates traffic through the .35 gateway
 # (Same IP but varying MACs)
-# Start conditions: User has performed CAM table overflow, forcing routing to hub
-# Termination conditions: N/A
-gwTrafficDaemon = threading.Thread(group=None, target=gwTraffic, name=None, args=(), kwargs={})
-gwTrafficDaemon.daemon = True
+# FtpHint - the SYN to the internal FTP server every 25 seconds
+# Start conditions: User has completed the port-knock sequence
+# Termination conditions: N/A (FtpHint is quiet while someone is logged in to the FTP server)
 
 # Packet Processing 
 # -----
-# void processPacket(packet p) 
-#   Processes the input packet, using the below functions to generate a response and
-#   write to the TUN/TAP interface.
+# void processPacket(session s, bytes frame) 
+#   Processes the input frame, using the below functions to generate a response and
+#   queue it on the TUN/TAP interface's writer.
 # 
 # Packet Replies
 # -----
-# packet arpIsAt(packet p) 
+# Each reply is returned as the raw bytes of the reply frame.
+# bytes arpIsAt(session s, frame f, host h) 
 #   Generates an ARP Is-At response to an ARP Who-Has request
-# packet tcpSA(packet p)   
+# bytes icmpEchoReply(frame f) 
+#   Generates an ICMP echo-reply to an ICMP echo-request
+# bytes tcpSA(frame f)   
 #   Generates a TCP SYN-ACK response to a TCP SYN request (indicative of open/unfiltered port)
-# packet tcpRA(packet p)   
+# bytes tcpRA(frame f)   
 #   Generates a TCP RES-ACK response to a TCP SYN request (indicative of closed port)
-# packet tcpA(packet p)    
+# bytes tcpA(frame f)    
 #   Generates a TCP ACK response to a TCP SYN-ACK (Completed TCP handshake)
-# packet tcpFA(packet p)   
+# bytes tcpFA(frame f)   
 #   Generates a TCP FIN-ACK response to close a TCP connection
 # 
-# smtpInit(packet p) 
+# The services send their replies on the connection themselves (see sendService):
+# smtpInit(session s, flow f) 
 #   Initializes an SMTP session and sends a standard introduction payload
-# smtpResp(packet p) 
+# smtpResp(session s, flow f, str line) 
 #   Response for a 'EHLO'/'HELO' information query
 # 
-# ftpInit(packet p) 
+# ftpInit(session s, flow f) 
 #   Initializes a FTP session and sends a standard introduction payload
-# ftpResp(packet p 
-#   Response for standard FTP queries (USER, PASS, LIST, RETR)
+# ftpResp(session s, flow f, str line)
+#   Response for standard FTP queries (USER, PASS, LIST, RETR) on the connection f
+# sendFile(session s, flow f, FileImage image)
+#   Streams a file down the connection f (see bulkSender.py)
+
+# Recieve and process incoming frames.
+#  Frames are classified from their raw headers (see fastPath.py), and the handlers
+#  read the same fields and the TCP payload (frame.payload) from the raw bytes.
+def processPacket(session, data):
+  frame = parseFrame(data)
+  kind = frame.kind
+  hosts = session.hosts
+  session.frameCounts[kind] += 1
+  if frame.ethSrc is not None:
+    macTableEntry(session, frame.ethSrc)
+
+  if kind == FRAME_ARP:
+    # Globally set ARP table if the router is in hub mode
+    if frame.arpOp == 2:
+      host = hosts.get(frame.arpPsrc)
+      if host is not None and not host.internal and host.mac is None:
+        session.clients[host.ip] = macToStr(frame.arpHwsrc)
+    dst = frame.arpPdst
 
-# Recieve and process incoming packets 
-def processPacket(pkt):
+  elif (kind == FRAME_ICMP and
+      frame.icmpType == 8): # ICMP echo-request
+    dst = frame.ipDst
 
-  if pkt.haslayer(ARP):
-    # Globally set ARP table if the router is in hub mode
-    if pkt[ARP].op == 2 and pkt[ARP].psrc in clients: 
-      clients[pkt[ARP].psrc] = pkt[ARP].hwsrc
-    
-    if pkt[ARP].pdst in clients:
-      o4 = getLastOctet(pkt[ARP].pdst)
-      globals()['dot'+o4](pkt) # Call the dot[last_octet] function
-    elif pkt[ARP].pdst in internalClients:
-      o4 = getLastOctet(pkt[ARP].pdst)
-      globals()['internalDot'+o4](pkt) # Call the internalDot[last_octet] function
-
-  elif (pkt.haslayer(ICMP) and
-      pkt[ICMP].type == 8): # ICMP echo-request
-    if pkt[IP].dst in clients:
-      o4 = getLastOctet(pkt[IP].dst)
-      globals()['dot'+o4](pkt) # Call the dot[last_octet] function
-    elif pkt[IP].dst in internalClients:
-      o4 = getLastOctet(pkt[IP].dst)
-      globals()['internalDot'+o4](pkt) # Call the internalDot[last_octet] function
-
-  elif (pkt.haslayer(TCP)):
-    if pkt[IP].dst in clients:
-      o4 = getLastOctet(pkt[IP].dst)
-      globals()['dot'+o4](pkt)
-    elif pkt[IP].dst in internalClients:
-      o4 = getLastOctet(pkt[IP].dst)
-      globals()['internalDot'+o4](pkt) # Call the internalDot[last_octet] function
-  
-  elif (pkt.haslayer(Ether) and 
-      not pkt.haslayer(ICMP) and 
-      state.macTable < 1024):
-    state.macTable += 1 # Add an "entry" to the "MAC table"
-    if state.macTable > 1023:
-      knockDaemon.start()
-      state.hubMode = True
+  elif kind == FRAME_TCP:
+    dst = frame.ipDst
+
+  else:
+    return
+
+  host = hosts.get(dst)
+  if host is not None:
+    host.handler(session, frame, host) # Call the dot[last_octet]/internalDot[last_octet] function
+
+# Learn the source MAC of a frame from the player's port (port 0) in the CAM table.
+#  When the table overflows the switch falls back to hub mode; the knock daemon is
+#  started the first time that happens.
+def macTableEntry(session, mac):
+  cam = session.macTable
+  cam.learn(mac)
+  # (over several queues, hub mode is on while any partition is overflowed, so each
+  #  keeps its own table's state in step with its own flag)
+  if session.shared is not None:
+    flagged = session.shared.isOverflowed(session.queue)
+  else:
+    flagged = session.hubMode
+  if cam.overflowed != flagged:
+    session.hubMode = cam.overflowed
+    if cam.overflowed and cam.overflows == 1:
+      gameEvent(session, EVENT_HUB_MODE)
+      progress(session, "hubMode")
 
 # Generate a proper ARP who-has reply (is-at)
-def arpIsAt(pkt):
-  if pkt[ARP].pdst in clients:
-    fake_src_mac = clients[pkt[ARP].pdst]
-  elif pkt[ARP].pdst in internalClients:
-    fake_src_mac = internalClients[pkt[ARP].pdst]
-  ether = Ether(dst=pkt.hwsrc, src=fake_src_mac)
-  arp = ARP(op="is-at", psrc=pkt.pdst, pdst="10.5.0.1", hwsrc=fake_src_mac, hwdst=pkt.hwsrc)
-  rpkt = ether/arp
-  return rpkt
+#  The reply is patched into the host's pre-assembled template, which is rebuilt
+#  whenever the host's MAC in the client list changes (ie, after an ARP spoof).
+def arpIsAt(session, frame, host):
+  return replyEngine.arpReply(hostArpTemplate(session, host), frame)
+
+# The host's is-at template, for its MAC in the client list
+def hostArpTemplate(session, host):
+  if host.mac is not None:
+    fake_src_mac = host.mac
+  elif host.internal:
+    fake_src_mac = session.internalClients[host.ip]
+  else:
+    fake_src_mac = session.clients[host.ip]
+  if host.arpTemplateMAC != fake_src_mac:
+    host.arpTemplate = replyEngine.arpTemplate(fake_src_mac, host.addr)
+    host.arpTemplateMAC = fake_src_mac
+  return host.arpTemplate
 
 # Generates an ICMP echo reply
-def icmpEchoReply(pkt):
-  rpkt = pkt.copy()
-  swapSrcAndDst(rpkt, Ether)
-  swapSrcAndDst(rpkt, IP)
-  rpkt[ICMP].type = 'echo-reply'
-  rpkt[ICMP].chksum = None # Recalculate checksum
-  rpkt[IP].chksum = None
-  return rpkt
+def icmpEchoReply(frame):
+  return replyEngine.icmpEchoReply(frame)
 
 # Generate a Syn-Ack response to a Syn request
-def tcpSA(pkt):
-  rpkt = pkt.copy()
-  swapSrcAndDst(rpkt,Ether)
-  swapSrcAndDst(rpkt,IP)
-  rpkt[TCP].flags = 'SA'
-  rpkt[TCP].seq = 0x1000
-  rpkt[TCP].ack = pkt[TCP].seq + 1
-  rpkt[IP].chksum = None # Recalculate the checksums
-  rpkt[TCP].chksum = None
-  rpkt[TCP].sport, rpkt[TCP].dport = rpkt[TCP].dport, rpkt[TCP].sport
-  return rpkt
+def tcpSA(frame):
+  return replyEngine.tcpReply(frame, 0x012, 0x1000, frame.seq + 1)
 
 # Generates a Reset-Ack response to a Syn request, indicative of a closed port
-def tcpRA(pkt):
-  rpkt = pkt.copy()
-  swapSrcAndDst(rpkt,Ether)
-  swapSrcAndDst(rpkt,IP)
-  rpkt[TCP].flags = 'RA'
-  rpkt[TCP].seq = 0
-  rpkt[TCP].ack = pkt[TCP].seq
-  rpkt[IP].chksum = None # Recalculate the checksums
-  rpkt[TCP].chksum = None
-  rpkt[TCP].sport, rpkt[TCP].dport = rpkt[TCP].dport, rpkt[TCP].sport
-  return rpkt
+def tcpRA(frame):
+  return replyEngine.tcpReply(frame, 0x014, 0, frame.seq)
 
 # Generates a Finalize-Ack response to a Finalize request, to complete a TCP disconnect
-def tcpFA(pkt):
-  rpkt = pkt.copy()
-  swapSrcAndDst(rpkt,Ether)
-  swapSrcAndDst(rpkt,IP)
-  rpkt[TCP].flags = 'FA'
-  rpkt[TCP].seq = pkt[TCP].ack
-  rpkt[TCP].ack = pkt[TCP].seq + 1
-  rpkt[IP].chksum = None # Recalculate the checksums
-  rpkt[TCP].chksum = None
-  rpkt[TCP].sport, rpkt[TCP].dport = rpkt[TCP].dport, rpkt[TCP].sport
-  return rpkt  
+def tcpFA(frame):
+  return replyEngine.tcpReply(frame, 0x011, frame.ack, frame.seq + 1)
 
 # Generates an Ack response to a Syn-Ack request, completing a three-way handshake
-def tcpA(pkt):
-  rpkt = pkt.copy()
-  swapSrcAndDst(rpkt,Ether)
-  swapSrcAndDst(rpkt,IP)
-  rpkt[TCP].flags = 'A'
-  rpkt[TCP].seq = pkt[TCP].ack
-  if (pkt.haslayer(Raw)):
-    rpkt[TCP].ack = pkt[TCP].seq + len(pkt[Raw].load)
+def tcpA(frame):
+  if frame.payloadLen:
+    ack = frame.seq + frame.payloadLen
   else: 
-    rpkt[TCP].ack = pkt[TCP].seq + 1
-  rpkt[IP].chksum = None # Recalculate the checksums
-  rpkt[TCP].chksum = None
-  rpkt[TCP].sport, rpkt[TCP].dport = rpkt[TCP].dport, rpkt[TCP].sport
-  return rpkt 
-
-# Generates a PSH-ACK response to a successful handshake, with an SMTP standard payload
-def smtpInit(pkt):
-  ether = Ether(dst = pkt[Ether].src, src = pkt[Ether].dst)
-  ip = IP(src = pkt[IP].dst, dst = pkt[IP].src)
-  tcp = TCP(flags='PA',seq=pkt[TCP].ack,ack=pkt[TCP].seq,sport = pkt[TCP].dport, dport = pkt[TCP].sport)
-  rpkt = ether/ip/tcp/'220-smtp02.mail.example.org ESMTP\r\n'
-  return rpkt
-
-# Generates a PSH-ACK response to an SMTP information query (ie, EHLO or HELO)
-def smtpResp(pkt):
-  ether = Ether(dst = pkt[Ether].src, src = pkt[Ether].dst)
-  ip = IP(src = pkt[IP].dst, dst = pkt[IP].src)
-  tcp = TCP(flags='PA',seq=pkt[TCP].ack,ack=pkt[TCP].seq + len(pkt[Raw].load),sport = pkt[TCP].dport, dport = pkt[TCP].sport)
- 
-  SMTPargs = pkt[Raw].load.split(" ")
-  SMTPargs = [w.strip('\r\n') for w in SMTPargs]
+    ack = frame.seq + 1
+  return replyEngine.tcpReply(frame, 0x010, frame.ack, ack)
+
+# Line-based services (SMTP/FTP)
+# -----
+# Once a service's connection is established (serviceOpen), the client's payloads
+#  are put back in stream order (see connTable.Flow.receive) and split into command
+#  lines (see lineBuffer.py), each of which is handed to the service's command
+#  handler. Replies are sent as PSH-ACKs on the flow (sendService), which keeps
+#  its own sequence numbers, so pipelined commands get one reply each.
+#
+# A command that never gets a line ending (ie, a Raw load crafted with scapy) is
+#  taken as it is once nothing more has arrived for COMMAND_TIMEOUT seconds.
+#
+# Files are streamed by a BulkSender (see bulkSender.py) on the flow, which then
+#  sends everything else on the flow after them, until the client has acked it all.
+
+COMMAND_TIMEOUT = 0.2
+
+# Sends a PSH-ACK carrying load to the flow's client
+def sendService(session, flow, load):
+  payload = load.encode("latin-1")
+  if flow.sender is not None:
+    flow.sender.send(payload)
+    return
+  session.writer.write(replyEngine.tcpSegment(flow.peer, flow.sndNxt, flow.seq, 0x018, payload))
+  flow.sndNxt = (flow.sndNxt + len(payload)) & 0xffffffff
+
+# Completes the handshake on a flow (frame is the client's ACK) and sends the
+#  service's greeting
+def serviceOpen(session, frame, flow, greeting, command):
+  flow.state = FLOW_ESTABLISHED
+  flow.peer = replyEngine.servicePeer(frame)
+  flow.sndNxt = frame.ack
+  flow.lines = LineBuffer()
+  greeting(session, flow)
+  if frame.payloadLen:
+    serviceData(session, frame, flow, command)
+
+# Handles a segment with data from the client of an established service connection
+def serviceData(session, frame, flow, command):
+  data = flow.receive(frame.seq, frame.payload)
+  if not data:
+    # A retransmission, or data after a gap: (re)acknowledge what was received
+    session.writer.write(replyEngine.tcpSegment(flow.peer, flow.sndNxt, flow.seq, 0x010, b""))
+    return
+  lines = flow.lines.push(data)
+  for line in lines:
+    command(session, flow, line)
+  if not lines:
+    session.writer.write(replyEngine.tcpSegment(flow.peer, flow.sndNxt, flow.seq, 0x010, b""))
+  if flow.lines.pending:
+    sessionWheel(session).spawn(commandTimeout(session, flow, command, flow.lines.received))
+
+# Streams a file to the flow's client, segmented to its MSS and paced by its window
+def sendFile(session, flow, image):
+  if flow.sender is None:
+    flow.sender = BulkSender(session, flow)
+  flow.sender.sendImage(image)
+
+# Takes an unterminated command as it is, if nothing has arrived on the flow since
+#  (yields its delay to the session's timing wheel, see timingWheel.py)
+def commandTimeout(session, flow, command, received):
+  yield COMMAND_TIMEOUT
+  lines = flow.lines
+  if lines.received == received and lines.pending and session.flows.tracked(flow):
+    command(session, flow, lines.flush())
+
+# Sends the SMTP greeting
+def smtpInit(session, flow):
+  sendService(session, flow, '220-smtp02.mail.example.org ESMTP\r\n')
+
+# Replies to an SMTP command (ie, EHLO or HELO information queries)
+def smtpResp(session, flow, line):
+  SMTPargs = line.split(" ")
 
   if not 0 < len(SMTPargs) < 2:
     load = '501-Invalid Command\r\n'
@@ -330,25 +493,16 @@ def smtpResp(pkt):
   else:
     load = '501-Invalid Command\r\n'
 
-  rpkt = ether/ip/tcp/load
-  return rpkt
-
-# Generates a PSH-ACK response to a successful handshake, with an FTP standard payload
-def ftpInit(pkt):
-  ether = Ether(dst = pkt[Ether].src, src = pkt[Ether].dst)
-  ip = IP(src = pkt[IP].dst, dst = pkt[IP].src)
-  tcp = TCP(flags='PA',seq=pkt[TCP].ack,ack=pkt[TCP].seq,sport = pkt[TCP].dport, dport = pkt[TCP].sport)
-  rpkt = ether/ip/tcp/'220-QTCP ftp01.example.org\r\n'
-  return rpkt
+  sendService(session, flow, load)
 
-# Generates a PSH-ACK response based on a given FTP command
-def ftpResp(pkt):
-  ether = Ether(dst = pkt[Ether].src, src = pkt[Ether].dst)
-  ip = IP(src = pkt[IP].dst, dst = pkt[IP].src)
-  tcp = TCP(flags='PA',seq=pkt[TCP].ack,ack=pkt[TCP].seq + len(pkt[Raw]),sport = pkt[TCP].dport, dport = pkt[TCP].sport)
+# Sends the FTP greeting
+def ftpInit(session, flow):
+  sendService(session, flow, '220-QTCP ftp01.example.org\r\n')
 
-  FTPargs = pkt[Raw].load.split(" ")
-  FTPargs = [w.strip('\r\n') for w in FTPargs]
+# Replies to an FTP command (USER, PASS, LIST, RETR)
+#  The login state is kept on the connection's flow.
+def ftpResp(session, flow, line):
+  FTPargs = line.split(" ")
 
   # Detect command and reply appropriately
   if not 0 < len(FTPargs) < 3:
@@ -357,38 +511,39 @@ def ftpResp(pkt):
   # If USER is sent as the first argument, parse the second as the username.
   elif ("USER" == FTPargs[0] and 
       len(FTPargs) == 2 and 
-      not state.ftpUserEntered):
+      not flow.userEntered):
 
-    state.ftpUserEntered = True
-    state.ftpUser = FTPargs[1]
+    flow.userEntered = True
+    flow.user = FTPargs[1]
     load = "331-Enter Password.\r\n"
   
   # If PASS is sent as the first argument, parse the second as the password.
   #  Do nothing if USER is not yet parsed.
   #  Authenticate iff both USER, PASS are set correctly as (admin, admin)
   elif ("PASS" == FTPargs[0] and 
-      state.ftpUserEntered and 
-      not state.ftpPassEntered):
+      flow.userEntered and 
+      not flow.passEntered):
 
-    if (state.ftpUser == "admin" and 
+    if (flow.user == "admin" and 
         len(FTPargs) == 2 and 
         FTPargs[1] == "admin"): 
-      state.ftpPassEntered = True
+      flow.passEntered = True
+      progress(session, "ftpLogin")
       load = "230-Admin logged on.\r\n"
     else:
-      state.ftpUser = None
-      state.ftpUserEntered = False
+      flow.user = None
+      flow.userEntered = False
       load = "430-Invalid Username or Password.\r\n"
   
-  # If LIST is sent as the only argument, then return a payload listing the target file.
+  # If LIST is sent as the only argument, then return a payload listing the served files.
   #  Do nothing if not authenticated.
   elif ("LIST" == FTPargs[0] and 
       len(FTPargs) == 1):
 
-    if state.ftpPassEntered == False:
+    if flow.passEntered == False:
       load = "530-User not logged in.\r\n"
     else:
-      load = "250-topSecret.txt\r\n"
+      load = "".join(["250-%s\r\n" % name for name in sorted(serverFiles)])
   
   # If RETR is sent as the first argument, then parse the second as the source filename.
   #  Do nothing if the user is not authenticated.
@@ -396,26 +551,26 @@ def ftpResp(pkt):
   elif ("RETR" == FTPargs[0] and 
       len(FTPargs) == 2):
 
-    if state.ftpPassEntered == False:
+    if flow.passEntered == False:
       load = "530-User not logged in.\r\n"
     else:
-      if FTPargs[1] == "topSecret.txt":
+      image = serverFiles.get(FTPargs[1])
+      if image is not None:
         #First send a confirmation packet
-        confLoad = "150-Retreiving file topSecret.txt\r\n"
-        os.write(tun, (ether/ip/tcp/confLoad).build())
-        load = """FTP Data (W WARNING THIS IS WARNING\r\n
-          V AP-VERSION 1.0\r\n
-          W Congratulations on completing scapyHunt. 
-          Hash this payload with SHA1 to confirm that you've won.\r\n"""
+        confLoad = "150-Retreiving file %s\r\n" % image.name
+        sendService(session, flow, confLoad)
+        if image.name == "topSecret.txt":
+          progress(session, "payloadRetrieved")
+        sendFile(session, flow, image)
+        load = "226-Transfer complete.\r\n"
       else: 
         load = "550-File Not Found.\r\n"
   
   else:
     load = '501-Invalid Command\r\n'
 
+  sendService(session, flow, load)
 
-  rpkt = ether/ip/tcp/load
-  return rpkt
 
 # Destination Specific Packet Processing
 # -----
@@ -426,199 +581,384 @@ def ftpResp(pkt):
 #  internalDot2 - Standard internal client
 #  internalDot6 - Internal FTP server and target
 #  internalDot22 - Standard internal client
+#  rangeHost - Every host of a --hosts/--internal-hosts range (see hostTable.HostRange)
 
-def dot4(pkt):
+def dot4(session, frame, host):
   rpkt = None
 
   # ICMP echo handling
-  if (pkt.haslayer(ICMP) and
-      pkt[ICMP].type == 8):
-    rpkt = icmpEchoReply(pkt)
+  if (frame.kind == FRAME_ICMP and
+      frame.icmpType == 8):
+    rpkt = icmpEchoReply(frame)
 
   # ARP handling
-  if (pkt.haslayer(ARP) and 
-      pkt[ARP].op == 1):
-    rpkt = arpIsAt(pkt)
+  if (frame.kind == FRAME_ARP and 
+      frame.arpOp == 1):
+    rpkt = arpIsAt(session, frame, host)
     
   # TCP handling
-  elif (pkt.haslayer(TCP)):
-    if pkt[TCP].dport in openPorts[pkt[IP].dst]:
-      if pkt[TCP].flags == 0x002: # SYN
-        rpkt = tcpSA(pkt)
+  elif (frame.kind == FRAME_TCP):
+    if frame.dport in host.ports:
+      if frame.tcpFlags == 0x002: # SYN
+        rpkt = tcpSA(frame)
     else:
-      rpkt = tcpRA(pkt)
+      rpkt = tcpRA(frame)
   
   if (rpkt == None):
     return
-  os.write(tun,rpkt.build())
+  session.writer.write(rpkt)
 
-def dot6(pkt):
+def dot6(session, frame, host):
   rpkt = None
-  ports = [951,951,4826,443,100,21]
-  filteredPorts = [25]
 
   # ICMP echo handling
-  if (pkt.haslayer(ICMP) and
-      pkt[ICMP].type == 8):
-    rpkt = icmpEchoReply(pkt)
+  if (frame.kind == FRAME_ICMP and
+      frame.icmpType == 8):
+    rpkt = icmpEchoReply(frame)
 
   # ARP handling
-  if (pkt.haslayer(ARP) and 
-      pkt[ARP].op == 1):
-    rpkt = arpIsAt(pkt)
+  if (frame.kind == FRAME_ARP and 
+      frame.arpOp == 1):
+    rpkt = arpIsAt(session, frame, host)
     
   # TCP handling
-  elif (pkt.haslayer(TCP)):
-    if (state.knockSequence < 6):
-      if (pkt[TCP].dport in ports and 
-          pkt[TCP].flags == 0x002):
-        rpkt = knockAnswer(pkt)
+  elif (frame.kind == FRAME_TCP):
+    if (session.knockSequence < 6):
+      if (frame.dport in knockPortSet and 
+          frame.tcpFlags == 0x002):
+        rpkt = knockAnswer(session, frame)
     
-    if (pkt[TCP].dport in openPorts[pkt[IP].dst]):
-      if (pkt[TCP].flags == 0x002): # SYN
-        rpkt = tcpSA(pkt)
+    if (frame.dport in host.ports):
+      if (frame.tcpFlags == 0x002): # SYN
+        rpkt = tcpSA(frame)
       
-      # Handling of SMTP Traffic
-      if(pkt[TCP].dport == 25):
-        if (pkt[TCP].flags == 0x011): # FIN-ACK
-          rpkt = tcpA(pkt)
-          state.smtpIsAlive = False
-        elif (pkt[TCP].flags == 0x010): # ACK
-          if (state.smtpIsAlive == False): 
-            state.smtpIsAlive = True
-            rpkt = smtpInit(pkt)
-        elif (pkt[TCP].flags == 0x018): # PSH-ACK
-          if (pkt.haslayer(Raw)):
-            rpkt = smtpResp(pkt)
+      # Handling of SMTP Traffic, per connection (see connTable.py)
+      if(frame.dport == 25):
+        flows = session.flows
+        if (frame.tcpFlags == 0x002): # SYN
+          flows.open(frame)
+        else:
+          flow = flows.lookup(frame)
+          if (frame.tcpFlags == 0x011): # FIN-ACK
+            rpkt = tcpA(frame)
+            if flow is not None:
+              flows.close(flow)
+          elif flow is None:
+            pass
+          elif (frame.tcpFlags & 0x0f7 == 0x010): # ACK or PSH-ACK
+            if (flow.state == FLOW_SYN_RCVD):
+              serviceOpen(session, frame, flow, smtpInit, smtpResp)
+            elif (frame.payloadLen):
+              serviceData(session, frame, flow, smtpResp)
     
-    elif pkt[TCP].dport in filteredPorts:
+    elif host.ports.state(frame.dport) == PORT_FILTERED:
       return
     else:
-      rpkt = tcpRA(pkt)
+      rpkt = tcpRA(frame)
       
   if (rpkt == None):
     return
-  os.write(tun,rpkt.build())
+  session.writer.write(rpkt)
   
-def dot35(pkt):
+def dot35(session, frame, host):
   rpkt = None
 
   # ICMP echo handling
-  if (pkt.haslayer(ICMP) and
-      pkt[ICMP].type == 8):
-    rpkt = icmpEchoReply(pkt)
+  if (frame.kind == FRAME_ICMP and
+      frame.icmpType == 8):
+    rpkt = icmpEchoReply(frame)
 
   # ARP handling
-  if (pkt.haslayer(ARP) and 
-      pkt[ARP].op == 1):
-    rpkt = arpIsAt(pkt)
+  if (frame.kind == FRAME_ARP and 
+      frame.arpOp == 1):
+    rpkt = arpIsAt(session, frame, host)
 
   # TCP handling
-  elif (pkt.haslayer(TCP)):
-    if pkt[TCP].dport in openPorts[pkt[IP].dst]:
-      if pkt[TCP].flags == 0x002: # SYN
-        rpkt = tcpSA(pkt)
+  elif (frame.kind == FRAME_TCP):
+    if frame.dport in host.ports:
+      if frame.tcpFlags == 0x002: # SYN
+        rpkt = tcpSA(frame)
     else:
-      rpkt = tcpRA(pkt)
+      rpkt = tcpRA(frame)
   
   if (rpkt == None):
     return
-  os.write(tun,rpkt.build())
+  session.writer.write(rpkt)
   
-def internalDot2(pkt):
+def internalDot2(session, frame, host):
   rpkt = None
 
   # ICMP echo handling
-  if (pkt.haslayer(ICMP) and
-      pkt[ICMP].type == 8):
-    rpkt = icmpEchoReply(pkt)
+  if (frame.kind == FRAME_ICMP and
+      frame.icmpType == 8):
+    rpkt = icmpEchoReply(frame)
 
   # ARP handling
-  if (pkt.haslayer(ARP) and 
-      pkt[ARP].op == 1):
-    rpkt = arpIsAt(pkt)
+  if (frame.kind == FRAME_ARP and 
+      frame.arpOp == 1):
+    rpkt = arpIsAt(session, frame, host)
     
   # TCP handling
-  elif (pkt.haslayer(TCP)):
-    if pkt[TCP].dport in openPorts[pkt[IP].dst]:
-      if pkt[TCP].flags == 0x002: # SYN
-        rpkt = tcpSA(pkt)
+  elif (frame.kind == FRAME_TCP):
+    if frame.dport in host.ports:
+      if frame.tcpFlags == 0x002: # SYN
+        rpkt = tcpSA(frame)
     else:
-      rpkt = tcpRA(pkt)
+      rpkt = tcpRA(frame)
   
   if (rpkt == None):
     return
   
-  os.write(tun,rpkt.build())
+  session.writer.write(rpkt)
 
-def internalDot6(pkt):
+def internalDot6(session, frame, host):
  
   # NO echo handling- configured to ignore ICMP echo
 
   rpkt = None
   # ARP handling
-  if (pkt.haslayer(ARP)):
-    if pkt[ARP].op == 1:
-      rpkt = arpIsAt(pkt)
+  if (frame.kind == FRAME_ARP):
+    if frame.arpOp == 1:
+      rpkt = arpIsAt(session, frame, host)
  
   # Immediately ignore any packets not from the supposed .4 and .6 clients
-  elif pkt.haslayer(Ether) and pkt[Ether].src not in [clients['10.5.0.6'],clients['10.5.0.4']]:
+  elif frame.macSrc not in [session.clients['10.5.0.6'],session.clients['10.5.0.4']]:
     return
  
  # TCP handling
-  elif (pkt.haslayer(TCP)):
-    if (pkt[TCP].dport in openPorts[pkt[IP].dst]):
-      if (pkt[TCP].flags == 0x002): # SYN
-        rpkt = tcpSA(pkt)
+  elif (frame.kind == FRAME_TCP):
+    if (frame.dport in host.ports):
+      if (frame.tcpFlags == 0x002): # SYN
+        rpkt = tcpSA(frame)
       
-      # Handling of FTP Traffic
-      if(pkt[TCP].dport == 21):
-        if (pkt[TCP].flags == 0x011): # FIN-ACK
-          rpkt = tcpA(pkt)
-          state.ftpIsAlive = False
-          state.ftpUserEntered = False
-          state.ftpPassEntered = False
-        elif (pkt[TCP].flags == 0x010): # ACK
-          if (state.ftpIsAlive == False): 
-            state.ftpIsAlive = True
-            rpkt = ftpInit(pkt)
-        elif (pkt[TCP].flags == 0x018): # PSH-ACK
-          if pkt.haslayer(Raw):
-            rpkt = ftpResp(pkt)
+      # Handling of FTP Traffic, per connection (see connTable.py)
+      if(frame.dport == 21):
+        flows = session.flows
+        if (frame.tcpFlags == 0x002): # SYN
+          flows.open(frame)
+        else:
+          flow = flows.lookup(frame)
+          if (frame.tcpFlags == 0x011): # FIN-ACK
+            rpkt = tcpA(frame)
+            if flow is not None:
+              flows.close(flow)
+          elif flow is None:
+            pass
+          elif (frame.tcpFlags & 0x0f7 == 0x010): # ACK or PSH-ACK
+            if (flow.state == FLOW_SYN_RCVD):
+              serviceOpen(session, frame, flow, ftpInit, ftpResp)
+            else:
+              if flow.sender is not None:
+                flow.sender.acked()
+              if (frame.payloadLen):
+                serviceData(session, frame, flow, ftpResp)
     
       else:
-        rpkt = tcpRA(pkt)
+        rpkt = tcpRA(frame)
  
   if (rpkt == None):
     return
   
-  os.write(tun,rpkt.build())
+  session.writer.write(rpkt)
 
-def internalDot22(pkt):
+def internalDot22(session, frame, host):
 
   # ICMP echo handling
-  if (pkt.haslayer(ICMP) and
-      pkt[ICMP].type == 8):
-    rpkt = icmpEchoReply(pkt)
+  if (frame.kind == FRAME_ICMP and
+      frame.icmpType == 8):
+    rpkt = icmpEchoReply(frame)
 
   rpkt = None
   # ARP handling
-  if (pkt.haslayer(ARP) and 
-      pkt[ARP].op == 1):
-    rpkt = arpIsAt(pkt)
+  if (frame.kind == FRAME_ARP and 
+      frame.arpOp == 1):
+    rpkt = arpIsAt(session, frame, host)
     
   # TCP handling
-  elif (pkt.haslayer(TCP)):
-    if pkt[TCP].dport in openPorts[pkt[IP].dst]:
-      if pkt[TCP].flags == 0x002: # SYN
-        rpkt = tcpSA(pkt)
+  elif (frame.kind == FRAME_TCP):
+    if frame.dport in host.ports:
+      if frame.tcpFlags == 0x002: # SYN
+        rpkt = tcpSA(frame)
     else:
-      rpkt = tcpRA(pkt)
+      rpkt = tcpRA(frame)
   
   if (rpkt == None):
     return
   
-  os.write(tun,rpkt.build())
+  session.writer.write(rpkt)
+
+def rangeHost(session, frame, host):
+  rpkt = None
+
+  # ICMP echo handling
+  if (frame.kind == FRAME_ICMP and
+      frame.icmpType == 8):
+    rpkt = icmpEchoReply(frame)
+
+  # ARP handling
+  elif (frame.kind == FRAME_ARP and
+      frame.arpOp == 1):
+    rpkt = arpIsAt(session, frame, host)
+
+  # TCP handling, from the range's port profile
+  elif (frame.kind == FRAME_TCP):
+    state = host.ports.state(frame.dport)
+    if state == PORT_OPEN:
+      if frame.tcpFlags == 0x002: # SYN
+        rpkt = tcpSA(frame)
+    elif state == PORT_CLOSED:
+      rpkt = tcpRA(frame)
+
+  if (rpkt == None):
+    return
+  session.writer.write(rpkt)
+
+
+# Sessions
+# -----
+# Each player gets a Session (see systemGlobals.py) on their own tap device, built
+#  from the declarations below. Sessions share nothing but the handler functions
+#  (and port bitmaps, until a session changes one - see portIndex.py).
+
+# Clients on the network
+#  (IP, behind the .35 gateway, handler, initial open ports, filtered ports,
+#   ports whose SYNs the handler needs to see - None for all of them)
+#  .1.8.6 never answers on a port that isn't open, so all the others are filtered.
+hostDeclarations = [
+  ('10.5.0.4',  False, dot4,          [20,21,22,80,443],         [],   []),
+  ('10.5.0.6',  False, dot6,          [80,22],                   [25], list(knockPortSet) + [25]),
+  ('10.5.0.35', False, dot35,         [20,21,22,25,80,443,8080], [],   []),
+  ('10.1.8.6',  True,  internalDot6,  [21, 25],                  range(65536), [21, 25]),
+  ('10.1.8.2',  True,  internalDot2,  [20, 80, 443],             [],   []),
+  ('10.1.8.22', True,  internalDot22, [20, 22, 80, 443],         [],   []),
+]
+
+# Ranges of hosts all alike, to make a larger network of (see --hosts)
+#  (CIDR, behind the .35 gateway, handler, open ports, filtered ports, MAC prefix)
+hostRanges = []
+
+# Port profiles the hosts of a range can share (open ports, filtered ports)
+portProfiles = {
+  "workstation": ([22, 135, 139, 445], []),
+  "server":      ([21, 22, 25, 53, 80, 443, 8080], []),
+  "firewalled":  ([80, 443], range(65536)),
+}
+
+# The first three bytes of the MACs of the hosts of a range, on the player's network
+#  and behind the gateway (the rest are the low three bytes of the host's address)
+rangeMACPrefix = "12:67:7f"
+internalRangeMACPrefix = "12:67:4e"
+
+# The player's address, never one of a range's hosts
+playerIP = '10.5.0.1'
+
+# Hosts whose handlers answer every ICMP echo-request sent to them (every handler
+#  answers ARP who-has), which the batch path answers itself (see batchReplies.py)
+echoHosts = frozenset(['10.5.0.4', '10.5.0.6', '10.5.0.35', '10.1.8.2'])
+
+# Does a host's handler answer ICMP echo-requests? (every host of a range does, see
+#  rangeHost)
+def answersEcho(host):
+  return host.ip in echoHosts or host.mac is not None
+
+# Size of each session's CAM table, and how long (seconds) an unused entry stays in it
+camSize = 1024
+camAging = 300.0
+
+# Directory each session's traffic is recorded to (None - not recorded), the size
+#  of each session's ring buffer, of each pcap file and how many files to keep
+recordDir = None
+recordRing = 4 << 20
+recordFileSize = 64 << 20
+recordFiles = 8
+# Writes the recordings out, started with the first recorded session in a process
+recorderFlusher = None
+
+# Admission budgets for each session's frames (see admission.py): None - everything
+#  is admitted, else class -> (frames/sec, burst) over the default budgets
+admissionBudgets = None
+
+# Frames/sec of the gateway's background traffic, once the knock is solved
+noiseRate = 0.2
+
+# Answer bursts of probes with the batch path, if NumPy is there (see batchReplies.py).
+#  Off by default: it pays off on SYN scans and sweeps of host ranges (see hostRanges),
+#  and slows down everything else.
+batchPath = False
+
+# Latency, jitter and loss of the networks on emulated links (Links, see
+#  linkEmulator.py): what their hosts send is held back or lost on the way to the
+#  player
+links = []
+
+# Where SIGUSR2's sampling profiles are written, and how long (seconds) each one runs
+#  for (see installProfiler)
+profileDir = "/tmp"
+profileDuration = 10.0
+
+# The payload retrieved from the internal FTP server to win the game
+topSecret = """FTP Data (W WARNING THIS IS WARNING\r\n
+          V AP-VERSION 1.0\r\n
+          W Congratulations on completing scapyHunt. 
+          Hash this payload with SHA1 to confirm that you've won.\r\n"""
+
+# Files served by the internal FTP server, by name (FileImages, see bulkSender.py).
+#  A --scenario directory adds its files, mapped rather than read (see loadScenario).
+serverFiles = {"topSecret.txt": FileImage("topSecret.txt", topSecret.encode("latin-1"))}
+
+# Serves every regular file in the directory from the FTP server (replacing any
+#  built-in file of the same name)
+def loadScenario(path):
+  for name in sorted(os.listdir(path)):
+    filePath = os.path.join(path, name)
+    if os.path.isfile(filePath) and " " not in name:
+      serverFiles[name] = openImage(filePath)
+
+# Creates a fresh game for the tap device opened as fd (or sets up the given session,
+#  ie a QueueSession)
+def newSession(ifname, fd, session=None):
+  global recorderFlusher
+  if session is None:
+    session = Session(ifname, fd)
+  if recordDir is not None:
+    session.recorder = PcapRecorder(recordDir, ifname, recordRing, recordFileSize, recordFiles)
+    if recorderFlusher is None:
+      recorderFlusher = RecorderFlusher()
+      recorderFlusher.start()
+    recorderFlusher.add(session.recorder)
+  session.macTable = CamTable(camSize, camAging)
+  session.flows = ConnTable()
+  # Compile the host table, and the initial entries in the client lists
+  session.hosts = compileHosts(hostDeclarations, hostRanges, [ipToInt(playerIP)])
+  for host in session.hosts.values():
+    if host.internal:
+      session.internalClients[host.ip] = getInternalMAC(host.ip)
+    else:
+      session.clients.setdefault(host.ip, getMAC(host.ip))
+    session.openPorts[host.ip] = host.ports
+  if admissionBudgets is not None:
+    session.admission = AdmissionControl(session.hosts, admissionBudgets)
+  if links:
+    session.link = LinkEmulator(session, links)
+  if batchPath and batchAvailable:
+    session.batch = batchReplier(session)
+  return session
+
+# A BatchReplier for the session's hosts
+def batchReplier(session):
+  return BatchReplier(session.hosts, answersEcho, lambda host: hostArpTemplate(session, host))
+
+# Creates the partition of the game served from one queue of a multi-queue tap, with
+#  its share of the CAM table
+def newQueueSession(ifname, fd, queue):
+  session = newSession(ifname, fd, QueueSession(ifname, fd, queueState, queue))
+  session.macTable = CamTable(max(1, camSize // queueState.queues), camAging)
+  return session
+
+# The visible clients' initial MACs
+def initialClients():
+  return dict((ip, getMAC(ip)) for ip, internal, handler, ports, filtered, synHooks
+              in hostDeclarations if not internal)
 
 
 # TUN/TAP Interface Setup
@@ -634,9 +974,10 @@ IFF_TUN = 0x0001
 IFF_TAP = 0x0002
 IFF_NO_PI = 0x1000
 TUNMODE = IFF_TAP
+IFF_MULTI_QUEUE = 0x0100
 TUNSETOWNER = TUNSETIFF + 2
 
-# Open TUN device file, create tap0
+# Open TUN device file, create the named tap device (ie, tap0)
 #
 #  To open a new transient device, put "tap%d" into ioctl() below.
 #  To open a persistent device, use "tap0" or the actual full name.
@@ -649,49 +990,523 @@ TUNSETOWNER = TUNSETIFF + 2
 #  Copied from https://gist.github.com/glacjay/585369 
 #   IFF_NO_PI is important! Otherwise, tap will add 4 extra bytes per packet, 
 #     and this will confuse Scapy parsing.
-tun = os.open("/dev/net/tun", os.O_RDWR)
-ifs = ioctl(tun, TUNSETIFF, struct.pack("16sH", "tap0", TUNMODE | IFF_NO_PI))
-ifname = ifs[:16].strip("\x00")  # will be tap0
-
-# Optionally, we want tap0 be accessed by the normal user.
-fcntl.ioctl(tun, TUNSETOWNER, 1000)
+#
+#  Every player's network uses the same addresses, so with more than one player
+#   each tap can be moved into its own network namespace (netns) first. A tap in a
+#   netns is configured with ifconfig/route run inside it; otherwise it is set up
+#   directly, with ioctls and rtnetlink (see netConfig.py), without forking.
+def openTap(name, netns=None):
+  tun, ifname = attachTap(name, TUNMODE | IFF_NO_PI)
+
+  # Optionally, we want the tap be accessed by the normal user.
+  fcntl.ioctl(tun, TUNSETOWNER, 1000)
+
+  if netns is None:
+    configurePlayerTap(ifname)
+    return tun, ifname
+
+  if not os.path.exists("/var/run/netns/%s" % netns):
+    subprocess.check_call("ip netns add %s" % netns, shell=True)
+  subprocess.check_call("ip link set %s netns %s" % (ifname, netns), shell=True)
+  prefix = "ip netns exec %s " % netns
+
+  subprocess.check_call(prefix + "ifconfig %s down" % ifname, shell=True)
+  subprocess.check_call(prefix + "ifconfig %s hw ether 12:67:7e:b7:6d:c8" % ifname, shell=True)
+  subprocess.check_call(prefix + "ifconfig %s 10.5.0.1 netmask 255.255.255.0 broadcast 10.5.0.255 up" % ifname, shell=True)
+  for net, netmask, gateway in playerRoutes():
+    via = ""
+    if gateway is not None:
+      via = "gw %s " % gateway
+    subprocess.check_call(prefix + "route add -net %s netmask %s %sdev %s" % (net, netmask, via, ifname), shell=True)
+  return tun, ifname
+
+# Opens a queue of the named tap device (the device itself, for its first queue),
+#  returning (fd, ifname)
+def attachTap(name, flags):
+  tun = os.open("/dev/net/tun", os.O_RDWR)
+  ifs = fcntl.ioctl(tun, TUNSETIFF, struct.pack("16sH", name.encode(), flags))
+  return tun, ifs[:16].strip(b"\x00").decode()  # will be the name asked for
+
+# Opens the named tap device with count queues (IFF_MULTI_QUEUE), returning (fds,
+#  ifname): the kernel hashes each flow it sends to the tap onto one of the queues
+def openTapQueues(name, count):
+  queues = [attachTap(name, TUNMODE | IFF_NO_PI | IFF_MULTI_QUEUE) for i in range(count)]
+  fds = [tun for tun, ifname in queues]
+  ifname = queues[0][1]
+  fcntl.ioctl(fds[0], TUNSETOWNER, 1000)
+  configurePlayerTap(ifname)
+  return fds, ifname
+
+# Configures a tap in this network namespace as the player's end of the network
+def configurePlayerTap(ifname):
+  configureTap(ifname, "12:67:7e:b7:6d:c8", playerIP, "255.255.255.0", "10.5.0.255",
+               playerRoutes())
+
+# The player's routes, as (net, netmask, gateway or None - on the link): the internal
+#  network through the gateway, and every range of hosts (see --hosts)
+def playerRoutes():
+  routes = [("10.1.8.0", "255.255.255.0", gatewayIP)]
+  for cidr, internal, handler, ports, filtered, macPrefix in hostRanges:
+    network, prefixLen = cidr.split("/")
+    netmask = intToIp((0xffffffff << (32 - int(prefixLen))) & 0xffffffff)
+    route = (intToIp(ipToInt(network) & ipToInt(netmask)), netmask, gatewayIP if internal else None)
+    # The player's own /24 is on the link already
+    if route[2] is None and int(prefixLen) >= 24 and route[0].startswith("10.5.0."):
+      continue
+    if route not in routes:
+      routes.append(route)
+  return routes
+
+
+# Command Line
+# -----
+# --asyncio - run the packet loop and daemons on one asyncio event loop instead of threads
+# --players - number of players, each on their own tap device (tap0, tap1, ...)
+# --netns   - move each player's tap device into its own network namespace (scapyhunt0, ...);
+#   needed with more than one player, or --workers
+# --workers - spread the players over this many worker processes (see supervisor.py)
+# --queues  - serve the one player's tap0 from this many queues, each with its own
+#   worker process and partition of the game (see multiQueue.py)
+# --cam-size, --cam-aging - CAM table capacity and entry aging time (see camTable.py)
+# --record, --record-ring, --record-file-size, --record-files - record every player's
+#   traffic to rotating pcap files (see recorder.py)
+# --stats, --stats-interval - keep metrics, and dump them to this file every so often
+#   (see metrics.py; with --workers each worker writes its own, suffixed with its pid)
+# --batch - answer bursts of probes all at once, with NumPy (see batchReplies.py)
+# --noise-rate - frames/sec of background traffic through the gateway (see GatewayNoise)
+# --scenario - directory of extra files served by the internal FTP server (see loadScenario)
+# --profile-dir, --profile-duration - where SIGUSR2's profiles are written, and how
+#   long they run for (see installProfiler)
+# --hosts, --internal-hosts - add a CIDR range of hosts, on the player's network or
+#   behind the gateway, all with the same port profile (see hostRanges)
+# --link - give the hosts of a network latency, jitter and loss (see linkEmulator.py)
+# --admission, --budget - shed each source's frames over its budget for their class,
+#   before they are handled (see admission.py)
+# --pool, --pool-socket - instead of serving a fixed set of players, keep this many
+#   games ready and hand one to each player connecting to the socket (see sessionPool.py).
+#   Every game has its own tap and network namespace (tap<n> in scapyhunt<n>).
+
+# Parses a --hosts range, CIDR[:PROFILE], into (CIDR, profile name)
+def parseHostRange(text):
+  cidr, sep, profile = text.partition(":")
+  network, sep, prefixLen = cidr.partition("/")
+  if (network.count(".") != 3 or not prefixLen.isdigit() or not 8 <= int(prefixLen) <= 30 or
+      not all(part.isdigit() and int(part) < 256 for part in network.split("."))):
+    raise ValueError("host range %r should be a CIDR block from /8 to /30" % text)
+  profile = profile or "workstation"
+  if profile not in portProfiles:
+    raise ValueError("host range %r should have one of the profiles %s" %
+                     (text, "/".join(sorted(portProfiles))))
+  return cidr, profile
+
+parser = argparse.ArgumentParser(description="scapyHunt - network security puzzles over a tap device")
+parser.add_argument("--asyncio", action="store_true",
+                    help="run the packet loop and simulated traffic on an asyncio event loop")
+parser.add_argument("--players", type=int, default=1,
+                    help="number of players served by this process, one tap device each "
+                         "(more than one implies --asyncio)")
+parser.add_argument("--netns", action="store_true",
+                    help="move each player's tap device into its own network namespace "
+                         "(needed with more than one player, or --workers)")
+parser.add_argument("--workers", type=int, default=0,
+                    help="serve the players from this many worker processes, "
+                         "each with its own event loop")
+parser.add_argument("--queues", type=int, default=1,
+                    help="serve tap0 from this many queues (IFF_MULTI_QUEUE), each with its own "
+                         "worker process and partition of the game")
+parser.add_argument("--cam-size", type=int, default=camSize,
+                    help="MAC addresses the simulated switch learns before it overflows")
+parser.add_argument("--cam-aging", type=float, default=camAging,
+                    help="seconds before an unused MAC ages out of the switch's CAM table")
+parser.add_argument("--record", metavar="DIR",
+                    help="record every frame in and out of each tap to DIR/<tap>-<n>.pcap")
+parser.add_argument("--record-ring", type=int, default=recordRing >> 20, metavar="MB",
+                    help="per-player recording buffer; frames that don't fit are dropped from the recording")
+parser.add_argument("--record-file-size", type=int, default=recordFileSize >> 20, metavar="MB",
+                    help="size at which a recording moves on to its next pcap file")
+parser.add_argument("--record-files", type=int, default=recordFiles,
+                    help="pcap files kept per player, older ones are deleted")
+parser.add_argument("--stats", metavar="PATH",
+                    help="count and time frames, handlers and replies, writing them to PATH as JSON")
+parser.add_argument("--stats-interval", type=float, default=1.0,
+                    help="seconds between rewrites of the --stats file")
+parser.add_argument("--pool", type=int, default=0, metavar="SIZE",
+                    help="keep SIZE games ready in pre-forked processes, handing one to each "
+                         "player that connects to --pool-socket (for the length of the connection)")
+parser.add_argument("--pool-socket", default="/run/scapyhunt.sock", metavar="PATH",
+                    help="unix socket players connect to for a game in --pool mode")
+parser.add_argument("--noise-rate", type=float, default=noiseRate, metavar="PPS",
+                    help="frames/sec of background traffic through the gateway once the knock is solved")
+parser.add_argument("--batch", action="store_true",
+                    help="answer bursts of probes all at once (with NumPy), rather than every frame "
+                         "on its own; faster on SYN scans and sweeps of --hosts ranges, slower on other traffic")
+parser.add_argument("--profile-dir", default=profileDir, metavar="DIR",
+                    help="directory SIGUSR2 writes sampling profiles to, as collapsed stacks")
+parser.add_argument("--profile-duration", type=float, default=profileDuration, metavar="SECONDS",
+                    help="how long each SIGUSR2 profile samples for (another SIGUSR2 stops it sooner)")
+parser.add_argument("--hosts", action="append", type=parseHostRange, metavar="CIDR[:PROFILE]",
+                    help="add a host at every address of CIDR on the player's network, with the ports "
+                         "of PROFILE (%s; workstation by default); may be repeated" %
+                         "/".join(sorted(portProfiles)))
+parser.add_argument("--internal-hosts", action="append", type=parseHostRange, metavar="CIDR[:PROFILE]",
+                    help="as --hosts, for hosts behind the 10.5.0.35 gateway")
+parser.add_argument("--link", action="append", type=parseLink, metavar="CIDR=LATENCY[:JITTER[:LOSS]]",
+                    help="hold back what the hosts of CIDR send by LATENCY ms, give or take up to "
+                         "JITTER ms, and lose LOSS%% of it (ie, 10.1.8.0/24=40:10:1 behind the "
+                         "gateway); may be repeated")
+parser.add_argument("--admission", action="store_true",
+                    help="shed frames over their source's budget (per protocol) before handling them")
+parser.add_argument("--budget", action="append", type=parseBudget, metavar="CLASS=RATE[:BURST]",
+                    help="frames/sec (and burst) a source may send of a class - arp, icmp, syn or "
+                         "tcp - before being shed; may be repeated, implies --admission")
+parser.add_argument("--scenario", metavar="DIR",
+                    help="serve the files in DIR from the internal FTP server, besides topSecret.txt")
 
-subprocess.check_call("ifconfig %s down" % ifname, shell=True)
-subprocess.check_call("ifconfig %s hw ether 12:67:7e:b7:6d:c8" % ifname, shell=True)
-subprocess.check_call("ifconfig %s 10.5.0.1 netmask 255.255.255.0 broadcast 10.5.0.255 up" % ifname, shell=True)
-subprocess.check_call("route add -net 10.1.8.0 netmask 255.255.255.0 gw 10.5.0.35 dev %s" % ifname, shell=True)
 
 # Defaults and Main Loop
 # -----
-# Main loop processes packets by reading directly from the TUN/TAP interface and transforming
-#  into scapy packets 
-
-# Initial entries in the client list
-clients['10.5.0.4'] = getMAC('10.5.0.4')
-clients['10.5.0.6'] = getMAC('10.5.0.6')
-clients['10.5.0.35'] = getMAC('10.5.0.35')
-# Initial entries in the internal network's client list
-internalClients['10.1.8.6'] = getInternalMAC('10.1.8.6')
-internalClients['10.1.8.22'] = getInternalMAC('10.1.8.22')
-internalClients['10.1.8.2'] = getInternalMAC('10.1.8.2')
-# Initial ports in each client's open port list
-openPorts['10.5.0.4'] = [20,21,22,80,443]
-openPorts['10.5.0.6'] = [80,22] 
-openPorts['10.5.0.35'] = [20,21,22,25,80,443,8080]
-openPorts['10.1.8.6'] = [21, 25]
-openPorts['10.1.8.2'] = [20, 80, 443]
-openPorts['10.1.8.22'] = [20, 22, 80, 443]
-
-print("The game is now running- tap0 interface allocated.\nEnding the process will deallocate this interface and release all state.")
-
-def signal_handler(signal,frame):
-  print("Exiting game and deallocating the tap0 interface.")
-  sys.exit(0)
-
-signal.signal(signal.SIGINT, signal_handler)
-
-#  Main loop, reads and processes packets
-while 1:
-  binary_packet = os.read(tun, 2048)   # get packet routed to our "network"
-  packet = Ether(binary_packet)        # Scapy parses byte string into its packet object
-  processPacket(packet)
+# Main loop processes packets by reading directly from the TUN/TAP interfaces and handing
+#  the raw frames to processPacket. Frames are read in batches by TapReader (tapReader.py)
+#  into reused buffers, so a frame is only valid while processPacket handles it.
+
+# Scan Fast Path
+# -----
+# A port scan (ie, nmap -sS -p-) is almost entirely bare SYNs, each answered with a
+#  SYN-ACK or RST-ACK straight from the target's port index. Those are recognised
+#  from a few header bytes and answered without parsing a Frame or calling the
+#  handler. Anything else - options in the IP header, fragments, other flags, or a
+#  port in the host's synHooks - goes through processPacket as usual.
+
+# Source MAC, EtherType, IPv4 version/IHL, fragment word, protocol, destination,
+#  TCP ports, seq, data offset byte (holds NS) and flags byte, from byte 6 of the frame
+synHeader = struct.Struct("!6sHB5xHxB6xIHHI4xBB")
+
+# Index of the fast path's count in Session.frameCounts (after the frame kinds)
+SCAN_COUNT = 5
+
+# Answers a bare SYN from the port index. Returns False if processPacket has to handle it.
+def scanReply(session, data):
+  if len(data) < 54:
+    return False
+  (src, etherType, verIhl, frag, proto, dst, sport, dport, seq,
+      offsetByte, flags) = synHeader.unpack_from(data, 6)
+  if (etherType != 0x0800 or verIhl != 0x45 or proto != 6 or flags != 0x02 or
+      frag & 0x1fff or offsetByte & 0x01):
+    return False
+  host = session.hosts.get(dst)
+  if host is None:
+    return False
+  hooks = host.synHooks
+  if hooks is None or dport in hooks:
+    return False
+
+  macTableEntry(session, src)
+  session.frameCounts[SCAN_COUNT] += 1
+  state = host.ports.state(dport)
+  if state == PORT_OPEN:
+    session.writer.write(replyEngine.tcpReplyAt(data, 34, 0x012, 0x1000, seq + 1))
+  elif state == PORT_CLOSED:
+    session.writer.write(replyEngine.tcpReplyAt(data, 34, 0x014, 0, seq))
+  return True
+
+# Handles a frame admission control shed or passed over (see admission.py): the
+#  switch learns its source MAC (so macof still overflows the CAM table), nothing
+#  else is done with it
+def shedFrame(session, data):
+  if len(data) >= 14:
+    macTableEntry(session, bytes(data[6:12]))
+
+# Batch Path
+# -----
+# A wakeup that drains at least BATCH_MIN frames has the probes among them (ARP
+#  who-has, ICMP echo-requests and the bare SYNs scanReply answers) answered all at
+#  once (see batchReplies.py); the rest go through scanReply/processPacket in order
+#  around them. Smaller batches aren't worth NumPy's overhead.
+
+BATCH_MIN = 16
+
+# Answers a batch's probes all at once, and every other frame as processBatch would
+def batchReply(session, frames):
+  replies, counts = session.batch.replies(frames)
+  frameCounts = session.frameCounts
+  frameCounts[FRAME_ARP] += counts[FRAME_ARP]
+  frameCounts[FRAME_ICMP] += counts[FRAME_ICMP]
+  frameCounts[SCAN_COUNT] += counts["scan"]
+  writer = session.writer
+  pending = []
+  lastSrc = None
+  for i, data in enumerate(frames):
+    reply = replies[i]
+    if reply is None:
+      if pending:
+        writer.writeMany(pending)
+        pending = []
+      lastSrc = None
+      if not scanReply(session, data):
+        processPacket(session, data)
+      continue
+    # The switch learns every frame's source; a run of frames from one source (ie,
+    #  a scan) refreshes its entry once
+    src = data[6:12]
+    if src != lastSrc:
+      lastSrc = bytes(src)
+      macTableEntry(session, lastSrc)
+    if reply is not NO_REPLY:
+      pending.append(reply)
+  if pending:
+    writer.writeMany(pending)
+
+# Processes every frame drained from a session's tap on one wakeup
+def processBatch(session, batch):
+  admission = session.admission
+  if admission is not None:
+    now = admission.clock()
+    admit = admission.admit
+  if session.batch is not None and len(batch) >= BATCH_MIN and session.batch.wanted():
+    if admission is not None:
+      admitted = []
+      for binary_packet in batch:
+        if admit(binary_packet, now):
+          admitted.append(binary_packet)
+        else:
+          shedFrame(session, binary_packet)
+      batch = admitted
+    # (a flood can be shed whole)
+    if batch:
+      batchReply(session, batch)
+  else:
+    for binary_packet in batch:   # get packets routed to our "network"
+      if admission is not None and not admit(binary_packet, now):
+        shedFrame(session, binary_packet)
+      elif not scanReply(session, binary_packet):
+        processPacket(session, binary_packet)
+  if session.reader.overflowed:
+    reportDrops(session)
+
+# Seconds between reports of frames the kernel dropped from a session's tap queue
+#  (they are counted all along, see metrics.py's droppedIn)
+DROP_REPORT_INTERVAL = 5.0
+
+# Prints how many frames the tap queue dropped since the last report, at most once
+#  every DROP_REPORT_INTERVAL, so a flood doesn't also have the packet loop writing
+#  to stdout for every batch
+def reportDrops(session):
+  reader = session.reader
+  now = time.monotonic()
+  if now - reader.reportedAt < DROP_REPORT_INTERVAL:
+    return
+  print("%s queue overflowed: %d frames dropped since the last report (batch of %d)" %
+        (session.ifname, reader.totalDropped - reader.reportedDropped, reader.batchSize))
+  reader.reportedDropped = reader.totalDropped
+  reader.reportedAt = now
+
+# Instrumentation
+# -----
+# Every session counts its frames per protocol (session.frameCounts) and its tap's
+#  reader/writer count frames and bytes. With --stats, enableMetrics also wraps the
+#  handlers and the reply builders with timed versions (see metrics.py); without it
+#  they are called directly, and only the rare progress() markers check.
+
+metrics = None
+statsFile = None
+statsInterval = 1.0
+
+# Reply builders timed with --stats
+instrumentedReplies = ("arpIsAt", "icmpEchoReply", "tcpSA", "tcpRA", "tcpFA", "tcpA",
+                       "smtpInit", "smtpResp", "ftpInit", "ftpResp", "batchReply")
+
+# Records a player reaching a step of the game (hubMode, knockSolved, ftpLogin, payloadRetrieved)
+def progress(session, marker):
+  if metrics is not None:
+    metrics.mark(session, marker)
+
+def enableMetrics():
+  global metrics, hostDeclarations, hostRanges
+  metrics = Metrics()
+  names = globals()
+  for name in instrumentedReplies:
+    names[name] = metrics.timed("reply." + name, names[name])
+  # Sessions created from now on get the timed handlers
+  hostDeclarations = [(ip, internal, metrics.timed("handler." + handler.__name__, handler),
+                       ports, filtered, synHooks)
+                      for ip, internal, handler, ports, filtered, synHooks in hostDeclarations]
+  hostRanges = [(cidr, internal, metrics.timed("handler." + handler.__name__, handler),
+                 ports, filtered, macPrefix)
+                for cidr, internal, handler, ports, filtered, macPrefix in hostRanges]
+
+# Profiling
+# -----
+# SIGUSR2 starts (or stops early) a sampling profile of the process receiving it,
+#  written to profileDir after profileDuration seconds (see profiler.py). Nothing
+#  runs until then. With --workers, --queues or --pool the signal goes to the
+#  supervisor (or pool), which passes it on to every worker (or pooled game);
+#  each writes its own profile.
+
+def installProfiler():
+  profiler = SamplingProfiler(profileDir, profileDuration)
+  signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
+  return profiler
+
+# Body of each worker process in --workers mode
+def serveWorker(control, index):
+  installProfiler()
+  runtime = AsyncioRuntime(processBatch)
+  if metrics is not None:
+    metrics.start("%s.%d" % (statsFile, os.getpid()), runtime.sessions, statsInterval)
+  runWorker(control, runtime, newSession)
+
+# The game state shared by the workers in --queues mode (see multiQueue.py)
+queueState = None
+
+# Body of each worker process in --queues mode: serves the queue of the same index
+def serveQueueWorker(control, index):
+  installProfiler()
+  runtime = AsyncioRuntime(processBatch)
+  if metrics is not None:
+    metrics.start("%s.%d" % (statsFile, os.getpid()), runtime.sessions, statsInterval)
+  def newQueue(ifname, fd):
+    session = newQueueSession(ifname, fd, index)
+    # First resumed once the loop runs, after runWorker has added the session
+    runtime.spawn(session, watchEvents(session))
+    return session
+  runWorker(control, runtime, newQueue)
+
+# Body of each pre-forked process in --pool mode: a new tap, in a network namespace
+#  of its own, with a fresh session, ready for a player
+def preparePoolGame(serial):
+  installProfiler()
+  tun, ifname = openTap("tap%d" % serial, "scapyhunt%d" % serial)
+  runtime = AsyncioRuntime(processBatch)
+  runtime.addSession(newSession(ifname, tun))
+  if metrics is not None:
+    metrics.start("%s.%d" % (statsFile, os.getpid()), runtime.sessions, statsInterval)
+  return "%s scapyhunt%d" % (ifname, serial), runtime
+
+# Removes a pooled game's namespace once it is over (the tap goes with the process)
+def releasePoolGame(serial):
+  if recorderFlusher is not None:
+    for recorder in recorderFlusher.recorders:
+      recorder.close()
+  subprocess.call("ip netns del scapyhunt%d" % serial, shell=True)
+
+# Does once, before forking, what every pooled game would otherwise do itself:
+#  builds the hosts' port bitmaps (see portIndex.py)
+def warmUp():
+  compileHosts(hostDeclarations)
+
+# Opens the tap devices for every player, as (fd, ifname)
+def openTaps(args):
+  taps = []
+  for i in range(args.players):
+    netns = None
+    if args.netns:
+      netns = "scapyhunt%d" % i
+    taps.append(openTap("tap%d" % i, netns))
+  return taps
+
+def main():
+  global camSize, camAging, statsFile, statsInterval, noiseRate, admissionBudgets, queueState
+  global batchPath, profileDir, profileDuration, links
+  global recordDir, recordRing, recordFileSize, recordFiles
+  args = parser.parse_args()
+  camSize = args.cam_size
+  camAging = args.cam_aging
+  noiseRate = args.noise_rate
+  batchPath = args.batch
+  profileDir = args.profile_dir
+  profileDuration = args.profile_duration
+  if args.scenario:
+    loadScenario(args.scenario)
+  for internal, ranges, macPrefix in ((False, args.hosts, rangeMACPrefix),
+                                      (True, args.internal_hosts, internalRangeMACPrefix)):
+    for cidr, profile in ranges or []:
+      ports, filtered = portProfiles[profile]
+      hostRanges.append((cidr, internal, rangeHost, ports, filtered, macPrefix))
+  links = args.link or []
+  if args.admission or args.budget:
+    admissionBudgets = dict(args.budget or [])
+  if args.record:
+    if not os.path.isdir(args.record):
+      os.makedirs(args.record)
+    recordDir = args.record
+    recordRing = args.record_ring << 20
+    recordFileSize = args.record_file_size << 20
+    recordFiles = args.record_files
+  if args.stats:
+    statsFile = args.stats
+    statsInterval = args.stats_interval
+    enableMetrics()
+
+  if args.queues > 1 and (args.players > 1 or args.workers or args.pool or args.netns):
+    parser.error("--queues serves a single player, without --players, --workers, --pool or --netns")
+  # Every player's tap gets the same addresses and routes, which only one tap in a
+  #  namespace can have
+  if (args.players > 1 or args.workers) and not args.netns:
+    parser.error("--players and --workers need --netns, each player's tap has the same routes")
+
+  taps = []
+  ifnames = "each player's"
+  if args.queues > 1:
+    fds, ifname = openTapQueues("tap0", args.queues)
+    taps = [(fd, ifname) for fd in fds]
+    ifnames = ifname
+  elif not args.pool:
+    taps = openTaps(args)
+    ifnames = ", ".join([ifname for tun, ifname in taps])
+
+  # The pool's games each open their own tap, once they are forked
+  if args.pool:
+    warmUp()
+    runtime = SessionPool(args.pool, args.pool_socket, preparePoolGame, releasePoolGame)
+    runtime.start()
+
+  elif args.workers:
+    # The supervisor keeps every tap open and hands them out to the workers
+    runtime = Supervisor(args.workers, serveWorker)
+    runtime.start()
+    for tun, ifname in taps:
+      runtime.addPlayer(ifname, tun)
+
+  elif args.queues > 1:
+    # One queue to each worker, in order (each goes to the least-loaded one)
+    queueState = SharedState(args.queues, initialClients())
+    runtime = Supervisor(args.queues, serveQueueWorker)
+    runtime.start()
+    for tun, ifname in taps:
+      runtime.addPlayer(ifname, tun)
+
+  # All taps are multiplexed on a single event loop when serving several players
+  elif args.asyncio or args.players > 1:
+    runtime = AsyncioRuntime(processBatch)
+  else:
+    runtime = ThreadRuntime(processBatch)
+
+  if not args.workers and not args.pool and args.queues <= 1:
+    for tun, ifname in taps:
+      runtime.addSession(newSession(ifname, tun))
+    if metrics is not None:
+      metrics.start(statsFile, runtime.sessions, statsInterval)
+
+  print("The game is now running- %s interface allocated.\nEnding the process will deallocate this interface and release all state." % ifnames)
+
+  def signal_handler(signal,frame):
+    print("Exiting game and deallocating the %s interface." % ifnames)
+    if args.workers or args.pool or args.queues > 1:
+      runtime.stop()
+    if recorderFlusher is not None:
+      for recorder in recorderFlusher.recorders:
+        recorder.close()
+    sys.exit(0)
+
+  signal.signal(signal.SIGINT, signal_handler)
+  if args.workers or args.pool or args.queues > 1:
+    signal.signal(signal.SIGUSR2, lambda signum, frame: runtime.signalChildren(signum))
+  else:
+    installProfiler()
+
+  #  Main loop, drains every queued frame on each wakeup and processes the batch
+  #   (or, with --workers, restarts any worker that dies)
+  runtime.run()
+
+if __name__ == '__main__':
+  main()
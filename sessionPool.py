@@ -0,0 +1,235 @@
+#
+# Pre-forked session pool for scapyHunt.py
+#
+# A fork server for games started on demand (ie, one per student login): the parent
+# process has everything imported and warmed up once, and keeps a pool of forked
+# children, each of which has already opened and configured its own tap device and
+# built its session. A player asks for a game by connecting to the pool's unix
+# socket:
+#  - the parent answers with where a ready child's game is (ie, its tap and network
+#    namespace, "tap3 scapyhunt3\n") and hands the connection to that child with
+#    SCM_RIGHTS, which starts serving the tap
+#  - the child serves the player for as long as the connection stays open, and
+#    exits when it is closed (taking its tap with it)
+#  - the parent forks a replacement straight away, which gets ready in the
+#    background while the pool keeps answering
+# Players arriving while no child is ready wait for the next one.
+#
+
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+
+from metrics import Histogram
+
+# A child that died before getting ready sooner than this after being forked is
+#  replaced after a pause, so a child that can't open its tap doesn't become a fork loop
+RESPAWN_BACKOFF = 1.0
+
+# Parent-side handle on a pooled child
+#  serial - numbers the pool's children, so each game's tap and namespace get names
+#           of their own
+#  game   - where the child's game is, once it is ready (None while it is still
+#           setting up)
+#  player - True once the child has been handed a player
+class PoolEntry(object):
+  __slots__ = ("serial", "pid", "control", "game", "player", "forked")
+
+  def __init__(self, serial, pid, control):
+    self.serial = serial
+    self.pid = pid
+    self.control = control
+    self.game = None
+    self.player = False
+    self.forked = time.time()
+
+class SessionPool(object):
+
+  # size    - children kept ready for new players
+  # path    - the unix socket players connect to
+  # prepare - function(serial) run in each forked child, returning where its game
+  #           is (as told to the player) and the runtime serving it, see runPoolChild
+  # release - function(serial) run as the child exits, after its runtime stopped
+  def __init__(self, size, path, prepare, release):
+    self.size = size
+    self.path = path
+    self.prepare = prepare
+    self.release = release
+    self.serials = 0
+    self.entries = dict()   # control fd -> PoolEntry
+    self.ready = []
+    # Connections waiting for a ready child, with when they were accepted (ns)
+    self.waiting = []
+    self.selector = selectors.DefaultSelector()
+    self.listener = None
+    self.stopping = False
+    self.announced = False
+
+    # Accounting
+    #  latency - time from accepting a player's connection to handing it to a child
+    #  served  - players handed a game
+    self.latency = Histogram()
+    self.served = 0
+
+  def start(self):
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.listener.bind(self.path)
+    self.listener.listen(64)
+    self.selector.register(self.listener, selectors.EVENT_READ)
+    for i in range(self.size):
+      self.spawn()
+
+  # Forks a child that prepares its session and then waits for a player
+  def spawn(self):
+    serial = self.serials
+    self.serials += 1
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        parent.close()
+        self.listener.close()
+        self.selector.close()
+        for entry in self.entries.values():
+          entry.control.close()
+        for conn, accepted in self.waiting:
+          conn.close()
+        runPoolChild(child, self.prepare, self.release, serial)
+        status = 0
+      finally:
+        os._exit(status)
+
+    child.close()
+    entry = PoolEntry(serial, pid, parent)
+    self.entries[parent.fileno()] = entry
+    self.selector.register(parent, selectors.EVENT_READ)
+
+  # Hands waiting players to ready children, forking a replacement for each
+  def dispatch(self):
+    while self.waiting and self.ready:
+      conn, accepted = self.waiting.pop(0)
+      entry = self.ready.pop(0)
+      try:
+        conn.sendall(("%s\n" % entry.game).encode())
+        socket.send_fds(entry.control, [b"player"], [conn.fileno()])
+      except OSError:
+        # The player already left; the child stays ready for the next one
+        conn.close()
+        self.ready.insert(0, entry)
+        continue
+      conn.close()
+      entry.player = True
+      latency = time.perf_counter_ns() - accepted
+      self.latency.add(latency)
+      self.served += 1
+      print("%s handed to a player in %.2f ms (%d ready)" %
+            (entry.game, latency / 1e6, len(self.ready)))
+      self.spawn()
+
+  def onControl(self, entry):
+    try:
+      msg = entry.control.recv(64)
+    except OSError:
+      msg = b""
+    if msg:
+      entry.game = msg.decode()
+      self.ready.append(entry)
+      if not self.announced and len(self.ready) == self.size:
+        self.announced = True
+        print("Session pool ready: %d games waiting for players on %s." % (self.size, self.path))
+      self.dispatch()
+      return
+
+    # The child exited (its player left, or it failed to set up)
+    self.selector.unregister(entry.control)
+    del self.entries[entry.control.fileno()]
+    entry.control.close()
+    try:
+      os.waitpid(entry.pid, 0)
+    except OSError:
+      pass
+    if entry in self.ready:
+      self.ready.remove(entry)
+    if entry.player or self.stopping:
+      return
+    print("Pooled game %d exited before a player joined, replacing it." % entry.serial)
+    if time.time() - entry.forked < RESPAWN_BACKOFF:
+      time.sleep(RESPAWN_BACKOFF)
+    self.spawn()
+
+  def onConnect(self):
+    conn, addr = self.listener.accept()
+    self.waiting.append((conn, time.perf_counter_ns()))
+    self.dispatch()
+
+  def run(self):
+    while not self.stopping:
+      for key, events in self.selector.select():
+        if key.fileobj is self.listener:
+          self.onConnect()
+        else:
+          entry = self.entries.get(key.fd)
+          if entry is not None:
+            self.onControl(entry)
+
+  # Passes a signal on to every child, ready or serving a player (ie, SIGUSR2 to
+  #  profile them)
+  def signalChildren(self, signum):
+    for entry in self.entries.values():
+      try:
+        os.kill(entry.pid, signum)
+      except OSError:
+        pass
+
+  # Stops every child, ready or serving a player
+  def stop(self):
+    self.stopping = True
+    for entry in list(self.entries.values()):
+      try:
+        os.kill(entry.pid, signal.SIGTERM)
+        os.waitpid(entry.pid, 0)
+      except OSError:
+        pass
+    if self.listener is not None:
+      self.listener.close()
+      os.unlink(self.path)
+
+# Body of a pooled child: prepares its session, reports where it is to the parent,
+#  then serves the player it is handed until they disconnect (or the parent goes
+#  away, or stops it with SIGTERM)
+def runPoolChild(control, prepare, release, serial):
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    game, runtime = prepare(serial)
+    control.send(game.encode())
+    msg, fds, flags, addr = socket.recv_fds(control, 64, 1)
+    if fds:
+      servePlayer(control, runtime, socket.socket(fileno=fds[0]))
+  finally:
+    release(serial)
+
+def servePlayer(control, runtime, player):
+  loop = runtime.loop
+
+  def onPlayer():
+    try:
+      data = player.recv(4096)
+    except OSError:
+      data = b""
+    if not data:
+      loop.stop()
+
+  def onControl():
+    if not control.recv(64):
+      loop.stop()
+
+  loop.add_reader(player.fileno(), onPlayer)
+  loop.add_reader(control.fileno(), onControl)
+  runtime.run()
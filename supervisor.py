@@ -0,0 +1,135 @@
+#
+# Multi-process supervisor for scapyHunt.py
+#
+# The supervisor owns every player's tap fd and spreads the sessions over a pool of
+# forked worker processes, each running its own AsyncioRuntime (and GIL). Tap fds
+# are handed to a worker over its control socket with SCM_RIGHTS:
+#  - a new player goes to the worker currently serving the fewest sessions
+#  - when a worker dies, only its own players are affected: the supervisor forks a
+#    replacement and hands it the same tap fds (their games restart from scratch)
+#
+
+import os
+import signal
+import socket
+import time
+
+# A worker that died sooner than this after being forked is restarted after a pause,
+#  so a worker that crashes on startup doesn't turn into a fork loop
+RESPAWN_BACKOFF = 1.0
+
+# Supervisor-side handle on a worker process
+#  sessions - (ifname, fd) of every tap the worker serves
+class Worker(object):
+  __slots__ = ("index", "pid", "control", "sessions", "started", "restarts")
+
+  def __init__(self, index):
+    self.index = index
+    self.pid = None
+    self.control = None
+    self.sessions = []
+    self.started = 0
+    self.restarts = 0
+
+class Supervisor(object):
+
+  # workerCount - number of worker processes
+  # serve       - function(control socket, worker index) run in each forked worker,
+  #               see runWorker
+  def __init__(self, workerCount, serve):
+    self.serve = serve
+    self.workers = [Worker(i) for i in range(workerCount)]
+    self.stopping = False
+
+  def start(self):
+    for worker in self.workers:
+      self.spawn(worker)
+
+  # Forks a worker process and hands it the sessions it is serving
+  def spawn(self, worker):
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        parent.close()
+        for other in self.workers:
+          if other.control is not None:
+            other.control.close()
+        self.serve(child, worker.index)
+        status = 0
+      finally:
+        os._exit(status)
+
+    child.close()
+    worker.pid = pid
+    worker.control = parent
+    worker.started = time.time()
+    for ifname, fd in worker.sessions:
+      self.send(worker, ifname, fd)
+
+  def send(self, worker, ifname, fd):
+    socket.send_fds(worker.control, [ifname.encode()], [fd])
+
+  # Places a new player's tap on the least-loaded worker
+  def addPlayer(self, ifname, fd):
+    worker = min(self.workers, key=lambda w: len(w.sessions))
+    worker.sessions.append((ifname, fd))
+    self.send(worker, ifname, fd)
+    return worker
+
+  # Passes a signal on to every running worker (ie, SIGUSR2 to profile them)
+  def signalChildren(self, signum):
+    for worker in self.workers:
+      if worker.pid is not None:
+        try:
+          os.kill(worker.pid, signum)
+        except OSError:
+          pass
+
+  # Waits on the workers, restarting any that exit
+  def run(self):
+    while not self.stopping:
+      pid, status = os.wait()
+      for worker in self.workers:
+        if worker.pid == pid:
+          break
+      else:
+        continue
+      worker.control.close()
+      worker.control = None
+      worker.pid = None
+      if self.stopping:
+        break
+      print("Worker %d (%d players) exited with status %d, restarting it." %
+            (worker.index, len(worker.sessions), status))
+      if time.time() - worker.started < RESPAWN_BACKOFF:
+        time.sleep(RESPAWN_BACKOFF)
+      worker.restarts += 1
+      self.spawn(worker)
+
+  # Stops and reaps every worker (their taps stay open in the supervisor until it exits)
+  def stop(self):
+    self.stopping = True
+    for worker in self.workers:
+      if worker.pid is not None:
+        try:
+          os.kill(worker.pid, signal.SIGTERM)
+          os.waitpid(worker.pid, 0)
+        except OSError:
+          pass
+        worker.pid = None
+
+# Body of a worker process: serves every tap the supervisor sends it on runtime.
+#  newSession(ifname, fd) builds a session for each; the worker exits when the
+#  supervisor closes the control socket.
+def runWorker(control, runtime, newSession):
+  def onControl():
+    msg, fds, flags, addr = socket.recv_fds(control, 64, 1)
+    if not msg:
+      runtime.loop.stop()
+      return
+    runtime.addSession(newSession(msg.decode(), fds[0]))
+  runtime.loop.add_reader(control.fileno(), onControl)
+  runtime.run()
@@ -1,21 +1,69 @@
 #
-# Contains global state variables for scapyHunt.py
-#
+# Contains the state of a game session for scapyHunt.py
+#  Every player gets their own Session, on their own tap device; nothing in it is
+#  shared with any other player. A game served over the queues of a multi-queue tap
+#  has a Session per queue, sharing a few fields (see multiQueue.py).
 #
 
-clientList = dict()
-internalClientList = dict()
-clientOpenPorts = dict()
-macTable = 0
-hubMode = False
+class Session(object):
+  __slots__ = ("ifname", "fd", "reader", "writer", "runtime", "recorder",
+               "clients", "internalClients", "openPorts", "hosts",
+               "macTable", "hubMode",
+               "knockSequence", "flows", "wheel", "traffic", "link", "admission", "batch",
+               "frameCounts", "shared", "queue")
+
+  def __init__(self, ifname, fd):
+    # The session's tap device, and the runtime/reader/writer serving it
+    self.ifname = ifname
+    self.fd = fd
+    self.reader = None
+    self.writer = None
+    self.runtime = None
+    # Records the tap's traffic to pcap files - a PcapRecorder (see recorder.py), or None
+    self.recorder = None
+    # For a game served over several queues (see multiQueue.py): the SharedState of
+    #  the whole game, and this session's queue
+    self.shared = None
+    self.queue = 0
+
+    # Visible clients - Key is IP, Value is MAC Addr.
+    self.clients = dict()
+    # Clients in the internal network behind .35 - Key is IP, value is MAC Addr.
+    self.internalClients = dict()
+    # Dictionary associating each client to a list of their open ports.
+    self.openPorts = dict()
+    # Every client, keyed by packed IPv4 address - Value is a Host (see hostTable.py).
+    self.hosts = dict()
+    # The switch's CAM table (simulated) for exploiting purposes - a CamTable (see camTable.py).
+    #  hubMode is set while it is overflowed and the switch floods every frame.
+    self.macTable = None
+    self.hubMode = False
+
+    self.knockSequence = 0
+
+    # TCP connections to the SMTP/FTP services - a ConnTable (see connTable.py).
+    self.flows = None
+
+    # Runs whatever the session does later - a TimingWheel (see timingWheel.py), started
+    #  with the first thing scheduled on it
+    self.wheel = None
+
+    # Runs the simulated hosts' traffic on the wheel - a TrafficScheduler (see
+    #  trafficGen.py), started with the first generator
+    self.traffic = None
+
+    # Holds back the frames of hosts on emulated links - a LinkEmulator (see
+    #  linkEmulator.py), or None
+    self.link = None
 
-knockSequence = 0
+    # Sheds frames over their source's budget before they are handled - an
+    #  AdmissionControl (see admission.py), or None
+    self.admission = None
 
-smtpSeqNumber = 0
-smtpIsAlive = False
+    # Answers bursts of probes all at once - a BatchReplier (see batchReplies.py), or
+    #  None
+    self.batch = None
 
-ftpSeqNumber = 0
-ftpIsAlive = False
-ftpUserEntered = False
-ftpPassEntered = False
-ftpUser = None
+    # Frames handled, by fastPath kind (index), then by the scan fast path (last)
+    #  - see metrics.FRAME_COUNT_NAMES
+    self.frameCounts = [0] * 6
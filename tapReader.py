@@ -0,0 +1,117 @@
+#
+# Non-blocking, batch-draining reader for the tap device
+#
+# Waits on the tap fd with epoll (or is told it is readable by an event loop, see
+# runtime.py) and, on each wakeup, drains every queued frame into a pool of
+# preallocated buffers with readv (no new bytes object per frame). The frames
+# handed out are memoryviews into the pool, and are only valid until the next
+# call to readBatch/drain.
+#
+
+import errno
+import fcntl
+import os
+import select
+
+# Allocates a pool of read buffers (as writable memoryviews). poolSize is the most
+#  frames returned by a single readBatch/drain.
+def allocateBuffers(poolSize=64, frameSize=2048):
+  return [memoryview(bytearray(frameSize)) for i in range(poolSize)]
+
+class TapReader(object):
+
+  # fd      - the opened tap device
+  # ifname  - its interface name, for the kernel's drop counter
+  # buffers - pool to read into (see allocateBuffers), which readers whose batches
+  #           are never handled at the same time may share
+  # recorder - PcapRecorder every frame read is copied to (see recorder.py), or None
+  def __init__(self, fd, ifname, buffers=None, recorder=None):
+    self.fd = fd
+    self.recorder = recorder
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    self.epoll = None
+
+    if buffers is None:
+      buffers = allocateBuffers()
+    self.buffers = buffers
+
+    # Frames the kernel dropped because the tap queue was full. Frames written by
+    #  the kernel to tap0 count as tap0's tx, so its tx_dropped counter tracks them.
+    try:
+      self.dropCounter = os.open("/sys/class/net/%s/statistics/tx_dropped" % ifname, os.O_RDONLY)
+      self.lastDropped = self.readDropped()
+    except OSError:
+      self.dropCounter = None
+      self.lastDropped = 0
+
+    # Per-batch reporting
+    #  batchSize  - frames in the last batch
+    #  dropped    - frames the kernel dropped since the previous batch
+    #  batchSizes - histogram of batch sizes (index is the frame count)
+    #  frames/bytes - read from the tap in total
+    self.batchSize = 0
+    self.dropped = 0
+    self.batches = 0
+    self.frames = 0
+    self.bytes = 0
+    self.totalDropped = 0
+    self.batchSizes = [0] * (len(buffers) + 1)
+    # totalDropped when drops were last reported, and when (see scapyHunt.reportDrops)
+    self.reportedDropped = 0
+    self.reportedAt = 0.0
+
+  def readDropped(self):
+    if self.dropCounter is None:
+      return 0
+    return int(os.pread(self.dropCounter, 32, 0))
+
+  # True if the tap queue overflowed since the previous batch
+  @property
+  def overflowed(self):
+    return self.dropped > 0
+
+  # Blocks until frames are queued on the tap, then returns all of them (up to poolSize)
+  def readBatch(self, timeout=-1):
+    if self.epoll is None:
+      self.epoll = select.epoll()
+      self.epoll.register(self.fd, select.EPOLLIN)
+    while 1:
+      try:
+        self.epoll.poll(timeout)
+        break
+      except (IOError, OSError) as e:
+        if e.errno != errno.EINTR:
+          raise
+    return self.drain()
+
+  # Returns every frame currently queued on the tap (up to poolSize), without waiting
+  def drain(self):
+    batch = []
+    for i in range(len(self.buffers)):
+      try:
+        size = os.readv(self.fd, [self.buffers[i]])
+      except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          break
+        raise
+      batch.append(self.buffers[i][:size])
+      self.bytes += size
+    if self.recorder is not None and batch:
+      self.recorder.recordBatch(batch)
+
+    dropped = self.readDropped()
+    self.dropped = dropped - self.lastDropped
+    self.lastDropped = dropped
+    self.totalDropped += self.dropped
+    self.batchSize = len(batch)
+    self.batchSizes[self.batchSize] += 1
+    self.batches += 1
+    self.frames += self.batchSize
+    return batch
+
+  def close(self):
+    if self.epoll is not None:
+      self.epoll.close()
+    if self.dropCounter is not None:
+      os.close(self.dropCounter)
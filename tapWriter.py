@@ -0,0 +1,137 @@
+#
+# Single writer for the tap device
+#
+# Every reply and generated frame is queued here and written by one thread that
+# owns the tap fd, so frames go out in the order they were queued no matter which
+# thread produced them. The thread wakes once per batch rather than once per frame.
+# (A tap fd takes exactly one frame per write(), so writes themselves can't be merged.)
+#
+# The queue is bounded: when it is full new frames are dropped and counted, rather
+# than stalling the packet loop behind the writer.
+#
+# With a link (see linkEmulator.py), frames from hosts on an emulated link are
+# handed to it instead, and come back through queueMany once they are due.
+#
+
+import collections
+import errno
+import os
+import threading
+
+class TapWriter(object):
+
+  # fd       - the opened tap device
+  # capacity - the most frames waiting to be written at once
+  # recorder - PcapRecorder every frame written is copied to (see recorder.py), or None
+  # link     - LinkEmulator holding back the frames of hosts on emulated links, or None
+  def __init__(self, fd, capacity=4096, recorder=None, link=None):
+    self.fd = fd
+    self.capacity = capacity
+    self.recorder = recorder
+    self.link = link
+    self.queue = collections.deque()
+    self.lock = threading.Lock()
+    self.ready = threading.Condition(self.lock)
+
+    # Accounting
+    #  frames/bytes - written to the tap
+    #  batches      - writer wakeups that flushed at least one frame
+    #  dropped      - frames refused because the queue was full (backpressure)
+    #  errors       - frames the kernel refused to take
+    #  maxDepth     - deepest the queue has been
+    self.frames = 0
+    self.bytes = 0
+    self.batches = 0
+    self.dropped = 0
+    self.errors = 0
+    self.maxDepth = 0
+
+    self.thread = None
+
+  # Starts the writer thread (not needed when drained from an event loop)
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name="tapWriter")
+    self.thread.daemon = True
+    self.thread.start()
+
+  # Queues a frame (bytes/bytearray, not a view into a reused buffer) to be written.
+  #  Returns False if the frame was dropped because the queue was full.
+  def write(self, frame):
+    if self.link is not None and self.link.hold(frame):
+      return True
+    with self.lock:
+      depth = len(self.queue)
+      if depth >= self.capacity:
+        self.dropped += 1
+        return False
+      self.queue.append(frame)
+      if depth == 0:
+        self.ready.notify()
+      if depth >= self.maxDepth:
+        self.maxDepth = depth + 1
+    return True
+
+  # Queues several frames at once (see write), taking the lock once. Returns how many
+  #  were queued (or taken by the link); the rest were dropped because the queue was full.
+  def writeMany(self, frames):
+    if self.link is None:
+      return self.queueMany(frames)
+    held = len(frames)
+    frames = self.link.holdMany(frames)
+    held -= len(frames)
+    return held + self.queueMany(frames)
+
+  # Queues several frames at once, past the link (ie, the frames it held back, once
+  #  they are due)
+  def queueMany(self, frames):
+    with self.lock:
+      depth = len(self.queue)
+      room = max(0, self.capacity - depth)
+      if len(frames) > room:
+        self.dropped += len(frames) - room
+        frames = frames[:room]
+      if not frames:
+        return 0
+      self.queue.extend(frames)
+      if depth == 0:
+        self.ready.notify()
+      if depth + len(frames) > self.maxDepth:
+        self.maxDepth = depth + len(frames)
+    return len(frames)
+
+  # Takes everything queued so far, waiting for at least one frame
+  def takeBatch(self):
+    with self.lock:
+      while not self.queue:
+        self.ready.wait()
+      batch = self.queue
+      self.queue = collections.deque()
+    return batch
+
+  # Writes a batch of frames to the tap, in order
+  def flush(self, batch):
+    for frame in batch:
+      try:
+        self.bytes += os.write(self.fd, frame)
+        self.frames += 1
+      except (IOError, OSError) as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS, errno.EINVAL):
+          raise
+        self.errors += 1
+    self.batches += 1
+    if self.recorder is not None:
+      self.recorder.recordBatch(batch)
+
+  # Writes everything queued so far from the calling thread, without waiting.
+  #  Used instead of the writer thread when running on an event loop.
+  def drain(self):
+    with self.lock:
+      if not self.queue:
+        return
+      batch = self.queue
+      self.queue = collections.deque()
+    self.flush(batch)
+
+  def run(self):
+    while 1:
+      self.flush(self.takeBatch())
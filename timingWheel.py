@@ -0,0 +1,258 @@
+#
+# Hierarchical timing wheel for scapyHunt.py
+#
+# Everything a session does later runs off its one TimingWheel: frames held back
+# by an emulated link (see linkEmulator.py), the traffic generators (trafficGen.py),
+# and the daemons that wait on a connection (retransmit timers, see bulkSender.py,
+# and the services' command timeouts). The wheel is itself a single daemon on the
+# session's runtime (see runtime.py), started with whatever is scheduled first.
+#
+# Time is cut into ticks of TICK seconds. The wheel has LEVELS rings of SLOTS slots:
+# a slot of the first ring holds what is due on one tick, a slot of the next ring
+# what is due in a span of SLOTS ticks, and so on. Scheduling something appends it
+# to the slot of the ring its delay falls in, and when the first ring comes round
+# each slot of the next ring is spread back over it (a cascade), so each timer or
+# frame costs O(1) to schedule and is moved at most LEVELS - 1 times before it is
+# due, however many are waiting. The frames due on the ticks a wakeup covers are
+# released to the writer together, as one batch.
+#
+# What is scheduled from the packet loop (or any thread) is only appended to a queue
+# that the wheel takes into its slots on its next wakeup, so the rings are only
+# ever touched from the wheel's daemon. When that is sooner than the wheel was going
+# to wake, it is woken early (see runtime.spawn). The runtime only runs the daemon
+# between the session's batches, so the callbacks can use the session (its CAM
+# table, flows and senders) as the packet handlers do.
+#
+
+import collections
+import math
+import threading
+import time
+
+# Seconds per tick, slots per ring (a power of 2) and how many rings there are:
+#  delays up to TICK * SLOTS ** LEVELS (~50 days) are told apart, longer ones are
+#  due then
+TICK = 0.001
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+# Longest the wheel sleeps while there is nothing in its first ring (so it notices
+#  the time moving on when nothing wakes it)
+MAX_SLEEP = 1.0
+
+class TimingWheel(object):
+
+  # release - function(frames) queueing a batch of frames that are due (ie, the
+  #           session writer's queueMany)
+  def __init__(self, release=None, tick=TICK, clock=time.monotonic):
+    self.release = release
+    self.tick = tick
+    self.clock = clock
+    # The rings, each a list of slots, each a list of (tick, callback, arg); a
+    #  callback of None means arg is a frame to release
+    self.rings = [[[] for i in range(SLOTS)] for level in range(LEVELS)]
+    # Entries in each ring
+    self.counts = [0] * LEVELS
+    # The next tick to run
+    self.current = int(clock() / tick)
+    # (due time, callback, arg) scheduled since the last wakeup
+    self.incoming = collections.deque()
+    # When the wheel's daemon next wakes (0 - while it is running), and the function
+    #  waking it early (see runtime.spawn, None - it isn't running on a runtime)
+    self.lock = threading.Lock()
+    self.wakeAt = 0.0
+    self.alarm = None
+
+    # Accounting
+    #  scheduled - timers and frames scheduled
+    #  fired     - callbacks run
+    #  released  - frames released
+    #  batches   - wakeups that released at least one frame
+    #  cascaded  - moves from a ring to the one below
+    self.scheduled = 0
+    self.fired = 0
+    self.released = 0
+    self.batches = 0
+    self.cascaded = 0
+
+  def __len__(self):
+    return sum(self.counts) + len(self.incoming)
+
+  # Calls callback(arg) in delay seconds
+  def schedule(self, delay, callback, arg):
+    self.add(self.clock() + delay, callback, arg)
+
+  # Releases a frame in delay seconds
+  def send(self, delay, frame):
+    self.add(self.clock() + delay, None, frame)
+
+  # Runs a daemon (a generator yielding how long to wait before it is resumed, as on
+  #  a runtime) from the wheel, starting on its next wakeup
+  def spawn(self, steps):
+    self.add(0.0, self.resume, steps)
+
+  def resume(self, steps):
+    try:
+      delay = next(steps)
+    except StopIteration:
+      return
+    self.schedule(delay, self.resume, steps)
+
+  def add(self, due, callback, arg):
+    self.scheduled += 1
+    self.incoming.append((due, callback, arg))
+    if due < self.wakeAt:
+      with self.lock:
+        if due < self.wakeAt:
+          self.wakeAt = due
+          if self.alarm is not None:
+            self.alarm()
+
+  # Puts a (tick, callback, arg) into the slot it is due in
+  def insert(self, entry):
+    delta = entry[0] - self.current
+    level = 0
+    while delta >= SLOTS and level < LEVELS - 1:
+      delta >>= SLOT_BITS
+      level += 1
+    self.rings[level][(entry[0] >> (SLOT_BITS * level)) & SLOT_MASK].append(entry)
+    self.counts[level] += 1
+
+  # Takes what was scheduled since the last wakeup into the rings (insert, inlined)
+  def admit(self):
+    incoming = self.incoming
+    if not incoming:
+      return
+    tick = self.tick
+    current = self.current
+    limit = current + (1 << (SLOT_BITS * LEVELS)) - 1
+    rings = self.rings
+    first = rings[0]
+    counts = self.counts
+    ceil = math.ceil
+    popleft = incoming.popleft
+    while incoming:
+      due, callback, arg = popleft()
+      t = ceil(due / tick)
+      if t < current:
+        t = current
+      elif t > limit:
+        t = limit
+      delta = t - current
+      if delta < SLOTS:
+        first[t & SLOT_MASK].append((t, callback, arg))
+        counts[0] += 1
+        continue
+      level = 0
+      while delta >= SLOTS and level < LEVELS - 1:
+        delta >>= SLOT_BITS
+        level += 1
+      rings[level][(t >> (SLOT_BITS * level)) & SLOT_MASK].append((t, callback, arg))
+      counts[level] += 1
+
+  # Spreads a slot of a ring over the rings below it
+  def cascade(self, level, index):
+    ring = self.rings[level]
+    entries = ring[index]
+    if not entries:
+      return
+    ring[index] = []
+    self.counts[level] -= len(entries)
+    self.cascaded += len(entries)
+    for entry in entries:
+      self.insert(entry)
+
+  # Runs every tick up to now, returning the frames that came due
+  def advance(self, now):
+    # (a wakeup at a tick's time, as nextDue asks for, runs that tick whatever the
+    #  rounding)
+    target = int(now / self.tick + 1e-6)
+    counts = self.counts
+    first = self.rings[0]
+    frames = []
+    while self.current <= target:
+      t = self.current
+      if not t & SLOT_MASK:
+        level = 1
+        while level < LEVELS:
+          index = (t >> (SLOT_BITS * level)) & SLOT_MASK
+          self.cascade(level, index)
+          if index:
+            break
+          level += 1
+      elif not counts[0]:
+        # Nothing in the first ring: on to the next cascade (or to now)
+        if not any(counts):
+          self.current = target + 1
+          break
+        self.current = min(target, t | SLOT_MASK) + 1
+        continue
+      entries = first[t & SLOT_MASK]
+      if entries:
+        first[t & SLOT_MASK] = []
+        counts[0] -= len(entries)
+        for due, callback, arg in entries:
+          if callback is None:
+            frames.append(arg)
+          else:
+            self.fired += 1
+            callback(arg)
+      self.current = t + 1
+    return frames
+
+  # Seconds from now until the next tick with anything to run
+  def nextDue(self, now):
+    counts = self.counts
+    if self.incoming:
+      return 0.0
+    if not any(counts):
+      return MAX_SLEEP
+    t = self.current
+    if counts[0]:
+      first = self.rings[0]
+      while not first[t & SLOT_MASK]:
+        t += 1
+        if not t & SLOT_MASK:
+          break
+    else:
+      # The next cascade (which may be the current tick)
+      t = ((t - 1) | SLOT_MASK) + 1
+    return min(max(t * self.tick - now, 0.0), MAX_SLEEP)
+
+  # Runs and releases everything due by now. Returns the seconds until something is
+  #  next due.
+  def runDue(self):
+    with self.lock:
+      self.wakeAt = 0.0
+    now = self.clock()
+    self.admit()
+    frames = self.advance(now)
+    if frames:
+      self.released += len(frames)
+      self.batches += 1
+      self.release(frames)
+    # What the callbacks scheduled
+    self.admit()
+    delay = self.nextDue(now)
+    with self.lock:
+      self.wakeAt = now + delay
+    # Anything scheduled since it was admitted, before wakeAt was set, hasn't woken
+    #  the wheel
+    if self.incoming:
+      return 0.0
+    return delay
+
+  # The wheel's daemon (started with runtime.spawn, see sessionWheel)
+  def run(self):
+    while 1:
+      yield self.runDue()
+
+# The session's TimingWheel, releasing frames to its writer; the wheel is made and
+#  started on the session's runtime the first time it is needed
+def sessionWheel(session):
+  wheel = session.wheel
+  if wheel is None:
+    wheel = session.wheel = TimingWheel(session.writer.queueMany)
+    wheel.alarm = session.runtime.spawn(session, wheel.run())
+  return wheel
@@ -0,0 +1,113 @@
+#
+# Simulated background traffic for scapyHunt.py
+#
+# The simulated hosts' own traffic (the knocks from .4, the gateway's noise) is sent
+# from prebuilt frames: a FrameTemplate is assembled once, with valid checksums,
+# and each frame sent from it is a copy with only the ports and sequence number
+# patched in (and the TCP checksum adjusted, as in replyEngine.py).
+#
+# Every source of traffic in a session is a TrafficGenerator with its own rate, and
+# all of them are run by the session's TrafficScheduler as timers on the session's
+# timing wheel (see timingWheel.py), rather than a daemon per source. A generator
+# is asked for as many frames as its rate owes since it last ran, and isn't run
+# again sooner than a TICK later, so a busy generator sends bursts of frames
+# instead of needing a wakeup per frame.
+#
+
+import struct
+
+from replyEngine import checksumAdjust, internetChecksum, word, ethIpTcp, pseudoHeader
+
+# TCP ports and sequence number, the fields patched per frame
+tcpPorts = struct.Struct("!HHI")
+
+TCP_OFFSET = 34
+TCP_CHECKSUM_OFFSET = 50
+
+# Shortest time between a generator's runs (the busiest generators are batched into
+#  ticks this long)
+TICK = 0.01
+# Most sends asked of a generator on one run; when the scheduler falls further
+#  behind than this the rest is skipped rather than sent in one burst
+MAX_BURST = 256
+
+# "12:67:7e:b7:6d:06" -> 6 bytes
+def macToBytes(mac):
+  return bytes.fromhex(mac.replace(":", ""))
+
+# A prebuilt TCP/IPv4 frame, between the given MACs and packed addresses. The
+#  headers match what scapy builds for Ether()/IP()/TCP() with the same fields.
+class FrameTemplate(object):
+  __slots__ = ("data", "checksum", "sum", "ethSrc")
+
+  def __init__(self, ethSrc, ethDst, src, dst, sport=0, dport=0, flags=0x002, seq=0, window=2048):
+    self.ethSrc = ethSrc
+    buf = bytearray(ethIpTcp.pack(macToBytes(ethDst), macToBytes(ethSrc), 0x0800,
+                                  0x45, 0, 40, 1, 0, 64, 6, 0, src, dst,
+                                  sport, dport, seq, 0, 0x50, flags, window, 0, 0))
+    word.pack_into(buf, 24, internetChecksum(buf[14:34]))
+    chksum = internetChecksum(pseudoHeader.pack(src, dst, 0, 6, 20) + bytes(buf[34:54]))
+    word.pack_into(buf, TCP_CHECKSUM_OFFSET, chksum)
+    self.data = bytes(buf)
+    self.checksum = chksum
+    self.sum = sport + dport + seq
+
+  # A copy of the frame with the given ports and sequence number
+  def frame(self, sport, dport, seq=0):
+    buf = bytearray(self.data)
+    tcpPorts.pack_into(buf, TCP_OFFSET, sport, dport, seq)
+    word.pack_into(buf, TCP_CHECKSUM_OFFSET,
+                   checksumAdjust(self.checksum, self.sum, sport + dport + seq))
+    return buf
+
+# A source of traffic, sending rate times a second (see TrafficScheduler).
+#  Subclasses implement send(count), which queues the frames of count sends (one
+#  frame each, or a few, ie. a knock sequence) and returns False once the generator
+#  is done.
+class TrafficGenerator(object):
+
+  def __init__(self, rate):
+    self.interval = 1.0 / rate
+    # When the next frame is due
+    self.due = 0.0
+
+# Runs every generator of a session on the session's timing wheel, each woken when
+#  its next frame is due
+class TrafficScheduler(object):
+
+  # wheel - the TimingWheel (see timingWheel.py) the generators are run from
+  def __init__(self, wheel):
+    self.wheel = wheel
+    self.clock = wheel.clock
+    # The generators still sending
+    self.generators = []
+    # Sends made, and sends skipped when the scheduler fell behind
+    self.sends = 0
+    self.skipped = 0
+
+  def __len__(self):
+    return len(self.generators)
+
+  # Starts a generator; its first send is on the wheel's next wakeup
+  def add(self, generator):
+    generator.due = self.clock()
+    self.generators.append(generator)
+    self.wheel.schedule(0.0, self.run, generator)
+
+  # Sends what the generator owes by now, and schedules it again for when its next
+  #  frame is due (at least a TICK from now, so busy generators send in bursts)
+  def run(self, generator):
+    now = self.clock()
+    due = generator.due
+    interval = generator.interval
+    count = int((now - due) / interval) + 1
+    if count > MAX_BURST:
+      self.skipped += count - MAX_BURST
+      count = MAX_BURST
+      due = now
+    self.sends += count
+    if generator.send(count) is False:
+      self.generators.remove(generator)
+      return
+    generator.due = due + count * interval
+    self.wheel.schedule(max(generator.due - now, TICK), self.run, generator)